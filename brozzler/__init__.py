@@ -37,6 +37,29 @@ class NothingToClaim(Exception):
     pass
 
 
+class HostOverBudget(NothingToClaim):
+    """
+    Raised when a site has pages to claim, but their hosts are over their
+    politeness budget. `wait` is the number of seconds until one of them
+    will be within budget again.
+    """
+
+    def __init__(self, wait):
+        super().__init__(wait)
+        self.wait = wait
+
+
+class PagesDeferred(NothingToClaim):
+    """
+    Raised when none of a site's pages can be claimed until pages that failed
+    are due to be retried. `retry_after` is the earliest of those retries.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
 class CrawlStopped(Exception):
     pass
 
@@ -17,12 +17,15 @@ limitations under the License.
 """
 
 import base64
+import concurrent.futures
 import datetime
+import itertools
 import json
 import logging
 import socket
 import threading
 import time
+import urllib.parse
 from ipaddress import AddressValueError
 
 import structlog
@@ -31,6 +34,7 @@ import websocket
 from requests.structures import CaseInsensitiveDict
 
 import brozzler
+from brozzler import metrics
 from brozzler.chrome import Chrome
 
 
@@ -46,37 +50,112 @@ class BrowsingTimeout(BrowsingException):
     pass
 
 
+class DevtoolsError(BrowsingException):
+    pass
+
+
 class BrowserPool:
     """
     Manages pool of browsers. Automatically chooses available port for the
     debugging protocol.
+
+    By default every browser released back to the pool is stopped, so each
+    site session starts with a cold chrome. With `reuse_browsers=True` the
+    pool instead keeps released browsers running ("warm"), resets them (see
+    `Browser.reset()`) and hands them out again on the next acquire. Warm
+    browsers are retired after `max_pages_per_browser` pages or
+    `max_browser_minutes` minutes, whichever comes first.
+
+    With `shared_chrome=True` the browsers are `ContextBrowser`s, which all
+    browse in browser contexts of a single chrome process.
     """
 
     logger = structlog.get_logger(logger_name=__module__ + "." + __qualname__)
 
-    def __init__(self, size=3, **kwargs):
+    def __init__(
+        self,
+        size=3,
+        reuse_browsers=False,
+        max_pages_per_browser=None,
+        max_browser_minutes=None,
+        shared_chrome=False,
+        **kwargs,
+    ):
         """
         Initializes the pool.
 
         Args:
             size: size of pool (default 3)
+            reuse_browsers: keep browsers running between site sessions
+                (default False)
+            max_pages_per_browser: retire a reused browser after it has
+                browsed this many pages (default None, no limit)
+            max_browser_minutes: retire a reused browser after it has been
+                running this many minutes (default None, no limit)
+            shared_chrome: browse in browser contexts of one chrome process,
+                rather than running a chrome process per browser (default
+                False)
             **kwargs: arguments for Browser(...)
         """
         self.size = size
+        self.reuse_browsers = reuse_browsers
+        self.max_pages_per_browser = max_pages_per_browser
+        self.max_browser_minutes = max_browser_minutes
         self.kwargs = kwargs
         self._in_use = set()
+        self._idle = []
+        self._shutdown = False
         self._lock = threading.Lock()
+        self._shared_chrome = None
+        if shared_chrome:
+            self._shared_chrome = SharedChrome(port=self._free_port(), **kwargs)
 
-    def _fresh_browser(self):
+    def _free_port(self):
         # choose available port
         sock = socket.socket()
         sock.bind(("0.0.0.0", 0))
         port = sock.getsockname()[1]
         sock.close()
+        return port
 
-        browser = Browser(port=port, **self.kwargs)
+    def _fresh_browser(self):
+        if self._shared_chrome:
+            return ContextBrowser(self._shared_chrome)
+        browser = Browser(port=self._free_port(), **self.kwargs)
         return browser
 
+    def _should_retire(self, browser):
+        if not browser.is_running():
+            return True
+        if (
+            self.max_pages_per_browser
+            and browser.pages_browsed >= self.max_pages_per_browser
+        ):
+            return True
+        if (
+            self.max_browser_minutes
+            and time.time() - browser.started_at > self.max_browser_minutes * 60
+        ):
+            return True
+        return False
+
+    def _next_browser(self, retired):
+        """
+        Returns a warm browser if one is idle, otherwise a fresh one. Must be
+        called with `self._lock` held. Idle browsers that are due to be
+        retired are appended to `retired`, to be stopped by the caller
+        outside the lock.
+        """
+        while self._idle:
+            browser = self._idle.pop()
+            if self._should_retire(browser):
+                retired.append(browser)
+            else:
+                metrics.brozzler_browser_pool_hits.inc()
+                return browser
+        metrics.brozzler_browser_pool_misses.inc()
+        return self._fresh_browser()
+
     def acquire_multi(self, n=1):
         """
         Returns a list of up to `n` browsers.
@@ -85,14 +164,19 @@ class BrowserPool:
             NoBrowsersAvailable if none available
         """
         browsers = []
-        with self._lock:
-            if len(self._in_use) >= self.size:
-                raise NoBrowsersAvailable
-            while len(self._in_use) < self.size and len(browsers) < n:
-                browser = self._fresh_browser()
-                browsers.append(browser)
-                self._in_use.add(browser)
-        return browsers
+        retired = []
+        try:
+            with self._lock:
+                if len(self._in_use) >= self.size:
+                    raise NoBrowsersAvailable
+                while len(self._in_use) < self.size and len(browsers) < n:
+                    browser = self._next_browser(retired)
+                    browsers.append(browser)
+                    self._in_use.add(browser)
+            return browsers
+        finally:
+            for retiree in retired:
+                retiree.stop()
 
     def acquire(self):
         """
@@ -104,32 +188,60 @@ class BrowserPool:
         Raises:
             NoBrowsersAvailable if none available
         """
-        with self._lock:
-            if len(self._in_use) >= self.size:
-                raise NoBrowsersAvailable
-            browser = self._fresh_browser()
-            self._in_use.add(browser)
-            return browser
+        retired = []
+        try:
+            with self._lock:
+                if len(self._in_use) >= self.size:
+                    raise NoBrowsersAvailable
+                browser = self._next_browser(retired)
+                self._in_use.add(browser)
+                return browser
+        finally:
+            for retiree in retired:
+                retiree.stop()
+
+    def _keep_warm(self, browser):
+        """
+        Resets `browser` for reuse if it is eligible, returns True on success.
+        """
+        if not self.reuse_browsers or self._shutdown:
+            return False
+        if self._should_retire(browser):
+            return False
+        return browser.reset()
 
     def release(self, browser):
-        browser.stop()  # make sure
+        warm = self._keep_warm(browser)
+        if not warm:
+            browser.stop()  # make sure
         with self._lock:
             self._in_use.remove(browser)
+            if warm and not self._shutdown:
+                self._idle.append(browser)
+                return
+        if warm:
+            # shutdown_now() was called while we were resetting the browser
+            browser.stop()
 
     def release_all(self, browsers):
         for browser in browsers:
-            browser.stop()  # make sure
-        with self._lock:
-            for browser in browsers:
-                self._in_use.remove(browser)
+            self.release(browser)
 
     def shutdown_now(self):
         self.logger.info(
-            "shutting down browser pool (%s browsers in use)", len(self._in_use)
+            "shutting down browser pool",
+            browsers_in_use=len(self._in_use),
+            idle_browsers=len(self._idle),
         )
         with self._lock:
+            self._shutdown = True
             for browser in self._in_use:
                 browser.stop()
+            for browser in self._idle:
+                browser.stop()
+            self._idle = []
+        if self._shared_chrome:
+            self._shared_chrome.stop()
 
     def num_available(self):
         return self.size - len(self._in_use)
@@ -137,10 +249,17 @@ class BrowserPool:
     def num_in_use(self):
         return len(self._in_use)
 
+    def num_idle(self):
+        return len(self._idle)
+
 
 # uncomment the next line for LOTS of debugging logging
 # websocket.enableTrace(True)
 
+# a browser that has requested more distinct origins than this since its last
+# reset is stopped rather than reset and reused
+MAX_TRACKED_ORIGINS = 1000
+
 
 class WebsockReceiverThread(threading.Thread):
     logger = structlog.get_logger(logger_name=__module__ + "." + __qualname__)
@@ -172,23 +291,79 @@ class WebsockReceiverThread(threading.Thread):
 
         self.initial_document = None
 
-        self._result_messages = {}
+        # origins requested since the last Browser.reset(), so that reset()
+        # can clear their storage; None means there were too many to track
+        self.origins = set()
+
+        self._futures = {}  # {msg_id: concurrent.futures.Future}
+        self._futures_lock = threading.Lock()
+
+        # bumped and notified after every message, so that Browser can wait
+        # for something to happen instead of polling
+        self._message_received = threading.Condition()
+        self.message_seq = 0
+
+    def _notify_waiters(self):
+        with self._message_received:
+            self.message_seq += 1
+            self._message_received.notify_all()
+
+    def wait_for_message(self, seq, timeout):
+        """
+        Waits up to `timeout` seconds for a message to arrive after the one
+        numbered `seq` (a previous value of `self.message_seq`).
+
+        Returns:
+            bool: True if a message arrived, False on timeout
+        """
+        with self._message_received:
+            return self._message_received.wait_for(
+                lambda: self.message_seq != seq, timeout
+            )
 
     def expect_result(self, msg_id):
-        self._result_messages[msg_id] = None
+        """
+        Registers interest in the response to the command with id `msg_id`,
+        which must happen before the command is sent.
+
+        Returns:
+            concurrent.futures.Future: resolved with the response message,
+                including error responses
+        """
+        future = concurrent.futures.Future()
+        future.msg_id = msg_id
+        with self._futures_lock:
+            self._futures[msg_id] = future
+        return future
 
     def received_result(self, msg_id):
-        return bool(self._result_messages.get(msg_id))
+        with self._futures_lock:
+            future = self._futures.get(msg_id)
+        return bool(future and future.done())
 
     def pop_result(self, msg_id):
-        return self._result_messages.pop(msg_id)
+        with self._futures_lock:
+            future = self._futures.pop(msg_id, None)
+        return future.result() if future and future.done() else None
+
+    def discard_results(self):
+        """Forgets about responses to any commands still in flight."""
+        with self._futures_lock:
+            self._futures.clear()
+
+    def _resolve(self, message):
+        with self._futures_lock:
+            future = self._futures.get(message["id"])
+        if future and not future.done():
+            future.set_result(message)
 
     def _on_close(self, websock, close_status_code, close_msg):
-        pass
+        self._notify_waiters()
         # self.logger.info('GOODBYE GOODBYE WEBSOCKET')
 
     def _on_open(self, websock):
         self.is_open = True
+        self._notify_waiters()
 
     def _on_error(self, websock, e):
         """
@@ -200,7 +375,8 @@ class WebsockReceiverThread(threading.Thread):
             self.logger.error("websocket closed, did chrome die?")
         else:
             self.logger.exception("exception from websocket receiver thread")
-        brozzler.thread_raise(self.calling_thread, BrowsingException)
+        if self.calling_thread:
+            brozzler.thread_raise(self.calling_thread, BrowsingException)
 
     def run(self):
         # ping_timeout is used as the timeout for the call to select.select()
@@ -223,6 +399,8 @@ class WebsockReceiverThread(threading.Thread):
                 "uncaught exception in _handle_message",
                 message=message,
             )
+        finally:
+            self._notify_waiters()
 
     def _network_response_received(self, message):
         status = message["params"]["response"].get("status")
@@ -284,6 +462,18 @@ class WebsockReceiverThread(threading.Thread):
             return self.initial_document == message["params"]["frameId"]
         return True
 
+    def _note_origin(self, message):
+        if self.origins is None:
+            return
+        try:
+            url = urllib.parse.urlsplit(message["params"]["request"]["url"])
+        except (KeyError, ValueError):
+            return
+        if url.scheme in ("http", "https"):
+            self.origins.add("%s://%s" % (url.scheme, url.netloc))
+            if len(self.origins) > MAX_TRACKED_ORIGINS:
+                self.origins = None
+
     def _handle_message(self, websock, json_message):
         message = json.loads(json_message)
         if "method" in message:
@@ -296,6 +486,7 @@ class WebsockReceiverThread(threading.Thread):
             elif message["method"] == "Network.requestWillBeSent":
                 if self.on_request:
                     self.on_request(message)
+                self._note_origin(message)
 
                 if "params" in message and "requestId" in message["params"]:
                     with self.activity_lock:
@@ -357,9 +548,9 @@ class WebsockReceiverThread(threading.Thread):
                     self.on_service_worker_version_updated(message)
             # else:
             #     self.logger.debug("%s %s", message["method"], json_message)
-        elif "result" in message:
-            if message["id"] in self._result_messages:
-                self._result_messages[message["id"]] = message
+        elif "id" in message:
+            # "result" or "error" response to a command
+            self._resolve(message)
 
     #      else:
     #          self.logger.debug("%s", json_message)
@@ -382,11 +573,18 @@ class Browser:
             **kwargs: arguments for Chrome(...)
         """
         self.chrome = Chrome(**kwargs)
+        # identifies the browser in thread names and `last_claimed_by`
+        self.browser_id = str(self.chrome.port)
         self.websock_url = None
         self.websock = None
         self.websock_thread = None
         self.is_browsing = False
-        self._command_id = Counter()
+        self.proxy = None
+        self.started_at = None
+        self.pages_browsed = 0
+        self._needs_reset = False
+        self._user_agent_overridden = False
+        self._command_id = itertools.count()
         self._wait_interval = 0.5
         self._max_screenshot_width = kwargs.get("max_screenshot_width", 2000)
         self._max_screenshot_height = kwargs.get("max_screenshot_height", 20000)
@@ -400,10 +598,12 @@ class Browser:
 
     def _wait_for(self, callback, timeout=None):
         """
-        Spins until callback() returns truthy.
+        Waits until callback() returns truthy, checking again whenever a
+        message arrives from chrome.
         """
         start = time.time()
         while True:
+            seq = self._message_seq()
             if callback():
                 return
             elapsed = time.time() - start
@@ -411,10 +611,70 @@ class Browser:
                 raise BrowsingTimeout(
                     "timed out after %.1fs waiting for: %s" % (elapsed, callback)
                 )
-            brozzler.sleep(self._wait_interval)
+            self._wait_for_message(seq, timeout - elapsed if timeout else None)
+
+    def _message_seq(self):
+        return self.websock_thread.message_seq if self.websock_thread else None
+
+    def _wait_for_message(self, seq, timeout=None):
+        """
+        Waits for a message from chrome to arrive after `seq`, or `timeout`
+        seconds. Waits at most `self._wait_interval` at a time, because
+        exceptions from `brozzler.thread_raise()` are only delivered between
+        waits.
+        """
+        wait = self._wait_interval
+        if timeout is not None:
+            wait = max(0, min(wait, timeout))
+        if seq is None:
+            brozzler.sleep(wait)
+        else:
+            self.websock_thread.wait_for_message(seq, wait)
 
     def send_to_chrome(self, suppress_logging=False, **kwargs):
+        """
+        Sends a DevTools command to chrome, ignoring the response.
+        """
+        return self._send(next(self._command_id), **kwargs)
+
+    def send_command(self, method, params=None, suppress_logging=False):
+        """
+        Sends a DevTools command to chrome without waiting for the response,
+        so that several commands can be in flight at once. Use `result()` to
+        wait for the response.
+
+        Returns:
+            concurrent.futures.Future: resolved with chrome's response message
+        """
         msg_id = next(self._command_id)
+        future = self.websock_thread.expect_result(msg_id)
+        if params is None:
+            self._send(msg_id, method=method)
+        else:
+            self._send(msg_id, method=method, params=params)
+        return future
+
+    def result(self, future, timeout=10):
+        """
+        Waits for the response to a command sent with `send_command()`.
+
+        Returns:
+            dict: the response message
+
+        Raises:
+            BrowsingTimeout: if there is no response within `timeout` seconds
+            DevtoolsError: if chrome responded with an error
+        """
+        try:
+            self._wait_for(future.done, timeout=timeout)
+        finally:
+            self.websock_thread.pop_result(future.msg_id)
+        message = future.result()
+        if "error" in message:
+            raise DevtoolsError(message["error"])
+        return message
+
+    def _send(self, msg_id, **kwargs):
         kwargs["id"] = msg_id
         msg = json.dumps(kwargs, separators=(",", ":"))
         self.logger.debug(
@@ -425,97 +685,225 @@ class Browser:
         self.websock.send(msg)
         return msg_id
 
-    def start(self, **kwargs):
+    def start(self, cookies=None, **kwargs):
         """
         Starts chrome if it's not running.
 
         Args:
+            cookies: DevTools `Network.CookieParam` dicts to set once chrome
+                is running (default None)
             **kwargs: arguments for self.chrome.start(...)
         """
         if not self.is_running():
             self.websock_url = self.chrome.start(**kwargs)
-            self.websock = websocket.WebSocketApp(self.websock_url)
-            self.websock_thread = WebsockReceiverThread(
-                self.websock, name="WebsockThread:%s" % self.chrome.port
-            )
-            self.websock_thread.start()
-
-            self._wait_for(lambda: self.websock_thread.is_open, timeout=30)
-
-            # tell browser to send us messages we're interested in
-            self.send_to_chrome(method="Network.enable")
-            self.send_to_chrome(method="Page.enable")
-            # Enable Console & Runtime output only when debugging.
-            # After all, we just print these events with debug(), we don't use
-            # them in Brozzler logic.
-            if self.logger.is_enabled_for(logging.DEBUG):
-                self.send_to_chrome(method="Console.enable")
-                self.send_to_chrome(method="Runtime.enable")
-            self.send_to_chrome(method="ServiceWorker.enable")
-            self.send_to_chrome(method="ServiceWorker.setForceUpdateOnPageLoad")
-
-            # disable google analytics and amp analytics
-            self.send_to_chrome(
-                method="Network.setBlockedURLs",
-                params={
-                    "urls": [
-                        "*google-analytics.com/analytics.js*",
-                        "*google-analytics.com/ga.js*",
-                        "*google-analytics.com/ga_exp.js*",
-                        "*google-analytics.com/urchin.js*",
-                        "*google-analytics.com/collect*",
-                        "*google-analytics.com/r/collect*",
-                        "*google-analytics.com/__utm.gif*",
-                        "*google-analytics.com/gtm/js?*",
-                        "*google-analytics.com/cx/api.js*",
-                        "*cdn.ampproject.org/*/amp-analytics*.js",
-                    ]
-                },
-            )
+            self.proxy = kwargs.get("proxy")
+            self.started_at = time.time()
+            self.pages_browsed = 0
+            self._needs_reset = False
+            self._user_agent_overridden = False
+            self._connect()
+            if cookies:
+                self.restore_cookies(cookies)
+
+    def _open_websock(self):
+        self.websock = websocket.WebSocketApp(self.websock_url)
+        self.websock_thread = WebsockReceiverThread(
+            self.websock, name="WebsockThread:%s" % self.chrome.port
+        )
+        self.websock_thread.start()
+
+        self._wait_for(lambda: self.websock_thread.is_open, timeout=30)
+
+    def _connect(self):
+        """
+        Connects to the DevTools websocket at `self.websock_url` and enables
+        the DevTools domains brozzler relies on.
+        """
+        self._open_websock()
+
+        # tell browser to send us messages we're interested in
+        self.send_to_chrome(method="Network.enable")
+        self.send_to_chrome(method="Page.enable")
+        # Enable Console & Runtime output only when debugging.
+        # After all, we just print these events with debug(), we don't use
+        # them in Brozzler logic.
+        if self.logger.is_enabled_for(logging.DEBUG):
+            self.send_to_chrome(method="Console.enable")
+            self.send_to_chrome(method="Runtime.enable")
+        self.send_to_chrome(method="ServiceWorker.enable")
+        self.send_to_chrome(method="ServiceWorker.setForceUpdateOnPageLoad")
+
+        # disable google analytics and amp analytics
+        self.send_to_chrome(
+            method="Network.setBlockedURLs",
+            params={
+                "urls": [
+                    "*google-analytics.com/analytics.js*",
+                    "*google-analytics.com/ga.js*",
+                    "*google-analytics.com/ga_exp.js*",
+                    "*google-analytics.com/urchin.js*",
+                    "*google-analytics.com/collect*",
+                    "*google-analytics.com/r/collect*",
+                    "*google-analytics.com/__utm.gif*",
+                    "*google-analytics.com/gtm/js?*",
+                    "*google-analytics.com/cx/api.js*",
+                    "*cdn.ampproject.org/*/amp-analytics*.js",
+                ]
+            },
+        )
 
     def stop(self):
         """
         Stops chrome if it's running.
         """
         try:
-            if self.websock and self.websock.sock and self.websock.sock.connected:
-                self.logger.info("shutting down websocket connection")
-                try:
-                    self.websock.close()
-                except BaseException:
-                    self.logger.exception(
-                        "exception closing websocket", websocket=self.websock
-                    )
-
+            self._close_websock()
             self.chrome.stop()
+            self._join_websock_thread()
+            self.websock_url = None
+        except:  # noqa: E722
+            self.logger.exception("problem stopping")
 
-            if self.websock_thread and (
-                self.websock_thread != threading.current_thread()
-            ):
+    def _close_websock(self):
+        if self.websock and self.websock.sock and self.websock.sock.connected:
+            self.logger.info("shutting down websocket connection")
+            try:
+                self.websock.close()
+            except BaseException:
+                self.logger.exception(
+                    "exception closing websocket", websocket=self.websock
+                )
+
+    def _join_websock_thread(self):
+        if self.websock_thread and (self.websock_thread != threading.current_thread()):
+            self.websock_thread.join(timeout=30)
+            if self.websock_thread.is_alive():
+                self.logger.error(
+                    "%s still alive 30 seconds after closing %s, will "
+                    "forcefully nudge it again",
+                    self.websock_thread,
+                    self.websock,
+                )
+                self.websock.keep_running = False
                 self.websock_thread.join(timeout=30)
                 if self.websock_thread.is_alive():
-                    self.logger.error(
-                        "%s still alive 30 seconds after closing %s, will "
-                        "forcefully nudge it again",
+                    self.logger.critical(
+                        "%s still alive 60 seconds after closing %s",
                         self.websock_thread,
                         self.websock,
                     )
-                    self.websock.keep_running = False
-                    self.websock_thread.join(timeout=30)
-                    if self.websock_thread.is_alive():
-                        self.logger.critical(
-                            "%s still alive 60 seconds after closing %s",
-                            self.websock_thread,
-                            self.websock,
-                        )
-
-            self.websock_url = None
-        except:  # noqa: E722
-            self.logger.exception("problem stopping")
 
     def is_running(self):
         return self.websock_url is not None
 
+    def _call(self, method, params=None, timeout=10):
+        """
+        Sends a command to chrome and waits for the response.
+        """
+        return self.result(self.send_command(method, params), timeout=timeout)
+
+    def get_cookies(self, timeout=10):
+        """
+        Returns all of the browser's cookies, as DevTools `Network.Cookie`
+        dicts.
+        """
+        message = self._call("Network.getAllCookies", timeout=timeout)
+        return message["result"]["cookies"]
+
+    def set_cookies(self, cookies, timeout=10):
+        """
+        Sets cookies, given as DevTools `Network.CookieParam` dicts.
+        """
+        self._call("Network.setCookies", {"cookies": cookies}, timeout=timeout)
+
+    def restore_cookies(self, cookies):
+        """
+        Sets cookies like `set_cookies()`, logging rather than raising if
+        that fails.
+        """
+        try:
+            self.set_cookies(cookies)
+        except (BrowsingTimeout, DevtoolsError):
+            self.logger.warning(
+                "failed to restore cookies", cookie_count=len(cookies), exc_info=True
+            )
+
+    def open_tab(self):
+        """
+        Opens another tab (DevTools target) in this browser's chrome, so that
+        another page can be browsed at the same time as this one. The tab
+        shares cookies and cache with this browser, and should be stopped
+        before this browser is stopped or reset.
+
+        Returns:
+            BrowserTab: the new tab, connected and ready to browse
+        """
+        if not self.is_running():
+            raise BrowsingException("browser has not been started")
+        tab = BrowserTab(self, self._create_target())
+        try:
+            tab.start()
+        except BaseException:
+            tab.stop()
+            raise
+        return tab
+
+    def _create_target(self):
+        message = self._call("Target.createTarget", {"url": "about:blank"})
+        return message["result"]["targetId"]
+
+    def reset(self):
+        """
+        Prepares a running browser to be reused for a different site: clears
+        cookies, cache and the storage of origins visited since the last
+        reset, undoes per-site configuration and navigates back to
+        about:blank.
+
+        Returns:
+            True if the browser was reset and can be reused, False if it
+            should be stopped instead
+        """
+        if not self.is_running():
+            return False
+        if not self._needs_reset:
+            return True
+        if (
+            self.is_browsing
+            or not self.websock_thread.is_alive()
+            or self.websock_thread.origins is None
+        ):
+            return False
+        self.websock_thread.calling_thread = threading.current_thread()
+        try:
+            self._call("Network.clearBrowserCookies")
+            self._call("Network.clearBrowserCache")
+            for origin in self.websock_thread.origins:
+                self._call(
+                    "Storage.clearDataForOrigin",
+                    {"origin": origin, "storageTypes": "all"},
+                )
+            self._call("Network.setExtraHTTPHeaders", {"headers": {}})
+            if self._user_agent_overridden:
+                # an empty user agent removes the override
+                self._call("Network.setUserAgentOverride", {"userAgent": ""})
+                self._user_agent_overridden = False
+            self.websock_thread.got_page_load_event = None
+            self.send_to_chrome(method="Page.navigate", params={"url": "about:blank"})
+            self._wait_for(lambda: self.websock_thread.got_page_load_event, timeout=10)
+        except Exception:
+            self.logger.warning("failed to reset browser for reuse", exc_info=True)
+            return False
+
+        self.websock_thread.on_service_worker_version_updated = None
+        self.websock_thread.reached_limit = None
+        self.websock_thread.page_status = None
+        self.websock_thread.initial_document = None
+        self.websock_thread.origins = set()
+        with self.websock_thread.activity_lock:
+            self.websock_thread.active_connections.clear()
+        self._needs_reset = False
+        return True
+
     def browse_page(
         self,
         page_url,
@@ -595,6 +983,10 @@ class Browser:
         if self.is_browsing:
             raise BrowsingException("browser is already busy browsing a page")
         self.is_browsing = True
+        # a reused browser may have been started by a different thread
+        self.websock_thread.calling_thread = threading.current_thread()
+        self.pages_browsed += 1
+        self._needs_reset = True
         if on_request:
             self.websock_thread.on_request = on_request
         if on_response:
@@ -642,21 +1034,17 @@ class Browser:
                     behavior_outlinks = self.run_behavior(
                         behavior_script, timeout=behavior_timeout
                     )
-                final_page_url = self.url()
-                if on_screenshot:
-                    if simpler404:
-                        if (
-                            self.websock_thread.page_status
-                            and self.websock_thread.page_status < 400
-                        ):
-                            self._try_screenshot(on_screenshot, screenshot_full_page)
-                    else:
-                        self._try_screenshot(on_screenshot, screenshot_full_page)
-
-                if not run_behaviors or skip_extract_outlinks:
-                    outlinks: frozenset[str] = frozenset()
-                else:
-                    outlinks = self.extract_outlinks(timeout=extract_outlinks_timeout)
+                if simpler404 and not (
+                    self.websock_thread.page_status
+                    and self.websock_thread.page_status < 400
+                ):
+                    on_screenshot = None
+                final_page_url, outlinks = self._finish_page(
+                    extract_outlinks=run_behaviors and not skip_extract_outlinks,
+                    extract_outlinks_timeout=extract_outlinks_timeout,
+                    on_screenshot=on_screenshot,
+                    screenshot_full_page=screenshot_full_page,
+                )
                 if run_behaviors and not skip_visit_hashtags:
                     self.visit_hashtags(final_page_url, hashtags, outlinks)
                 return final_page_url, outlinks.union(behavior_outlinks)
@@ -671,8 +1059,47 @@ class Browser:
             self.is_browsing = False
             self.websock_thread.on_request = None
             self.websock_thread.on_response = None
+            self.websock_thread.discard_results()
 
-    def _try_screenshot(self, on_screenshot, full_page=False):
+    def _finish_page(
+        self,
+        extract_outlinks=True,
+        extract_outlinks_timeout=60,
+        on_screenshot=None,
+        screenshot_full_page=False,
+    ):
+        """
+        Gets the final url, outlinks and screenshot of a page after behaviors
+        have run. The DevTools commands for all of them are sent up front,
+        rather than waiting for each response before sending the next command.
+
+        Returns:
+            tuple: (final_page_url, outlinks)
+        """
+        url_future = self.send_command(
+            "Runtime.evaluate", {"expression": "document.URL"}
+        )
+        layout_metrics = None
+        if on_screenshot and screenshot_full_page:
+            layout_metrics = self.send_command("Page.getLayoutMetrics")
+        if extract_outlinks:
+            self.logger.info("extracting outlinks")
+            inject_future = self._send_outlink_extractor()
+            extract_future = self._send_extract_outlinks()
+
+        final_page_url = self._url_from(self.result(url_future, timeout=30))
+        outlinks: frozenset[str] = frozenset()
+        if extract_outlinks:
+            outlinks = self._outlinks_from(
+                inject_future, extract_future, timeout=extract_outlinks_timeout
+            )
+        if on_screenshot:
+            self._try_screenshot(
+                on_screenshot, screenshot_full_page, layout_metrics=layout_metrics
+            )
+        return final_page_url, outlinks
+
+    def _try_screenshot(self, on_screenshot, full_page=False, layout_metrics=None):
         """The browser instance must be scrolled to the top of the page before
         trying to get a screenshot.
         """
@@ -683,11 +1110,12 @@ class Browser:
         )
         for i in range(3):
             try:
-                jpeg_bytes = self.screenshot(full_page)
+                jpeg_bytes = self.screenshot(full_page, layout_metrics=layout_metrics)
                 on_screenshot(jpeg_bytes)
                 return
-            except BrowsingTimeout:
+            except (BrowsingTimeout, DevtoolsError):
                 self.logger.exception("attempt %s/3", i + 1)
+                layout_metrics = None
 
     def visit_hashtags(self, page_url, hashtags, outlinks):
         _hashtags = set(hashtags or [])
@@ -723,46 +1151,47 @@ class Browser:
             timeout: The maximum number of seconds to wait for.
         """
 
-        def is_idle():
+        deadline = time.time() + timeout
+        while True:
+            seq = self._message_seq()
             with self.websock_thread.activity_lock:
-                elapsed = time.time() - self.websock_thread.last_network_activity
-                return (
-                    len(self.websock_thread.active_connections) == 0
-                    and elapsed > idle_time
-                )
-
-        try:
-            self._wait_for(is_idle, timeout)
-        except BrowsingTimeout:
-            self.logger.debug("idle timed out")
+                quiet_for = time.time() - self.websock_thread.last_network_activity
+                busy = len(self.websock_thread.active_connections) > 0
+            if not busy and quiet_for > idle_time:
+                return
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self.logger.debug("idle timed out")
+                return
+            if not busy:
+                # idle by then unless more network activity wakes us up
+                remaining = min(remaining, idle_time - quiet_for + 0.01)
+            self._wait_for_message(seq, remaining)
 
     def configure_browser(
         self, extra_headers=None, user_agent=None, download_throughput=-1, stealth=False
     ):
         headers = extra_headers or {}
         headers["Accept-Encoding"] = "gzip"  # avoid encodings br, sdch
-        msg_id = self.send_to_chrome(
+        self.send_to_chrome(
             method="Network.setExtraHTTPHeaders", params={"headers": headers}
         )
         if user_agent:
-            msg_id = self.send_to_chrome(
+            self.send_to_chrome(
                 method="Network.setUserAgentOverride", params={"userAgent": user_agent}
             )
+            self._user_agent_overridden = True
         if download_throughput > -1:
             # traffic shaping already used by SPN2 to aid warcprox resilience
             # parameter value as bytes/second, or -1 to disable (default)
-            msg_id = self.send_to_chrome(
+            self.send_to_chrome(
                 method="Network.emulateNetworkConditions",
                 params={"downloadThroughput": download_throughput},
             )
         if stealth:
-            self.websock_thread.expect_result(self._command_id.peek())
             js = brozzler.jinja2_environment().get_template("stealth.js").render()
-            msg_id = self.send_to_chrome(
-                method="Page.addScriptToEvaluateOnNewDocument", params={"source": js}
-            )
-            self._wait_for(
-                lambda: self.websock_thread.received_result(msg_id), timeout=10
+            self._call(
+                "Page.addScriptToEvaluateOnNewDocument", {"source": js}, timeout=10
             )
 
     def navigate_to_page(self, page_url, timeout=300):
@@ -772,40 +1201,41 @@ class Browser:
         self.send_to_chrome(method="Page.navigate", params={"url": page_url})
         self._wait_for(lambda: self.websock_thread.got_page_load_event, timeout=timeout)
 
-    def inject_outlink_extractor(self, timeout=60):
-        self.websock_thread.expect_result(self._command_id.peek())
+    def _send_outlink_extractor(self):
         js = brozzler.jinja2_environment().get_template("extract-outlinks.js").render()
         # This defines the method but doesn't extract outlinks yet
-        msg_id = self.send_to_chrome(
-            method="Runtime.evaluate",
-            suppress_logging=True,
-            params={"expression": js},
-        )
-        self._wait_for(
-            lambda: self.websock_thread.received_result(msg_id), timeout=timeout
+        return self.send_command(
+            "Runtime.evaluate", {"expression": js}, suppress_logging=True
         )
 
-    def extract_outlinks(self, timeout=60) -> frozenset[str]:
-        self.logger.info("extracting outlinks")
-
-        # Define the outlink extractor first before extracting
-        self.inject_outlink_extractor(timeout=timeout)
+    def inject_outlink_extractor(self, timeout=60):
+        self.result(self._send_outlink_extractor(), timeout=timeout)
 
-        self.websock_thread.expect_result(self._command_id.peek())
-        # Now we actually do outlink extraction
-        msg_id = self.send_to_chrome(
-            method="Runtime.evaluate",
-            params={
+    def _send_extract_outlinks(self):
+        return self.send_command(
+            "Runtime.evaluate",
+            {
                 "expression": "__brzl_extractOutlinks()",
                 # returnByValue ensures we can receive an array response
                 "returnByValue": True,
             },
         )
-        self._wait_for(
-            lambda: self.websock_thread.received_result(msg_id), timeout=timeout
-        )
 
-        message = self.websock_thread.pop_result(msg_id)
+    def extract_outlinks(self, timeout=60) -> frozenset[str]:
+        self.logger.info("extracting outlinks")
+        # The outlink extractor is defined before the extraction runs, since
+        # chrome evaluates them in the order they were sent
+        inject_future = self._send_outlink_extractor()
+        extract_future = self._send_extract_outlinks()
+        return self._outlinks_from(inject_future, extract_future, timeout=timeout)
+
+    def _outlinks_from(self, inject_future, extract_future, timeout=60):
+        try:
+            self.result(inject_future, timeout=timeout)
+            message = self.result(extract_future, timeout=timeout)
+        except DevtoolsError as e:
+            self.logger.error("problem extracting outlinks", error=e)
+            return frozenset()
         if (
             "result" in message
             and "result" in message["result"]
@@ -826,19 +1256,19 @@ class Browser:
             self.logger.error("problem extracting outlinks", message=message)
             return frozenset()
 
-    def screenshot(self, full_page=False, timeout=45):
+    def screenshot(self, full_page=False, timeout=45, layout_metrics=None):
         """Optionally capture full page screenshot using puppeteer as an
         inspiration:
         https://github.com/GoogleChrome/puppeteer/blob/master/lib/Page.js#L898
+
+        `layout_metrics` is an already sent Page.getLayoutMetrics command
+        (see `send_command()`) to use for a full page screenshot.
         """
         self.logger.info("taking screenshot")
         if full_page:
-            self.websock_thread.expect_result(self._command_id.peek())
-            msg_id = self.send_to_chrome(method="Page.getLayoutMetrics")
-            self._wait_for(
-                lambda: self.websock_thread.received_result(msg_id), timeout=timeout
-            )
-            message = self.websock_thread.pop_result(msg_id)
+            if layout_metrics is None:
+                layout_metrics = self.send_command("Page.getLayoutMetrics")
+            message = self.result(layout_metrics, timeout=timeout)
             width = min(
                 message["result"]["contentSize"]["width"], self._max_screenshot_width
             )
@@ -861,14 +1291,7 @@ class Browser:
             capture_params = {"format": "jpeg", "quality": 95, "clip": clip}
         else:
             capture_params = {"format": "jpeg", "quality": 95}
-        self.websock_thread.expect_result(self._command_id.peek())
-        msg_id = self.send_to_chrome(
-            method="Page.captureScreenshot", params=capture_params
-        )
-        self._wait_for(
-            lambda: self.websock_thread.received_result(msg_id), timeout=timeout
-        )
-        message = self.websock_thread.pop_result(msg_id)
+        message = self._call("Page.captureScreenshot", capture_params, timeout=timeout)
         jpeg_bytes = base64.b64decode(message["result"]["data"])
         return jpeg_bytes
 
@@ -876,14 +1299,12 @@ class Browser:
         """
         Returns value of document.URL from the browser.
         """
-        self.websock_thread.expect_result(self._command_id.peek())
-        msg_id = self.send_to_chrome(
-            method="Runtime.evaluate", params={"expression": "document.URL"}
-        )
-        self._wait_for(
-            lambda: self.websock_thread.received_result(msg_id), timeout=timeout
+        message = self._call(
+            "Runtime.evaluate", {"expression": "document.URL"}, timeout=timeout
         )
-        message = self.websock_thread.pop_result(msg_id)
+        return self._url_from(message)
+
+    def _url_from(self, message):
         return message["result"]["result"]["value"]
 
     def run_behavior(self, behavior_script, timeout=900) -> frozenset[str]:
@@ -906,21 +1327,17 @@ class Browser:
 
             brozzler.sleep(check_interval)
 
-            self.websock_thread.expect_result(self._command_id.peek())
-            msg_id = self.send_to_chrome(
-                method="Runtime.evaluate",
-                suppress_logging=True,
-                params={
+            future = self.send_command(
+                "Runtime.evaluate",
+                {
                     "expression": "umbraBehaviorFinished()",
                     # returnByValue ensures we can return more complicated types like dicts
                     "returnByValue": True,
                 },
+                suppress_logging=True,
             )
             try:
-                self._wait_for(
-                    lambda: self.websock_thread.received_result(msg_id), timeout=5
-                )
-                msg = self.websock_thread.pop_result(msg_id)
+                msg = self.result(future, timeout=5)
                 if (
                     msg
                     and "result" in msg
@@ -941,7 +1358,7 @@ class Browser:
                             self.logger.info("behavior decided it has finished")
                             outlinks = frozenset(response.get("outlinks", []))
                             return outlinks
-            except BrowsingTimeout:
+            except (BrowsingTimeout, DevtoolsError):
                 pass
 
     def try_login(self, username, password, timeout=300):
@@ -965,18 +1382,14 @@ class Browser:
         # wait for tryLogin to finish trying (should be very very quick)
         start = time.time()
         while True:
-            self.websock_thread.expect_result(self._command_id.peek())
-            msg_id = self.send_to_chrome(
-                method="Runtime.evaluate",
-                params={
+            future = self.send_command(
+                "Runtime.evaluate",
+                {
                     "expression": 'try { __brzl_tryLoginState } catch (e) { "maybe-submitted-form" }'
                 },
             )
             try:
-                self._wait_for(
-                    lambda: self.websock_thread.received_result(msg_id), timeout=5
-                )
-                msg = self.websock_thread.pop_result(msg_id)
+                msg = self.result(future, timeout=5)
                 if msg and "result" in msg and "result" in msg["result"]:
                     result = msg["result"]["result"]["value"]
                     if result == "login-form-not-found":
@@ -991,7 +1404,7 @@ class Browser:
                         break
                     # else try again to get __brzl_tryLoginState
 
-            except BrowsingTimeout:
+            except (BrowsingTimeout, DevtoolsError):
                 pass
 
             if time.time() - start > 30:
@@ -1004,15 +1417,277 @@ class Browser:
         self._wait_for(lambda: self.websock_thread.got_page_load_event, timeout=timeout)
 
 
-class Counter:
-    def __init__(self):
-        self.next_value = 0
+class BrowserTab(Browser):
+    """
+    An additional tab in the chrome of a running `Browser`, opened with
+    `Browser.open_tab()`. Browses pages like a `Browser` does, but stopping it
+    only closes the tab.
+    """
+
+    def __init__(self, browser, target_id):
+        super().__init__(chrome_exe=browser.chrome.chrome_exe, port=browser.chrome.port)
+        self.chrome = browser.chrome
+        self.browser_id = browser.browser_id
+        self.browser = browser
+        self.target_id = target_id
+        self._max_screenshot_width = browser._max_screenshot_width
+        self._max_screenshot_height = browser._max_screenshot_height
+
+    def start(self, **kwargs):
+        """
+        Connects to the tab. Arguments for chrome are ignored, since it is
+        already running.
+        """
+        if not self.is_running():
+            self.websock_url = self.chrome.page_websocket_url(self.target_id)
+            self.proxy = self.browser.proxy
+            self.started_at = time.time()
+            self._connect()
+
+    def stop(self):
+        """
+        Disconnects from the tab and closes it.
+        """
+        try:
+            self._close_websock()
+            self._join_websock_thread()
+            if self.websock_thread and self.browser.websock_thread:
+                # the browser's reset() clears the storage of the origins
+                # this tab visited too
+                if self.websock_thread.origins is None:
+                    self.browser.websock_thread.origins = None
+                elif self.browser.websock_thread.origins is not None:
+                    origins = self.browser.websock_thread.origins
+                    origins.update(self.websock_thread.origins)
+                    if len(origins) > MAX_TRACKED_ORIGINS:
+                        self.browser.websock_thread.origins = None
+            if self.pages_browsed:
+                self.browser._needs_reset = True
+            if self.websock_url and self.browser.is_running():
+                self.browser._call("Target.closeTarget", {"targetId": self.target_id})
+            self.websock_url = None
+        except:  # noqa: E722
+            self.logger.exception("problem closing tab", target_id=self.target_id)
+
+    def reset(self):
+        return False
+
+
+class _BrowserTarget(Browser):
+    """
+    Connection to the browser target of a chrome, for DevTools commands that
+    are not about a particular page.
+    """
+
+    def __init__(self, chrome):
+        super().__init__(chrome_exe=chrome.chrome_exe, port=chrome.port)
+        self.chrome = chrome
+
+    def start(self):
+        if not self.is_running():
+            self.websock_url = self.chrome.browser_websocket_url()
+            self.started_at = time.time()
+            self._open_websock()
+
+    def stop(self):
+        try:
+            self._close_websock()
+            self._join_websock_thread()
+            self.websock_url = None
+        except:  # noqa: E722
+            self.logger.exception("problem disconnecting from browser target")
+
+    def reset(self):
+        return False
+
+
+class SharedChrome:
+    """
+    A chrome process shared by several `ContextBrowser`s, each browsing in its
+    own browser context, which has its own cookies, cache and proxy, like an
+    incognito window.
+    """
 
-    def __next__(self):
+    logger = structlog.get_logger(logger_name=__module__ + "." + __qualname__)
+
+    def __init__(self, **kwargs):
+        """
+        Initializes the SharedChrome.
+
+        Args:
+            **kwargs: arguments for Chrome(...)
+        """
+        self.chrome = Chrome(**kwargs)
+        self._browser_target = None
+        self._lock = threading.Lock()
+        # serializes commands to the browser target, so that an error from
+        # its websocket is raised in the thread waiting on it
+        self._call_lock = threading.Lock()
+        self._context_browser_seq = itertools.count(1)
+
+    def is_running(self):
+        return bool(
+            self._browser_target
+            and self._browser_target.is_running()
+            and self._browser_target.websock_thread.is_alive()
+        )
+
+    def start(self, **kwargs):
+        """
+        Starts chrome if it's not running, or restarts it if it has died.
+
+        Args:
+            **kwargs: arguments for self.chrome.start(...), except for the
+                proxy and cookie db, which are per browser context
+        """
+        with self._lock:
+            if self.is_running():
+                return
+            if self._browser_target:
+                self.logger.warning("shared chrome has died, restarting it")
+                self._stop()
+            self.chrome.start(**kwargs)
+            self._browser_target = _BrowserTarget(self.chrome)
+            try:
+                self._browser_target.start()
+            except BaseException:
+                self._stop()
+                raise
+            # the browser target isn't used by the thread that started it
+            # any more than by other threads, see `_call()`
+            self._browser_target.websock_thread.calling_thread = None
+
+    def _call(self, method, params):
+        """
+        Sends a command to the browser target and waits for the response. An
+        error from the browser target's websocket while waiting is raised in
+        the calling thread, and at other times only logged, since the
+        `ContextBrowser`s notice a dead chrome on their own websockets.
+        """
+        with self._call_lock:
+            websock_thread = self._browser_target.websock_thread
+            websock_thread.calling_thread = threading.current_thread()
+            try:
+                return self._browser_target._call(method, params)
+            finally:
+                websock_thread.calling_thread = None
+
+    def next_browser_id(self):
+        """
+        Returns an id for a new `ContextBrowser`, made of the port of the
+        shared chrome and a sequence number.
+        """
+        return "%s.%s" % (self.chrome.port, next(self._context_browser_seq))
+
+    def stop(self):
+        with self._lock:
+            self._stop()
+
+    def _stop(self):
+        if self._browser_target:
+            self._browser_target.stop()
+            self._browser_target = None
+        self.chrome.stop()
+
+    def create_context(self, proxy=None):
+        """
+        Creates a browser context.
+
+        Args:
+            proxy: http proxy 'host:port' for the context (default None)
+
+        Returns:
+            the id of the browser context
+        """
+        params = {"proxyServer": proxy} if proxy else {}
+        message = self._call("Target.createBrowserContext", params)
+        return message["result"]["browserContextId"]
+
+    def create_target(self, context_id):
+        """
+        Opens a tab at about:blank in browser context `context_id`, returns its
+        target id.
+        """
+        message = self._call(
+            "Target.createTarget",
+            {"url": "about:blank", "browserContextId": context_id},
+        )
+        return message["result"]["targetId"]
+
+    def dispose_context(self, context_id):
+        """
+        Closes browser context `context_id` and all of its tabs.
+        """
+        if self.is_running():
+            self._call("Target.disposeBrowserContext", {"browserContextId": context_id})
+
+
+class ContextBrowser(Browser):
+    """
+    Browses in a browser context of a `SharedChrome` rather than in a chrome
+    process of its own. Starting it creates the browser context, starting the
+    shared chrome first if needed, and stopping it disposes of the context.
+    """
+
+    def __init__(self, shared_chrome):
+        super().__init__(
+            chrome_exe=shared_chrome.chrome.chrome_exe, port=shared_chrome.chrome.port
+        )
+        self.chrome = shared_chrome.chrome
+        self.browser_id = shared_chrome.next_browser_id()
+        self.shared_chrome = shared_chrome
+        self.context_id = None
+
+    def start(self, proxy=None, cookie_db=None, cookies=None, **kwargs):
+        """
+        Creates a browser context and connects to a tab in it.
+
+        Args:
+            proxy: http proxy 'host:port' for the context (default None)
+            cookie_db: ignored, cookie databases are loaded at chrome startup
+            cookies: DevTools `Network.CookieParam` dicts to set in the
+                context (default None)
+            **kwargs: arguments for self.chrome.start(...), used if the shared
+                chrome has to be started
+        """
+        if not self.is_running():
+            if cookie_db:
+                self.logger.info("not loading cookie db into browser context")
+            self.shared_chrome.start(**kwargs)
+            self.context_id = self.shared_chrome.create_context(proxy)
+            try:
+                target_id = self.shared_chrome.create_target(self.context_id)
+                self.websock_url = self.chrome.page_websocket_url(target_id)
+                self.proxy = proxy
+                self.started_at = time.time()
+                self.pages_browsed = 0
+                self._needs_reset = False
+                self._user_agent_overridden = False
+                self._connect()
+                if cookies:
+                    self.restore_cookies(cookies)
+            except BaseException:
+                self.stop()
+                raise
+
+    def stop(self):
+        """
+        Disconnects and disposes of the browser context.
+        """
         try:
-            return self.next_value
+            self._close_websock()
+            self._join_websock_thread()
+            if self.context_id:
+                self.shared_chrome.dispose_context(self.context_id)
+        except:  # noqa: E722
+            self.logger.exception("problem stopping", context_id=self.context_id)
         finally:
-            self.next_value += 1
+            self.context_id = None
+            self.websock_url = None
+
+    def reset(self):
+        # a fresh browser context is cheap, and cleaner than a reset one
+        return False
 
-    def peek(self):
-        return self.next_value
+    def _create_target(self):
+        return self.shared_chrome.create_target(self.context_id)
@@ -301,6 +301,22 @@ class Chrome:
                     self.stop()
                     raise e
 
+    def browser_websocket_url(self):
+        """
+        Returns the websocket url of chrome's browser target, for DevTools
+        commands that are not about a particular page, like creating browser
+        contexts. Chrome must be running.
+        """
+        version_url = "http://localhost:%s/json/version" % self.port
+        raw_json = urllib.request.urlopen(version_url, timeout=30).read()
+        return json.loads(raw_json.decode("utf-8"))["webSocketDebuggerUrl"]
+
+    def page_websocket_url(self, target_id):
+        """
+        Returns the websocket url of the page target (tab) `target_id`.
+        """
+        return "ws://localhost:%s/devtools/page/%s" % (self.port, target_id)
+
     def _read_stderr_stdout(self):
         # XXX select doesn't work on windows
         def readline_nonblock(f):
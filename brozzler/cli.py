@@ -434,6 +434,25 @@ def brozzler_new_job(argv=None):
         metavar="JOB_CONF_FILE",
         help="brozzler job configuration file in yaml",
     )
+    arg_parser.add_argument(
+        "--seeds-file",
+        dest="seeds_file",
+        default=None,
+        help=(
+            "file of more seeds, read one at a time, for jobs with too many "
+            "seeds to list in the job configuration file; one json seed per "
+            "line if the name ends in .jsonl, otherwise a stream of yaml "
+            "documents; a seed is a dict like those in the job configuration "
+            "or just a url"
+        ),
+    )
+    arg_parser.add_argument(
+        "--threads",
+        dest="threads",
+        type=int,
+        default=4,
+        help="number of threads inserting sites and pages into rethinkdb",
+    )
     add_rethinkdb_options(arg_parser)
     add_common_options(arg_parser, argv)
 
@@ -443,10 +462,17 @@ def brozzler_new_job(argv=None):
     rr = rethinker(args)
     frontier = brozzler.RethinkDbFrontier(rr)
     try:
-        brozzler.new_job_file(frontier, args.job_conf_file)
+        brozzler.new_job_file(
+            frontier,
+            args.job_conf_file,
+            seeds_file=args.seeds_file,
+            threads=args.threads,
+        )
     except brozzler.InvalidJobConf as e:
         print(
-            "brozzler-new-job: invalid job file:", args.job_conf_file, file=sys.stderr
+            "brozzler-new-job: invalid job file:",
+            args.seeds_file if "seed number" in e.errors else args.job_conf_file,
+            file=sys.stderr,
         )
         print(
             "  " + yaml.dump(e.errors).rstrip().replace("\n", "\n  "), file=sys.stderr
@@ -577,6 +603,146 @@ def brozzler_worker(argv=None):
         default="1",
         help="max number of chrome instances simultaneously browsing pages",
     )
+    arg_parser.add_argument(
+        "--reuse-browsers",
+        dest="reuse_browsers",
+        action="store_true",
+        help=(
+            "keep chrome running between site sessions, resetting cookies "
+            "and other browser state before each reuse"
+        ),
+    )
+    arg_parser.add_argument(
+        "--max-pages-per-browser",
+        dest="max_pages_per_browser",
+        type=int,
+        default=None,
+        help="with --reuse-browsers, restart chrome after this many pages",
+    )
+    arg_parser.add_argument(
+        "--max-browser-minutes",
+        dest="max_browser_minutes",
+        type=float,
+        default=None,
+        help="with --reuse-browsers, restart chrome after this many minutes",
+    )
+    arg_parser.add_argument(
+        "--page-claim-batch-size",
+        dest="page_claim_batch_size",
+        type=int,
+        default=1,
+        help=(
+            "claim up to this many pages of a site at a time, and hand them "
+            "out from an in-memory priority queue"
+        ),
+    )
+    arg_parser.add_argument(
+        "--completion-pipeline-depth",
+        dest="completion_pipeline_depth",
+        type=int,
+        default=0,
+        help=(
+            "write page completions and outlinks to rethinkdb in the "
+            "background, with up to this many completions queued (0 to write "
+            "them synchronously)"
+        ),
+    )
+    arg_parser.add_argument(
+        "--site-leases",
+        dest="site_leases",
+        action="store_true",
+        help=(
+            "take sites to brozzle from leases offered by one elected worker, "
+            "instead of every worker scanning for claimable sites"
+        ),
+    )
+    arg_parser.add_argument(
+        "--status-feed",
+        dest="status_feed",
+        action="store_true",
+        help=(
+            "follow stop requests for the sites being brozzled through a "
+            "rethinkdb changefeed, interrupting them right away, instead of "
+            "checking before every page"
+        ),
+    )
+    arg_parser.add_argument(
+        "--screenshot-threads",
+        dest="screenshot_threads",
+        type=int,
+        default=2,
+        help=(
+            "number of threads thumbnailing screenshots and writing them to "
+            "warcprox while browsing carries on, or 0 to do that on the "
+            "browsing thread"
+        ),
+    )
+    arg_parser.add_argument(
+        "--host-rate-limit",
+        dest="host_rate_limit",
+        type=float,
+        default=None,
+        help=(
+            "brozzle at most this many pages per minute from each host, "
+            "across all the sites this worker is brozzling (default no limit)"
+        ),
+    )
+    arg_parser.add_argument(
+        "--host-rate-burst",
+        dest="host_rate_burst",
+        type=int,
+        default=1,
+        help="pages of a host that may be brozzled in a burst (default 1)",
+    )
+    arg_parser.add_argument(
+        "--cluster-host-rate-limit",
+        dest="cluster_host_rate_limit",
+        action="store_true",
+        help=(
+            "apply --host-rate-limit across all workers sharing the "
+            "rethinkdb, instead of to each worker"
+        ),
+    )
+    arg_parser.add_argument(
+        "--predict-content-type",
+        dest="predict_content_type",
+        action="store_true",
+        help=(
+            "skip fetching the headers of pages that are expected to be html, "
+            "judging by their extension and what was seen earlier on the "
+            "same host, and browse them straight away"
+        ),
+    )
+    arg_parser.add_argument(
+        "--shared-chrome",
+        dest="shared_chrome",
+        action="store_true",
+        help=(
+            "run a single chrome process, and brozzle each site in a browser "
+            "context of its own, instead of running a chrome process per "
+            "browser"
+        ),
+    )
+    arg_parser.add_argument(
+        "--max-page-concurrency",
+        dest="max_page_concurrency",
+        type=int,
+        default=4,
+        help=(
+            "brozzle at most this many pages of a site at once, in tabs of the "
+            "same browser, for sites configured with page_concurrency"
+        ),
+    )
+    arg_parser.add_argument(
+        "--max-pages-per-host",
+        dest="max_pages_per_host",
+        type=int,
+        default=2,
+        help=(
+            "when brozzling pages of a site at once, brozzle at most this many "
+            "pages of the same host at once"
+        ),
+    )
     arg_parser.add_argument("--proxy", dest="proxy", default=None, help="http proxy")
     arg_parser.add_argument(
         "--no-headless",
@@ -713,7 +879,9 @@ def brozzler_worker(argv=None):
         return ytdlp_proxy_endpoints
 
     rr = rethinker(args)
-    frontier = brozzler.RethinkDbFrontier(rr)
+    frontier = brozzler.RethinkDbFrontier(
+        rr, page_claim_batch_size=args.page_claim_batch_size
+    )
     service_registry = doublethink.ServiceRegistry(rr)
     ytdlp_proxy_endpoints_from_file = get_ytdlp_proxy_endpoints()
     worker = brozzler.worker.BrozzlerWorker(
@@ -734,6 +902,20 @@ def brozzler_worker(argv=None):
         registry_url=args.registry_url,
         env=args.env,
         worker_id=args.worker_id,
+        reuse_browsers=args.reuse_browsers,
+        max_pages_per_browser=args.max_pages_per_browser,
+        max_browser_minutes=args.max_browser_minutes,
+        completion_pipeline_depth=args.completion_pipeline_depth,
+        predict_content_type=args.predict_content_type,
+        site_leases=args.site_leases,
+        max_page_concurrency=args.max_page_concurrency,
+        max_pages_per_host=args.max_pages_per_host,
+        shared_chrome=args.shared_chrome,
+        status_feed=args.status_feed,
+        screenshot_threads=args.screenshot_threads,
+        host_rate_limit=args.host_rate_limit,
+        host_rate_burst=args.host_rate_burst,
+        cluster_host_rate_limit=args.cluster_host_rate_limit,
     )
 
     signal.signal(signal.SIGQUIT, dump_state)
@@ -753,6 +935,11 @@ def brozzler_ensure_tables(argv=None):
     needs on demand at startup, but if multiple instances are starting up at
     the same time, you can end up with duplicate broken tables. So it's a good
     idea to use this utility at an early step when spinning up a cluster.
+
+    Also builds indexes added by newer versions of brozzler to existing
+    tables, waiting for them to be ready, which can take a long time on a big
+    pages table. Run it after upgrading brozzler, before starting the rest of
+    the cluster, which refuses to start until the indexes are ready.
     """
     argv = argv or sys.argv
     arg_parser = argparse.ArgumentParser(
@@ -770,8 +957,9 @@ def brozzler_ensure_tables(argv=None):
     # services table
     doublethink.ServiceRegistry(rr)
 
-    # sites, pages, jobs tables
-    brozzler.frontier.RethinkDbFrontier(rr)
+    # sites, pages, jobs tables, and indexes added to them since they were
+    # created
+    brozzler.frontier.RethinkDbFrontier(rr, build_indexes=True)
 
 
 class Jsonner(json.JSONEncoder):
@@ -827,7 +1015,11 @@ def brozzler_list_jobs(argv=None):
     else:
         reql = rr.table("jobs").order_by("id")
         if args.active:
-            reql = reql.filter({"status": "ACTIVE"})
+            reql = reql.filter(
+                lambda job: r.expr(list(brozzler.Job.ACTIVE_STATUSES)).contains(
+                    job["status"]
+                )
+            )
         logger.debug("querying rethinkdb", query=reql)
         results = reql.run()
     if args.yaml:
@@ -1057,18 +1249,20 @@ def brozzler_purge(argv=None):
         if not job:
             logger.fatal("no such job", job_id=job_id)
             sys.exit(1)
-        if job.status == "ACTIVE":
+        # a job whose seeding failed is still crawling the seeds it has
+        if job.status in brozzler.Job.ACTIVE_STATUSES:
             if args.force:
                 logger.warning(
-                    "job has status ACTIVE, purging anyway because "
-                    "--force was supplied",
+                    "job is still active, purging anyway because --force was supplied",
                     job_id=job_id,
+                    status=job.status,
                 )
             else:
                 logger.fatal(
-                    "refusing to purge job because status is ACTIVE "
+                    "refusing to purge job because it is still active "
                     "(override with --force)",
                     job_id=job_id,
+                    status=job.status,
                 )
                 sys.exit(1)
         _purge_job(rr, job_id)
@@ -1132,6 +1326,10 @@ def _purge_site(rr, site_id):
     result = reql.run()
     site_logger.info("purged pages for site", result=result)
 
+    reql = rr.table("site_stats").get(site_id).delete()
+    site_logger.debug("purging site_stats", query=reql)
+    reql.run()
+
     reql = rr.table("sites").get(site_id).delete()
     site_logger.debug("purging site", query=reql)
     result = reql.run()
@@ -0,0 +1,93 @@
+"""
+brozzler/content_type.py - predicts whether a url serves html, so that
+brozzler can skip fetching its headers before deciding to browse it
+
+Copyright (C) 2026 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import collections
+import posixpath
+import threading
+import urllib.parse
+
+# extensions that are served as html unless this host has shown otherwise
+HTML_EXTENSIONS = frozenset({".htm", ".html", ".shtml", ".xhtml"})
+
+
+class ContentTypePredictor:
+    """
+    Predicts whether a url serves html, from its extension and from the
+    content types previously seen on the same host for urls with the same
+    extension (or no extension).
+
+    Observations come from header requests and from the responses chrome
+    reports while browsing. A url is only predicted to be html once the last
+    `min_observations` observations for its host and extension were all
+    html, or, for extensions in `HTML_EXTENSIONS`, if nothing else has been
+    seen for them. Anything else is unknown, meaning the headers should be
+    fetched.
+    """
+
+    def __init__(self, min_observations=3, max_entries=10000):
+        self.min_observations = min_observations
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # {(host, extension): number of html responses in a row}
+        self._html_streaks = collections.OrderedDict()
+
+    @staticmethod
+    def _key(url):
+        if not url:
+            return None
+        try:
+            split = urllib.parse.urlsplit(url)
+        except ValueError:
+            return None
+        if split.scheme not in ("http", "https") or not split.hostname:
+            return None
+        extension = posixpath.splitext(split.path)[1].lower()
+        return (split.hostname, extension)
+
+    def observe(self, url, content_type):
+        """
+        Notes that `url` was served with `content_type` (a Content-Type header
+        value or a mime type).
+        """
+        key = self._key(url)
+        if key is None:
+            return
+        is_html = bool(content_type) and "html" in content_type.lower()
+        with self._lock:
+            if is_html:
+                self._html_streaks[key] = self._html_streaks.get(key, 0) + 1
+            else:
+                self._html_streaks[key] = 0
+            self._html_streaks.move_to_end(key)
+            while len(self._html_streaks) > self.max_entries:
+                self._html_streaks.popitem(last=False)
+
+    def predicts_html(self, url):
+        """
+        Returns True if `url` is expected to serve html, False if that is
+        unknown.
+        """
+        key = self._key(url)
+        if key is None:
+            return False
+        with self._lock:
+            streak = self._html_streaks.get(key)
+        if streak is None:
+            return key[1] in HTML_EXTENSIONS
+        return streak >= self.min_observations
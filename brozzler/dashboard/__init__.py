@@ -66,9 +66,23 @@ def service_registry():
     return _svc_reg
 
 
+def _site_stats(site_id):
+    """
+    Returns the page counters the frontier keeps for the site, or None for
+    sites created by older versions of brozzler, whose pages have to be
+    counted.
+    """
+    reql = rr.table("site_stats").get(site_id)
+    logger.debug("querying rethinkdb", query=reql)
+    return reql.run()
+
+
 @app.route("/api/sites/<site_id>/queued_count")
 @app.route("/api/site/<site_id>/queued_count")
 def queued_count(site_id):
+    stats = _site_stats(site_id)
+    if stats:
+        return flask.jsonify(count=stats["queued"])
     reql = (
         rr.table("pages")
         .between(
@@ -104,6 +118,9 @@ def queue(site_id):
 @app.route("/api/sites/<site_id>/page_count")
 @app.route("/api/site/<site_id>/page_count")
 def page_count(site_id):
+    stats = _site_stats(site_id)
+    if stats:
+        return flask.jsonify(count=stats["brozzled"])
     reql = (
         rr.table("pages")
         .between(
@@ -156,14 +173,20 @@ def page_yaml(page_id):
     )
 
 
+def _encode_cookies(site):
+    # TypeError: <binary, 7168 bytes, '53 51 4c 69 74 65...'> is not JSON serializable
+    for field in ("cookie_db", "cookies"):
+        if field in site:
+            site[field] = base64.b64encode(site[field]).decode("ascii")
+
+
 @app.route("/api/sites/<site_id>")
 @app.route("/api/site/<site_id>")
 def site(site_id):
     reql = rr.table("sites").get(site_id)
     logger.debug("querying rethinkdb", query=reql)
     s = reql.run()
-    if "cookie_db" in s:
-        s["cookie_db"] = base64.b64encode(s["cookie_db"]).decode("ascii")
+    _encode_cookies(s)
     return flask.jsonify(s)
 
 
@@ -196,10 +219,8 @@ def sites(job_id):
     reql = rr.table("sites").get_all(jid, index="job_id")
     logger.debug("querying rethinkdb", query=reql)
     sites_ = list(reql.run())
-    # TypeError: <binary, 7168 bytes, '53 51 4c 69 74 65...'> is not JSON serializable
     for s in sites_:
-        if "cookie_db" in s:
-            s["cookie_db"] = base64.b64encode(s["cookie_db"]).decode("ascii")
+        _encode_cookies(s)
     return flask.jsonify(sites=sites_)
 
 
@@ -209,10 +230,8 @@ def jobless_sites():
     reql = rr.table("sites").filter(~r.row.has_fields("job_id"))
     logger.debug("querying rethinkdb", query=reql)
     sites_ = list(reql.run())
-    # TypeError: <binary, 7168 bytes, '53 51 4c 69 74 65...'> is not JSON serializable
     for s in sites_:
-        if "cookie_db" in s:
-            s["cookie_db"] = base64.b64encode(s["cookie_db"]).decode("ascii")
+        _encode_cookies(s)
     return flask.jsonify(sites=sites_)
 
 
@@ -17,7 +17,13 @@ limitations under the License.
 """
 
 import datetime
-from typing import Dict, List
+import heapq
+import itertools
+import queue
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
 
 import doublethink
 import rethinkdb as rdb
@@ -25,6 +31,8 @@ import structlog
 import urlcanon
 
 import brozzler
+from brozzler import metrics
+from brozzler.politeness import url_host
 
 r = rdb.RethinkDB()
 
@@ -33,12 +41,42 @@ class UnexpectedDbResult(Exception):
     pass
 
 
+class PagesNotSaved(Exception):
+    """
+    Raised when brozzled pages couldn't be written to rethinkdb, even after
+    retrying. The pages, whose ids are `page_ids`, are still claimed in
+    rethinkdb, so they are brozzled again when their site is next claimed.
+    """
+
+    def __init__(self, page_ids, error):
+        super().__init__("%s brozzled pages not saved: %r" % (len(page_ids), error))
+        self.page_ids = page_ids
+        self.error = error
+
+
+class IndexesNotReady(Exception):
+    """
+    Raised by `RethinkDbFrontier` when indexes this version of brozzler needs
+    haven't been built yet on tables created by an older version. They are
+    built by `brozzler-ensure-tables`.
+    """
+
+
 def filter_claimable_site_ids(
     active_sites: List[Dict],
     reclaim_cooldown: int,
     max_sites_to_claim=1,
+    job_counts: Optional[Dict] = None,
 ) -> List[str]:
-    job_counts = {}
+    """
+    Picks up to `max_sites_to_claim` ids of claimable sites from
+    `active_sites`, in order, respecting each job's `max_claimed_sites`.
+
+    `job_counts` is the number of currently claimed sites of each job, for
+    when `active_sites` doesn't include all the claimed sites; by default
+    they are counted from `active_sites`.
+    """
+    job_counts = dict(job_counts or {})
     claimable_sites = []
     now = datetime.datetime.now(datetime.timezone.utc)
 
@@ -88,13 +126,120 @@ def filter_claimable_site_ids(
     return site_ids_to_claim
 
 
+class _SitePageQueue:
+    """
+    Pages of one site, already marked claimed in rethinkdb, waiting to be
+    handed out by `RethinkDbFrontier.claim_page()`, highest priority first.
+
+    Every page of the site that is claimable but not in the queue has a
+    priority no higher than the lowest priority in the queue (the "floor"),
+    as long as `exhausted` is False. If `exhausted` is True, there are no
+    claimable pages outside the queue at all.
+    """
+
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.exhausted = False
+        self.lock = threading.Lock()
+        self._heap = []  # [(-priority, seq, page_id), ...]
+        self._pages = {}  # {page_id: (seq, page), ...}
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return len(self._pages)
+
+    def __contains__(self, page_id):
+        return page_id in self._pages
+
+    def page_ids(self):
+        return list(self._pages)
+
+    def get(self, page_id):
+        """Returns the queued copy of the page, or None."""
+        if page_id in self._pages:
+            return self._pages[page_id][1]
+        return None
+
+    def push(self, page):
+        """Adds `page`, or replaces the queued copy of it."""
+        seq = next(self._seq)
+        self._pages[page.id] = (seq, page)
+        heapq.heappush(self._heap, (-page.priority, seq, page.id))
+
+    def pop(self):
+        """Returns the highest priority page, or None if the queue is empty."""
+        while self._heap:
+            _, seq, page_id = heapq.heappop(self._heap)
+            # skip entries superseded by a later push()
+            if page_id in self._pages and self._pages[page_id][0] == seq:
+                return self._pages.pop(page_id)[1]
+        return None
+
+    def floor(self):
+        """Returns the lowest priority in the queue, or None if it's empty."""
+        if not self._pages:
+            return None
+        return min(page.priority for _, page in self._pages.values())
+
+    def drain(self):
+        """Empties the queue, returning the ids of the pages that were in it."""
+        page_ids = list(self._pages)
+        self._pages = {}
+        self._heap = []
+        return page_ids
+
+
 class RethinkDbFrontier:
     logger = structlog.get_logger(logger_name=__module__ + "." + __qualname__)
 
-    def __init__(self, rr, shards=None, replicas=None):
+    # fields of a site that other processes may change while it is being
+    # brozzled, see `refresh_site_control_fields()`
+    SITE_CONTROL_FIELDS = ("status", "stop_requested", "time_limit")
+
+    # number of the highest priority pages `claim_page()` chooses from when
+    # it's given a host budget
+    HOST_BUDGET_CANDIDATES = 4
+
+    # page counters kept per site in the site_stats table, see
+    # `_tracking_site_stats()`: unclaimed and claimed pages not yet brozzled,
+    # and pages brozzled at least once
+    SITE_STATS_FIELDS = ("queued", "claimed", "brozzled")
+
+    # attempts at writing a batch of pages in `_save_pages()` before giving up
+    PAGE_BATCH_ATTEMPTS = 3
+
+    def __init__(
+        self,
+        rr,
+        shards=None,
+        replicas=None,
+        page_claim_batch_size=1,
+        build_indexes=False,
+    ):
+        """
+        Args:
+            rr: doublethink.Rethinker
+            shards: number of shards for tables this creates (default number
+                of rethinkdb servers)
+            replicas: number of replicas for tables this creates (default
+                number of rethinkdb servers, max 3)
+            page_claim_batch_size: if greater than 1, `claim_page()` claims up
+                to this many pages of a site in one query and hands them out
+                one at a time from a local priority queue (default 1, one
+                query per page)
+            build_indexes: if True, builds indexes missing from tables
+                created by an older version of brozzler and waits for them,
+                which can take hours on a big pages table; if False, raises
+                `IndexesNotReady` if any are missing or still being built
+                (default False)
+        """
         self.rr = rr
         self.shards = shards or len(rr.servers)
         self.replicas = replicas or min(len(rr.servers), 3)
+        self.page_claim_batch_size = page_claim_batch_size
+        self._page_queues = {}  # {site_id: _SitePageQueue, ...}
+        self._page_queues_lock = threading.Lock()
+        self._build_indexes = build_indexes
         self._ensure_db()
 
     def _ensure_db(self):
@@ -114,6 +259,9 @@ class RethinkDbFrontier:
                 "sites_last_disclaimed", [r.row["status"], r.row["last_disclaimed"]]
             ).run()
             self.rr.table("sites").index_create("job_id").run()
+            self._create_indexes("sites", self._site_indexes())
+        else:
+            self._ensure_indexes("sites", self._site_indexes())
         if "pages" not in tables:
             db_logger.info("creating rethinkdb table 'pages' in database")
             self.rr.table_create(
@@ -134,12 +282,137 @@ class RethinkDbFrontier:
                 "least_hops",
                 [r.row["site_id"], r.row["brozzle_count"], r.row["hops_from_seed"]],
             ).run()
+            self._create_indexes("pages", self._page_indexes())
+        else:
+            self._ensure_indexes("pages", self._page_indexes())
+        if "site_stats" not in tables:
+            db_logger.info("creating rethinkdb table 'site_stats' in database")
+            self.rr.table_create(
+                "site_stats", shards=self.shards, replicas=self.replicas
+            ).run()
+        if "site_leases" not in tables:
+            db_logger.info("creating rethinkdb table 'site_leases' in database")
+            self.rr.table_create(
+                "site_leases", shards=self.shards, replicas=self.replicas
+            ).run()
+            self.rr.table("site_leases").index_create("seq").run()
+        if "host_buckets" not in tables:
+            db_logger.info("creating rethinkdb table 'host_buckets' in database")
+            self.rr.table_create(
+                "host_buckets", shards=self.shards, replicas=self.replicas
+            ).run()
+            self._create_indexes("host_buckets", self._host_bucket_indexes())
+        else:
+            self._ensure_indexes("host_buckets", self._host_bucket_indexes())
         if "jobs" not in tables:
             db_logger.info("creating rethinkdb table 'jobs' in database")
             self.rr.table_create(
                 "jobs", shards=self.shards, replicas=self.replicas
             ).run()
 
+    def _site_indexes(self):
+        """
+        Returns the indexes of the sites table that were added after it was
+        first created, as {name: (index function, index_create kwargs)}.
+        """
+        return {
+            "sites_claimable": (
+                [r.row["status"], r.row["claimed"], r.row["last_disclaimed"]],
+                {},
+            ),
+            "sites_claimed_since": (
+                [r.row["status"], r.row["claimed"], r.row["last_claimed"]],
+                {},
+            ),
+            # job ids of sites that haven't finished, for _maybe_finish_job()
+            "sites_unfinished_by_job": (
+                lambda site: r.branch(
+                    site["status"].match("^FINISH"), [], [site["job_id"]]
+                ),
+                {"multi": True},
+            ),
+        }
+
+    def _page_indexes(self):
+        """
+        Returns the indexes of the pages table that were added after it was
+        first created, as {name: (index function, index_create kwargs)}.
+        """
+        return {
+            # claimable pages that aren't waiting to be retried after a
+            # failure, for _claim_pages()
+            "priority_by_site_ready": (
+                lambda page: [
+                    page["site_id"],
+                    page["brozzle_count"],
+                    page["retry_after"].default(None).ne(None),
+                    page["claimed"],
+                    page["priority"],
+                ],
+                {},
+            ),
+            # pages waiting to be retried, by when
+            "retry_after_by_site": (
+                lambda page: r.branch(
+                    page["retry_after"].default(None).eq(None),
+                    [],
+                    [[page["site_id"], page["brozzle_count"], page["retry_after"]]],
+                ),
+                {"multi": True},
+            ),
+        }
+
+    def _host_bucket_indexes(self):
+        """
+        Returns the indexes of the host_buckets table, as {name: (index
+        function, index_create kwargs)}.
+        """
+        return {
+            # for RethinkDbHostTokenBuckets.prune()
+            "updated": (r.row["updated"], {}),
+        }
+
+    def _create_indexes(self, table, indexes, names=None):
+        for name, (index, kwargs) in indexes.items():
+            if names is None or name in names:
+                self.rr.table(table).index_create(name, index, **kwargs).run()
+
+    def _ensure_indexes(self, table, indexes):
+        """
+        Makes sure `table`, which may have been created by an older version
+        of brozzler, has `indexes`. Missing ones are only built if
+        `build_indexes` was passed to the constructor, because that blocks
+        until they are ready.
+
+        Raises:
+            IndexesNotReady: if `build_indexes` is False and some of
+                `indexes` are missing or still being built
+        """
+        existing = self.rr.table(table).index_list().run()
+        missing = [name for name in indexes if name not in existing]
+        if missing and self._build_indexes:
+            self.logger.info(
+                "building rethinkdb indexes, which can take a long time on a big table",
+                table=table,
+                indexes=missing,
+            )
+            self._create_indexes(table, indexes, missing)
+            self.rr.table(table).index_wait(*missing).run()
+            return
+        if missing:
+            raise IndexesNotReady(
+                "rethinkdb table %r is missing indexes %r needed by this "
+                "version of brozzler; run brozzler-ensure-tables to build "
+                "them" % (table, missing)
+            )
+        statuses = self.rr.table(table).index_status(*indexes).run()
+        building = [status["index"] for status in statuses if not status["ready"]]
+        if building:
+            raise IndexesNotReady(
+                "rethinkdb indexes %r of table %r are still being built; "
+                "wait for brozzler-ensure-tables to finish" % (building, table)
+            )
+
     def _vet_result(self, result, **kwargs):
         # self.logger.debug("vetting expected=%s result=%s", kwargs, result)
         # {'replaced': 0, 'errors': 0, 'skipped': 0, 'inserted': 1, 'deleted': 0, 'generated_keys': ['292859c1-4926-4b27-9d87-b2c367667058'], 'unchanged': 0}
@@ -180,16 +453,105 @@ class RethinkDbFrontier:
         )
         return active_sites
 
+    def get_claimable_sites(self, n=1, reclaim_cooldown=20):
+        """
+        Fetches a window of candidates for `claim_sites()` using indexes,
+        rather than reading every active site like `get_active_sites()`.
+
+        Returns:
+            tuple: (candidate sites, stale claims first, then unclaimed sites
+                longest disclaimed first; number of currently claimed sites
+                of each job with `max_claimed_sites`)
+        """
+        window = max(n * 4, 50)
+        fields = [
+            "id",
+            "last_disclaimed",
+            "claimed",
+            "last_claimed",
+            "job_id",
+            "max_claimed_sites",
+        ]
+        stale_before = r.now().sub(60 * 60)
+
+        # there are only as many claimed sites as there are browsers in the
+        # cluster, so reading the live ones to count them is cheap
+        job_counts = {}
+        job_limits = {}
+        claimed_sites = (
+            self.rr.table("sites", read_mode="majority")
+            .between(
+                ["ACTIVE", True, stale_before],
+                ["ACTIVE", True, r.maxval],
+                index="sites_claimed_since",
+                left_bound="open",
+            )
+            .has_fields("job_id", "max_claimed_sites")
+            .pluck("job_id", "max_claimed_sites")
+            .run()
+        )
+        for site in claimed_sites:
+            job_counts[site["job_id"]] = job_counts.get(site["job_id"], 0) + 1
+            job_limits[site["job_id"]] = site["max_claimed_sites"]
+        full_job_ids = [
+            job_id
+            for job_id, count in job_counts.items()
+            if count >= job_limits[job_id]
+        ]
+
+        stale_claims = list(
+            self.rr.table("sites", read_mode="majority")
+            .between(
+                ["ACTIVE", True, r.minval],
+                ["ACTIVE", True, stale_before],
+                index="sites_claimed_since",
+                right_bound="closed",
+            )
+            .limit(window)
+            .pluck(*fields)
+            .run()
+        )
+
+        query = self.rr.table("sites", read_mode="majority").between(
+            ["ACTIVE", False, r.minval],
+            ["ACTIVE", False, r.now().sub(reclaim_cooldown)],
+            index="sites_claimable",
+            right_bound="closed",
+        )
+        query = query.order_by(index="sites_claimable")
+        if full_job_ids:
+            # skip sites of jobs that can't have any more sites claimed
+            query = query.filter(
+                lambda site: (
+                    r.expr(full_job_ids).contains(site["job_id"].default(None)).not_()
+                )
+            )
+        unclaimed = list(query.limit(window).pluck(*fields).run())
+
+        return stale_claims + unclaimed, job_counts
+
     def claim_sites(self, n=1, reclaim_cooldown=20) -> List[Dict]:
         self.logger.debug("claiming up to %s sites to brozzle", n)
 
-        active_sites = self.get_active_sites()
+        candidates, job_counts = self.get_claimable_sites(n, reclaim_cooldown)
         site_ids_to_claim = filter_claimable_site_ids(
-            active_sites, reclaim_cooldown, max_sites_to_claim=n
+            candidates, reclaim_cooldown, max_sites_to_claim=n, job_counts=job_counts
         )
+        sites = self._claim_site_ids(site_ids_to_claim)
+        if sites:
+            return sites
+        else:
+            raise brozzler.NothingToClaim
+
+    def _claim_site_ids(self, site_ids):
+        """
+        Marks the sites claimed, unless another worker got to them first.
+        Returns a possibly empty list of `brozzler.Site`.
+        """
+        n = len(site_ids)
         result = (
             self.rr.table("sites", read_mode="majority")
-            .get_all(r.args(site_ids_to_claim))
+            .get_all(r.args(site_ids))
             .update(  # mark the sites we're claiming, and return changed sites (our final claim
                 # results)
                 #
@@ -224,10 +586,27 @@ class RethinkDbFrontier:
             site = brozzler.Site(self.rr, result["changes"][i]["new_val"])
             sites.append(site)
         self.logger.debug("claimed %s sites", len(sites))
-        if sites:
-            return sites
-        else:
-            raise brozzler.NothingToClaim
+        return sites
+
+    def claim_leased_sites(self, n=1) -> List[Dict]:
+        """
+        Takes up to `n` site leases offered by the `SiteLeaseCoordinator` and
+        claims those sites. Returns a possibly empty list of `brozzler.Site`.
+
+        Each lease is handed to exactly one worker, so workers don't race
+        each other for the same sites.
+        """
+        result = (
+            self.rr.table("site_leases")
+            .order_by(index="seq")
+            .limit(n)
+            .delete(return_changes=True)
+            .run()
+        )
+        site_ids = [change["old_val"]["id"] for change in result.get("changes", [])]
+        if not site_ids:
+            return []
+        return self._claim_site_ids(site_ids)
 
     def enforce_time_limit(self, site):
         """
@@ -242,37 +621,464 @@ class RethinkDbFrontier:
             )
             raise brozzler.ReachedTimeLimit
 
-    def claim_page(self, site, worker_id):
+    def _candidate_pages(self, site, n, exclude_page_ids=None):
+        """
+        Returns a reql sequence of up to `n` of the site's claimable pages,
+        highest priority first, with only the fields "id", "url", "claimed"
+        and "priority".
+
+        Candidates come from two indexes, so that pages waiting to be retried
+        after a failure are never scanned: pages that aren't waiting, from
+        "priority_by_site_ready", and pages whose `retry_after` has passed,
+        from "retry_after_by_site". Claiming a page clears its `retry_after`,
+        which moves it back to the first index.
+        """
         # ignores the "claimed" field of the page, because only one
         # brozzler-worker can be working on a site at a time, and that would
         # have to be the worker calling this method, so if something is claimed
         # already, it must have been left that way because of some error
-        result = (
+        pages = r.db(self.rr.dbname).table("pages")
+        ready = pages.between(
+            [site.id, 0, False, r.minval, r.minval],
+            [site.id, 0, False, r.maxval, r.maxval],
+            index="priority_by_site_ready",
+        ).order_by(index=r.desc("priority_by_site_ready"))
+        # pages due for a retry are read in order of when they became due,
+        # and only as many as could be claimed, since after a host outage
+        # there can be a great many of them
+        due = pages.between(
+            [site.id, 0, r.minval], [site.id, 0, r.now()], index="retry_after_by_site"
+        ).order_by(index="retry_after_by_site")
+        if exclude_page_ids:
+            exclude = r.expr(list(exclude_page_ids))
+            ready = ready.filter(lambda page: exclude.contains(page["id"]).not_())
+            due = due.filter(lambda page: exclude.contains(page["id"]).not_())
+        fields = ("id", "url", "claimed", "priority")
+        return (
+            ready.limit(n)
+            .pluck(*fields)
+            .union(due.limit(n).pluck(*fields))
+            .order_by(r.desc("claimed"), r.desc("priority"))
+            .limit(n)
+        )
+
+    def _claim_pages(self, site, worker_id, n=1, exclude_page_ids=None):
+        """
+        Claims up to `n` of the site's pages, highest priority first, in one
+        query. Returns a possibly empty list of `brozzler.Page`.
+        """
+        return self._claim_page_ids(
+            self._candidate_pages(site, n, exclude_page_ids)["id"], worker_id, n
+        )
+
+    def _claim_page_ids(self, page_ids, worker_id, n=1):
+        """
+        Claims the pages with ids `page_ids`, a list or a reql sequence of up
+        to `n` ids. Returns a possibly empty list of `brozzler.Page`, highest
+        priority first.
+        """
+        pages = r.db(self.rr.dbname).table("pages")
+        query = self.rr.expr(r.expr(page_ids).coerce_to("array")).do(
+            lambda ids: r.branch(
+                ids.is_empty(),
+                # what the update would return
+                {
+                    "deleted": 0,
+                    "errors": 0,
+                    "inserted": 0,
+                    "replaced": 0,
+                    "skipped": 0,
+                    "unchanged": 0,
+                    "changes": [],
+                },
+                pages.get_all(r.args(ids)).update(
+                    {
+                        "claimed": True,
+                        "last_claimed_by": worker_id,
+                        "retry_after": None,
+                    },
+                    return_changes="always",
+                ),
+            )
+        )
+        result = self._tracking_site_stats(query, return_changes=True).run()
+        self._vet_result(
+            result, unchanged=list(range(n + 1)), replaced=list(range(n + 1))
+        )
+        claimed = [
+            brozzler.Page(self.rr, change["new_val"]) for change in result["changes"]
+        ]
+        # get_all() doesn't keep the order of the candidates
+        claimed.sort(key=lambda page: page.priority, reverse=True)
+        return claimed
+
+    def _nothing_to_claim(self, site):
+        """
+        Returns the exception to raise when none of the site's pages can be
+        claimed: `brozzler.PagesDeferred` if some are waiting to be retried,
+        otherwise `brozzler.NothingToClaim`.
+        """
+        results = (
             self.rr.table("pages")
             .between(
-                [site.id, 0, r.minval, r.minval],
-                [site.id, 0, r.maxval, r.maxval],
-                index="priority_by_site",
-            )
-            .order_by(index=r.desc("priority_by_site"))
-            .filter(
-                lambda page: r.or_(
-                    page.has_fields("retry_after").not_(), r.now() > page["retry_after"]
-                )
+                [site.id, 0, r.minval],
+                [site.id, 0, r.maxval],
+                index="retry_after_by_site",
             )
+            .order_by(index="retry_after_by_site")
             .limit(1)
-            .update(
-                {"claimed": True, "last_claimed_by": worker_id}, return_changes="always"
-            )
+            .pluck("retry_after")
             .run()
         )
-        self._vet_result(result, unchanged=[0, 1], replaced=[0, 1])
-        if result["unchanged"] == 0 and result["replaced"] == 0:
-            raise brozzler.NothingToClaim
+        for result in results:
+            return brozzler.PagesDeferred(result["retry_after"])
+        return brozzler.NothingToClaim()
+
+    def claim_page(self, site, worker_id, exclude_page_ids=None, host_budget=None):
+        """
+        Claims the site's highest priority claimable page.
+
+        Args:
+            site: brozzler.Site
+            worker_id: identifies the claimant, stored in `last_claimed_by`
+            exclude_page_ids: ids of pages not to claim, e.g. pages that have
+                been brozzled but whose completion hasn't been written yet
+                (default None)
+            host_budget: a `brozzler.politeness.HostTokenBuckets` or
+                `brozzler.politeness.RethinkDbHostTokenBuckets`; if supplied,
+                a page is only claimed if a token can be taken for its host,
+                and up to `HOST_BUDGET_CANDIDATES` of the highest priority
+                pages are considered (default None)
+
+        Raises:
+            brozzler.NothingToClaim if there's nothing to claim
+            brozzler.PagesDeferred if there's nothing to claim until pages
+                that failed are due to be retried
+            brozzler.HostOverBudget if there are pages to claim, but all the
+                candidates are over the host budget
+        """
+        if self.page_claim_batch_size > 1:
+            return self._claim_page_from_queue(
+                site, worker_id, exclude_page_ids, host_budget
+            )
+        if host_budget is None:
+            pages = self._claim_pages(
+                site, worker_id, exclude_page_ids=exclude_page_ids
+            )
         else:
-            return brozzler.Page(self.rr, result["changes"][0]["new_val"])
+            # choose among the candidates before claiming any of them, so that
+            # nothing has to be unclaimed when their hosts are over budget
+            candidates = self.rr.expr(
+                self._candidate_pages(
+                    site, self.HOST_BUDGET_CANDIDATES, exclude_page_ids
+                )
+            ).run()
+            if not candidates:
+                raise self._nothing_to_claim(site)
+            waits = {}
+            candidate = self._within_budget(candidates, host_budget, waits)
+            if candidate is None:
+                raise brozzler.HostOverBudget(min(waits.values()))
+            pages = self._claim_page_ids([candidate["id"]], worker_id)
+        if not pages:
+            raise self._nothing_to_claim(site)
+        return pages[0]
 
-    def has_outstanding_pages(self, site):
+    def _within_budget(self, pages, host_budget, waits):
+        """
+        Returns the first of `pages`, page documents or `brozzler.Page`, for
+        whose host a token could be taken from `host_budget`, or None. Hosts
+        found to be over budget are added to `waits`, {host: seconds}, and
+        not asked about again.
+        """
+        for page in pages:
+            host = url_host(page["url"])
+            if host in waits:
+                continue
+            wait = host_budget.take(page["url"])
+            if not wait:
+                return page
+            waits[host] = wait
+        return None
+
+    def _page_queue(self, site_id):
+        with self._page_queues_lock:
+            return self._page_queues.get(site_id)
+
+    def _claim_page_from_queue(
+        self, site, worker_id, exclude_page_ids=None, host_budget=None
+    ):
+        with self._page_queues_lock:
+            page_queue = self._page_queues.get(site.id)
+            if page_queue is None:
+                page_queue = _SitePageQueue(worker_id)
+                self._page_queues[site.id] = page_queue
+        with page_queue.lock:
+            # refill when running low, or always when empty, because pages
+            # whose retry_after has passed don't reset `exhausted`
+            if len(page_queue) == 0 or (
+                len(page_queue) <= self.page_claim_batch_size // 4
+                and not page_queue.exhausted
+            ):
+                n = self.page_claim_batch_size - len(page_queue)
+                pages = self._claim_pages(
+                    site,
+                    worker_id,
+                    n,
+                    exclude_page_ids=page_queue.page_ids()
+                    + list(exclude_page_ids or []),
+                )
+                self.logger.debug(
+                    "refilled page queue", site_id=site.id, requested=n, got=len(pages)
+                )
+                page_queue.exhausted = len(pages) < n
+                for page in pages:
+                    page_queue.push(page)
+            if host_budget is None:
+                page = page_queue.pop()
+            else:
+                page, waits = self._pop_within_budget(page_queue, host_budget)
+        if page is None and host_budget is not None and waits:
+            raise brozzler.HostOverBudget(min(waits.values()))
+        if page is None:
+            raise self._nothing_to_claim(site)
+        return page
+
+    def _pop_within_budget(self, page_queue, host_budget):
+        """
+        Pops the highest priority page of `page_queue`, among the first
+        `HOST_BUDGET_CANDIDATES`, for whose host a token could be taken from
+        `host_budget`. Candidates passed over are pushed back.
+
+        Returns:
+            tuple (page or None, {host: seconds} of hosts over budget)
+        """
+        skipped = []
+        waits = {}
+        page = None
+        while len(skipped) < self.HOST_BUDGET_CANDIDATES:
+            candidate = page_queue.pop()
+            if candidate is None:
+                break
+            if self._within_budget([candidate], host_budget, waits):
+                page = candidate
+                break
+            skipped.append(candidate)
+        for candidate in skipped:
+            page_queue.push(candidate)
+        return page, waits
+
+    def _offer_to_page_queue(self, site, fresh_pages):
+        """
+        Offers pages freshly scheduled from outlinks, which are about to be
+        saved, to the site's page queue, if the site has one. Queued copies of
+        pages are updated with the merged priority and hashtags. Pages not
+        yet queued are added if they would be claimed ahead of what is
+        already queued, and are marked claimed so that they are saved that
+        way.
+        """
+        page_queue = self._page_queue(site.id)
+        if page_queue is None:
+            return
+        with page_queue.lock:
+            unqueued_ids = [
+                page.id for page in fresh_pages if page.id not in page_queue
+            ]
+            existing = {}
+            if unqueued_ids:
+                # only unbrozzled pages are candidates for the queue, so don't
+                # fetch the documents of brozzled ones, which can be big
+                results = (
+                    self.rr.table("pages")
+                    .get_all(*unqueued_ids)
+                    .map(
+                        lambda page: r.branch(
+                            page["brozzle_count"].eq(0),
+                            page,
+                            page.pluck("id", "brozzle_count"),
+                        )
+                    )
+                    .run()
+                )
+                existing = {doc["id"]: doc for doc in results}
+
+            now = doublethink.utcnow()
+            floor = page_queue.floor()
+            capacity = 2 * self.page_claim_batch_size
+            for fresh_page in fresh_pages:
+                queued_page = page_queue.get(fresh_page.id)
+                if queued_page is not None:
+                    self._merge_page(queued_page, fresh_page)
+                    page_queue.push(queued_page)
+                    continue
+                if fresh_page.id in existing:
+                    if existing[fresh_page.id]["brozzle_count"] != 0:
+                        continue
+                    page = brozzler.Page(self.rr, existing[fresh_page.id])
+                    self._merge_page(page, fresh_page)
+                else:
+                    page = brozzler.Page(self.rr, dict(fresh_page))
+                if page.claimed or (page.retry_after and page.retry_after > now):
+                    continue
+                if len(page_queue) < capacity and (
+                    page_queue.exhausted
+                    or (floor is not None and page.priority > floor)
+                ):
+                    # claimed status is saved by way of `_merge_on_conflict()`
+                    for p in (page, fresh_page):
+                        p.claimed = True
+                        p.last_claimed_by = page_queue.worker_id
+                    page_queue.push(page)
+                else:
+                    page_queue.exhausted = False
+
+    def _release_page_queue(self, site):
+        """
+        Drops the site's page queue, if it has one, and marks the pages that
+        were still waiting in it unclaimed.
+        """
+        with self._page_queues_lock:
+            page_queue = self._page_queues.pop(site.id, None)
+        if page_queue is None:
+            return
+        with page_queue.lock:
+            page_ids = page_queue.drain()
+        if page_ids:
+            self.logger.debug(
+                "unclaiming queued pages", site_id=site.id, count=len(page_ids)
+            )
+            self._tracking_site_stats(
+                self.rr.table("pages")
+                .get_all(*page_ids)
+                .update({"claimed": False}, return_changes=True)
+            ).run()
+
+    def _page_stats(self, page, sign):
+        """
+        Returns what `page`, a reql page document or null, adds to the
+        counters of its site, as a reql object, negated if `sign` is -1.
+        """
+        unbrozzled = page["brozzle_count"].default(0).eq(0)
+        claimed = page["claimed"].default(False).eq(True)
+        return r.branch(
+            page.eq(None),
+            {"site_id": None, "queued": 0, "claimed": 0, "brozzled": 0},
+            {
+                "site_id": page["site_id"],
+                "queued": r.branch(unbrozzled.and_(claimed.not_()), sign, 0),
+                "claimed": r.branch(unbrozzled.and_(claimed), sign, 0),
+                "brozzled": r.branch(unbrozzled, 0, sign),
+            },
+        )
+
+    def _tracking_site_stats(self, query, return_changes=False):
+        """
+        Wraps `query`, a write to the pages table made with `return_changes`,
+        so that the same query also applies the changes to the counters of
+        the affected sites in the site_stats table. Sites without site_stats,
+        such as those created by older versions of brozzler, are skipped.
+
+        Returns:
+            the wrapped query, whose result leaves out the changes unless
+            `return_changes` is True
+        """
+        fields = self.SITE_STATS_FIELDS
+        site_stats = r.db(self.rr.dbname).table("site_stats")
+
+        def track(result):
+            deltas = (
+                result["changes"]
+                .default([])
+                .concat_map(
+                    lambda change: [
+                        self._page_stats(change["new_val"], 1),
+                        self._page_stats(change["old_val"], -1),
+                    ]
+                )
+                .filter(lambda delta: delta["site_id"].ne(None))
+                .group("site_id")
+                .reduce(lambda a, b: {f: a[f].add(b[f]) for f in fields})
+                .ungroup()
+            )
+            return deltas.for_each(
+                lambda delta: site_stats.get(delta["group"]).update(
+                    lambda stats: {
+                        f: stats[f].default(0).add(delta["reduction"][f])
+                        for f in fields
+                    }
+                )
+            ).do(lambda _: result if return_changes else result.without("changes"))
+
+        return query.do(track)
+
+    def init_site_stats(self, site_ids):
+        """
+        Starts counting the pages of new sites, before their seed pages are
+        inserted. Sites that already have site_stats keep them.
+        """
+        self.rr.table("site_stats").insert(
+            [
+                {"id": site_id, **{f: 0 for f in self.SITE_STATS_FIELDS}}
+                for site_id in site_ids
+            ],
+            conflict=lambda site_id, old, new: old,
+        ).run()
+
+    def site_stats(self, site_id):
+        """
+        Returns the page counters of the site as a dict with the keys in
+        `SITE_STATS_FIELDS`, counting them first if the site has none yet.
+        """
+        stats = self.rr.table("site_stats").get(site_id).run()
+        if stats is None:
+            stats = self._recount_site_stats(site_id)
+        return stats
+
+    def _recount_site_stats(self, site_id):
+        """
+        Counts the pages of the site using the priority_by_site index and
+        saves the counts in the site_stats table.
+        """
+        pages = r.db(self.rr.dbname).table("pages")
+        stats = self.rr.expr(
+            {
+                "id": site_id,
+                "queued": pages.between(
+                    [site_id, 0, False, r.minval],
+                    [site_id, 0, False, r.maxval],
+                    index="priority_by_site",
+                ).count(),
+                "claimed": pages.between(
+                    [site_id, 0, True, r.minval],
+                    [site_id, 0, True, r.maxval],
+                    index="priority_by_site",
+                ).count(),
+                "brozzled": pages.between(
+                    [site_id, 1, r.minval, r.minval],
+                    [site_id, r.maxval, r.maxval, r.maxval],
+                    index="priority_by_site",
+                ).count(),
+            }
+        ).run()
+        self.logger.info("counted pages of site", site_id=site_id, stats=stats)
+        self.rr.table("site_stats").insert(stats, conflict="replace").run()
+        return stats
+
+    def has_outstanding_pages(self, site, nothing_to_claim=False):
+        """
+        Returns whether the site has pages that haven't been brozzled yet,
+        going by its site_stats counters, unless they say there are none, or
+        `nothing_to_claim` is True because `claim_page()` has just raised
+        `brozzler.NothingToClaim`, in which case the pages are checked.
+        """
+        stats = self.site_stats(site.id)
+        counted = stats["queued"] + stats["claimed"] > 0
+        if counted and not nothing_to_claim:
+            return True
+        # the counters miss pages written some other way than through the
+        # frontier, and can drift upward, e.g. when _recount_site_stats()
+        # races with tracked writes, and this decides whether the site is
+        # finished, so check
         results_iter = (
             self.rr.table("pages")
             .between(
@@ -283,38 +1089,105 @@ class RethinkDbFrontier:
             .limit(1)
             .run()
         )
-        return len(list(results_iter)) > 0
+        outstanding = bool(list(results_iter))
+        if outstanding != counted:
+            self.logger.warning("site_stats out of date", site_id=site.id, stats=stats)
+            self._recount_site_stats(site.id)
+        return outstanding
+
+    def save_page(self, page):
+        """
+        Saves `page`, like `page.save()`, but also updates the counters of
+        its site.
+        """
+        result = self._tracking_site_stats(
+            self.rr.table("pages").insert(page, conflict="replace", return_changes=True)
+        ).run()
+        self._vet_result(result, inserted=[0, 1], replaced=[0, 1], unchanged=[0, 1])
+
+    def insert_pages(self, pages):
+        """
+        Inserts new pages, such as seed pages, counting them in the
+        site_stats of their sites.
+        """
+        return self._tracking_site_stats(
+            self.rr.table("pages").insert(pages, return_changes=True)
+        ).run()
 
     def completed_page(self, site, page):
+        self._note_completed_page(site, page)
+        self.save_page(page)
+
+    def _note_completed_page(self, site, page):
+        """
+        Updates `page` in memory to record that it has been brozzled, and
+        saves the site if the page was a seed that redirected.
+        """
         page.brozzle_count += 1
         page.claimed = False
         # XXX set priority?
-        page.save()
         if page.redirect_url and page.hops_from_seed == 0:
             site.note_seed_redirect(page.redirect_url)
             site.save()
 
     def active_jobs(self):
-        results = self.rr.table("jobs").filter({"status": "ACTIVE"}).run()
+        results = (
+            self.rr.table("jobs")
+            .filter(
+                lambda job: r.expr(list(brozzler.Job.ACTIVE_STATUSES)).contains(
+                    job["status"]
+                )
+            )
+            .run()
+        )
         for result in results:
             yield brozzler.Job(self.rr, result)
 
-    def honor_stop_request(self, site):
-        """Raises brozzler.CrawlStopped if stop has been requested."""
-        site.refresh()
+    def refresh_site_control_fields(self, site):
+        """
+        Updates `site` in place with the current values of
+        `SITE_CONTROL_FIELDS`, and reads the stop request of its job, in a
+        single query that doesn't fetch the whole site and job documents.
+
+        Returns:
+            the `stop_requested` of the site's job, or None
+        """
+        query = (
+            self.rr.table("sites")
+            .get(site.id)
+            .default({})
+            .pluck(*self.SITE_CONTROL_FIELDS)
+        )
+        if site.job_id:
+            query = query.merge(
+                {
+                    "job": r.db(self.rr.dbname)
+                    .table("jobs")
+                    .get(site.job_id)
+                    .default({})
+                    .pluck("stop_requested")
+                }
+            )
+        result = query.run()
+        for field in self.SITE_CONTROL_FIELDS:
+            if field in result:
+                site[field] = result[field]
+        return result.get("job", {}).get("stop_requested")
+
+    def honor_stop_request(self, site, status_feed=None):
+        """
+        Raises brozzler.CrawlStopped if stop has been requested. Reads the
+        stop requests from `status_feed` (a `SiteStatusFeed`), if supplied
+        and it is following the site.
+        """
+        job_stop_requested = (status_feed or self).refresh_site_control_fields(site)
         if site.stop_requested and site.stop_requested <= doublethink.utcnow():
             self.logger.info("stop requested for site", site_id=site.id)
             raise brozzler.CrawlStopped
 
-        if site.job_id:
-            job = brozzler.Job.load(self.rr, site.job_id)
-            if (
-                job
-                and job.stop_requested
-                and job.stop_requested <= doublethink.utcnow()
-            ):
-                self.logger.info("stop requested for job", job_id=site.job_id)
-                raise brozzler.CrawlStopped
+        if job_stop_requested and job_stop_requested <= doublethink.utcnow():
+            self.logger.info("stop requested for job", job_id=site.job_id)
+            raise brozzler.CrawlStopped
 
     def _maybe_finish_job(self, job_id):
         """Returns True if job is finished."""
@@ -324,21 +1197,44 @@ class RethinkDbFrontier:
         if job.status.startswith("FINISH"):
             self.logger.warning("%s is already %s", job, job.status)
             return True
+        if job.get("seeding"):
+            return False
 
-        results = self.rr.table("sites").get_all(job_id, index="job_id").run()
-        n = 0
-        for result in results:
-            site = brozzler.Site(self.rr, result)
-            if not site.status.startswith("FINISH"):
-                results.close()
-                return False
-            n += 1
+        unfinished = (
+            self.rr.table("sites")
+            .get_all(job_id, index="sites_unfinished_by_job")
+            .is_empty()
+            .not_()
+            .run()
+        )
+        if unfinished:
+            return False
 
-        self.logger.info("all %s sites finished, job is FINISHED!", n, job_id=job.id)
+        self.logger.info("all sites finished, job is FINISHED!", job_id=job.id)
         job.finish()
         job.save()
         return True
 
+    def seeded(self, job):
+        """
+        Records that all of the seeds of the new `job` have been queued, and
+        finishes the job if all of its sites are finished already.
+        """
+        self.rr.table("jobs").get(job.id).update({"seeding": False}).run()
+        job.seeding = False
+        self._maybe_finish_job(job.id)
+
+    def seeding_failed(self, job, error):
+        """
+        Records that queuing the seeds of the new `job` stopped partway
+        because of `error`. The seeds queued already are crawled, and then
+        the job gets status "FINISHED_SEEDING_FAILED" instead of "FINISHED".
+        """
+        fields = {"seeding": False, "status": "SEEDING_FAILED", "seeding_error": error}
+        self.rr.table("jobs").get(job.id).update(fields).run()
+        job.update(fields)
+        self._maybe_finish_job(job.id)
+
     def finished(self, site, status):
         self.logger.info("%s %s", status, site)
         site.status = status
@@ -349,17 +1245,29 @@ class RethinkDbFrontier:
         if site.job_id:
             self._maybe_finish_job(site.job_id)
 
-    def disclaim_site(self, site, page=None):
+    def disclaim_site(
+        self, site, page=None, reclaim_after=None, nothing_to_claim=False
+    ):
+        """
+        Disclaims the site, and `page` if supplied. If `reclaim_after` is
+        supplied, e.g. because all of the site's remaining pages are waiting
+        to be retried until then, the site is recorded as disclaimed at that
+        time, so that it isn't claimed again before it. If `nothing_to_claim`
+        is True, see `has_outstanding_pages()`.
+        """
         self.logger.info("disclaiming", site=site)
+        self._release_page_queue(site)
         site.claimed = False
         site.last_disclaimed = doublethink.utcnow()
-        if not page and not self.has_outstanding_pages(site):
+        if reclaim_after and reclaim_after > site.last_disclaimed:
+            site.last_disclaimed = reclaim_after
+        if not page and not self.has_outstanding_pages(site, nothing_to_claim):
             self.finished(site, "FINISHED")
         else:
             site.save()
         if page:
             page.claimed = False
-            page.save()
+            self.save_page(page)
 
     def resume_job(self, job):
         job.status = "ACTIVE"
@@ -454,75 +1362,153 @@ class RethinkDbFrontier:
                 out_of_scope.add(str(url_for_crawling))
         return pages, blocked, out_of_scope
 
-    def scope_and_schedule_outlinks(self, site, parent_page, outlinks):
-        decisions = {"accepted": set(), "blocked": set(), "rejected": set()}
-        counts = {"added": 0, "updated": 0, "rejected": 0, "blocked": 0}
+    def _scope_outlinks(self, site, parent_page, outlinks):
+        """
+        Scopes `outlinks` and records the decisions in `parent_page.outlinks`.
 
+        Returns:
+            tuple (fresh_pages, counts) to pass to `_save_pages()`
+        """
         fresh_pages, blocked, out_of_scope = self._scope_and_enforce_robots(
             site, parent_page, outlinks
         )
-        decisions["blocked"] = blocked
-        decisions["rejected"] = out_of_scope
-        counts["blocked"] += len(blocked)
-        counts["rejected"] += len(out_of_scope)
-
-        # get existing pages from rethinkdb
-        results = self.rr.table("pages").get_all(*fresh_pages.keys()).run()
-        pages = {doc["id"]: brozzler.Page(self.rr, doc) for doc in results}
-
-        # build list of pages to save, consisting of new pages, and existing
-        # pages updated with higher priority and new hashtags
-        for fresh_page in fresh_pages.values():
-            decisions["accepted"].add(fresh_page.url)
-            if fresh_page.id in pages:
-                page = pages[fresh_page.id]
-                self._merge_page(page, fresh_page)
-                counts["updated"] += 1
-            else:
-                pages[fresh_page.id] = fresh_page
-                counts["added"] += 1
+        counts = {"rejected": len(out_of_scope), "blocked": len(blocked)}
+
+        parent_page.outlinks = {
+            "accepted": list({page.url for page in fresh_pages.values()}),
+            "blocked": list(blocked),
+            "rejected": list(out_of_scope),
+        }
+        return fresh_pages, counts
+
+    def _merge_on_conflict(self, parent_page_ids):
+        """
+        Returns a conflict function for inserting pages into rethinkdb, which
+        replaces brozzled pages (`parent_page_ids`) and merges fresh pages
+        into existing ones the same way `_merge_page()` does.
+        """
+        parent_page_ids = r.expr(list(parent_page_ids))
+
+        def merge(page_id, old, new):
+            merged = {
+                "priority": old["priority"].default(0).add(new["priority"]),
+                "hashtags": old["hashtags"]
+                .default([])
+                .set_union(new["hashtags"].default([])),
+                "hops_off": r.expr(
+                    [
+                        old["hops_off"].default(
+                            old["hops_off_surt"].default(new["hops_off"])
+                        ),
+                        new["hops_off"],
+                    ]
+                ).min(),
+            }
+            return r.branch(
+                parent_page_ids.contains(page_id),
+                new,
+                new["claimed"].default(False),
+                old.merge(merged).merge(
+                    {"claimed": True, "last_claimed_by": new["last_claimed_by"]}
+                ),
+                old.merge(merged),
+            )
+
+        return merge
+
+    def _save_pages(self, completions):
+        """
+        Saves brozzled pages together with the fresh pages scheduled from
+        their outlinks, in as few queries as possible. Fresh pages are merged
+        into existing pages server side, see `_merge_on_conflict()`, and into
+        each other if scheduled more than once.
 
-        # make sure we're not stepping on our own toes in case we have a link
-        # back to parent_page, which I think happens because of hashtags
-        if parent_page.id in pages:
-            self._merge_page(parent_page, pages[parent_page.id])
-            del pages[parent_page.id]
+        Args:
+            completions: list of tuples (site, parent_page, fresh_pages,
+                counts) in the order the parent pages were brozzled, where
+                fresh_pages and counts come from `_scope_outlinks()`, or are
+                None if the page has no outlinks to schedule
+        """
+        pages = {}
+        parent_page_ids = set()
+        for site, parent_page, fresh_pages, _ in completions:
+            if parent_page.id in pages:
+                # parent page was scheduled by an earlier completion, or links
+                # to itself, which I think happens because of hashtags
+                self._merge_page(parent_page, pages[parent_page.id])
+            pages[parent_page.id] = parent_page
+            parent_page_ids.add(parent_page.id)
+            scheduled = []
+            for fresh_page in (fresh_pages or {}).values():
+                if fresh_page.id in pages:
+                    self._merge_page(pages[fresh_page.id], fresh_page)
+                else:
+                    pages[fresh_page.id] = fresh_page
+                if fresh_page.id not in parent_page_ids:
+                    scheduled.append(pages[fresh_page.id])
+            self._offer_to_page_queue(site, scheduled)
 
-        # insert/replace in batches of 50 to try to avoid this error:
+        # insert in batches of 50 to try to avoid this error:
         # "rethinkdb.errors.ReqlDriverError: Query size (167883036) greater than maximum (134217727) in:"
         # there can be many pages and each one can be very large (many videos,
         # in and out of scope links, etc)
-        pages_list = list(pages.values())
-        for batch in (pages_list[i : i + 50] for i in range(0, len(pages_list), 50)):
-            try:
-                self.logger.debug("inserting/replacing batch of %s pages", len(batch))
-                reql = self.rr.table("pages").insert(batch, conflict="replace")
-                self.logger.debug(
-                    'running query self.rr.table("pages").insert(%r, '
-                    'conflict="replace")',
-                    batch,
-                )
-                reql.run()
-            except Exception:
-                self.logger.exception(
-                    "problem inserting/replacing batch of %s pages",
-                    len(batch),
-                )
+        # brozzled pages go last, so that a brozzled page is only written once
+        # its outlinks have been, and if a batch can't be written the pages
+        # left unwritten are simply brozzled again
+        totals = {"inserted": 0, "replaced": 0, "unchanged": 0}
+        pages_list = [p for p in pages.values() if p.id not in parent_page_ids]
+        pages_list.extend(p for p in pages.values() if p.id in parent_page_ids)
+        for i in range(0, len(pages_list), 50):
+            batch = pages_list[i : i + 50]
+            for attempt in range(1, self.PAGE_BATCH_ATTEMPTS + 1):
+                try:
+                    self.logger.debug("inserting/merging batch of %s pages", len(batch))
+                    result = self._tracking_site_stats(
+                        self.rr.table("pages").insert(
+                            batch,
+                            conflict=self._merge_on_conflict(parent_page_ids),
+                            return_changes=True,
+                        )
+                    ).run()
+                    break
+                except Exception as e:
+                    if attempt == self.PAGE_BATCH_ATTEMPTS:
+                        unsaved = {
+                            p.id for p in pages_list[i:] if p.id in parent_page_ids
+                        }
+                        raise PagesNotSaved(unsaved, e) from e
+                    self.logger.warning(
+                        "problem inserting/merging batch of %s pages, will retry",
+                        len(batch),
+                        attempt=attempt,
+                        exc_info=True,
+                    )
+                    time.sleep(attempt)
+            for k in totals:
+                totals[k] += result.get(k, 0)
 
-        parent_page.outlinks = {}
-        for k in decisions:
-            parent_page.outlinks[k] = list(decisions[k])
-        parent_page.save()
-
-        self.logger.info(
-            "%s new links added, %s existing links updated, %s links "
-            "rejected, %s links blocked by robots from %s",
-            counts["added"],
-            counts["updated"],
-            counts["rejected"],
-            counts["blocked"],
-            parent_page,
-        )
+        counts = [c for _, _, _, c in completions if c is not None]
+        if counts:
+            # brozzled pages already exist, so are among replaced/unchanged
+            self.logger.info(
+                "%s new links added, %s existing links updated, %s links "
+                "rejected, %s links blocked by robots from %s",
+                totals["inserted"],
+                max(0, totals["replaced"] + totals["unchanged"] - len(parent_page_ids)),
+                sum(c["rejected"] for c in counts),
+                sum(c["blocked"] for c in counts),
+                completions[0][1]
+                if len(completions) == 1
+                else "%s pages" % len(completions),
+            )
+
+    def scope_and_schedule_outlinks(self, site, parent_page, outlinks):
+        fresh_pages, counts = self._scope_outlinks(site, parent_page, outlinks)
+        try:
+            self._save_pages([(site, parent_page, fresh_pages, counts)])
+        except PagesNotSaved:
+            # the parent page was saved by completed_page() already
+            self.logger.exception("problem scheduling outlinks", page=parent_page)
 
     def reached_limit(self, site, e):
         self.logger.info("reached_limit", site=site, e=e)
@@ -583,3 +1569,505 @@ class RethinkDbFrontier:
         for result in results:
             self.logger.debug("yielding result", result=result)
             yield brozzler.Page(self.rr, result)
+
+
+class CompletionPipeline:
+    """
+    Write-behind pipeline for the frontier writes that follow brozzling a
+    page, i.e. what `RethinkDbFrontier.completed_page()` followed by
+    `RethinkDbFrontier.scope_and_schedule_outlinks()` would do.
+
+    `submit()` does the in-memory part (outlink scoping, seed redirect
+    handling) in the calling thread, then queues the database writes for a
+    background thread. The background thread combines whatever completions
+    have queued up, possibly from several sites, into a single read of
+    existing pages and a single batched insert. `submit()` blocks while
+    `max_depth` completions are queued.
+
+    Until its completion has been written, a brozzled page is still
+    claimable in rethinkdb, so callers must pass `pending_page_ids()` to
+    `RethinkDbFrontier.claim_page()`, and `flush()` before disclaiming the
+    site.
+
+    If brozzled pages can't be written, the next `submit()` or `flush()` for
+    their site raises `PagesNotSaved`, in the thread brozzling the site, and
+    until then their ids stay among `pending_page_ids()`.
+    """
+
+    logger = structlog.get_logger(logger_name=__module__ + "." + __qualname__)
+
+    # max number of queued completions combined into one write
+    MAX_BATCH = 20
+
+    def __init__(self, frontier, max_depth=20):
+        self.frontier = frontier
+        self.max_depth = max_depth
+        self._queue = queue.Queue(maxsize=max_depth)
+        self._pending = {}  # {site_id: set(page_id, ...), ...}
+        self._failures = {}  # {site_id: (error, set(page_id, ...)), ...}
+        self._pending_cond = threading.Condition()
+        self._thread = None
+        self._start_stop_lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._start_stop_lock:
+            if not self._thread:
+                self._thread = threading.Thread(
+                    target=self._run, name="CompletionPipeline", daemon=True
+                )
+                self._thread.start()
+
+    def submit(self, site, page, outlinks=None):
+        """
+        Marks `page` completed and schedules `outlinks` (if not None), saving
+        both in the background.
+
+        Raises:
+            PagesNotSaved: if pages of the site submitted earlier couldn't be
+                written
+        """
+        self._raise_failure(site.id)
+        self._ensure_started()
+        self.frontier._note_completed_page(site, page)
+        if outlinks is None:
+            fresh_pages, counts = None, None
+        else:
+            fresh_pages, counts = self.frontier._scope_outlinks(site, page, outlinks)
+        with self._pending_cond:
+            self._pending.setdefault(site.id, set()).add(page.id)
+        self._queue.put((site, page, fresh_pages, counts))
+        metrics.brozzler_completion_pipeline_depth.set(self._queue.qsize())
+
+    def pending_page_ids(self, site_id):
+        """Returns ids of the site's pages whose completion is not written yet."""
+        with self._pending_cond:
+            page_ids = set(self._pending.get(site_id, ()))
+            if site_id in self._failures:
+                page_ids.update(self._failures[site_id][1])
+            return list(page_ids)
+
+    def _raise_failure(self, site_id):
+        with self._pending_cond:
+            failure = self._failures.pop(site_id, None)
+        if failure:
+            error, page_ids = failure
+            raise PagesNotSaved(page_ids, error)
+
+    def flush(self, site_id=None, timeout=None):
+        """
+        Waits until all completions submitted for the site, or for all sites
+        if `site_id` is None, have been written.
+
+        Returns:
+            True if everything was written, False if timed out
+
+        Raises:
+            PagesNotSaved: if pages of the site couldn't be written
+        """
+
+        def done():
+            if site_id is None:
+                return not self._pending
+            return site_id not in self._pending
+
+        start = time.time()
+        with self._pending_cond:
+            while not done():
+                if timeout is not None and time.time() - start > timeout:
+                    return False
+                # wait in short increments so that thread_raise() still works
+                self._pending_cond.wait(0.5)
+        if site_id is not None:
+            self._raise_failure(site_id)
+        return True
+
+    def stop(self, timeout=60):
+        """Writes whatever is still queued, then stops the background thread."""
+        with self._start_stop_lock:
+            if self._thread:
+                self._queue.put(None)
+                self._thread.join(timeout)
+                self._thread = None
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
+            completions = [item]
+            while len(completions) < self.MAX_BATCH:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                completions.append(item)
+            metrics.brozzler_completion_pipeline_depth.set(self._queue.qsize())
+            failure = None
+            try:
+                self.frontier._save_pages(completions)
+            except Exception as e:
+                self.logger.exception(
+                    "problem saving completed pages", count=len(completions)
+                )
+                if isinstance(e, PagesNotSaved):
+                    failure = e
+                else:
+                    failure = PagesNotSaved({c[1].id for c in completions}, e)
+            finally:
+                with self._pending_cond:
+                    for site, page, _, _ in completions:
+                        if failure and page.id in failure.page_ids:
+                            _, page_ids = self._failures.setdefault(
+                                site.id, (failure.error, set())
+                            )
+                            page_ids.add(page.id)
+                        pending = self._pending.get(site.id)
+                        if pending is not None:
+                            pending.discard(page.id)
+                            if not pending:
+                                del self._pending[site.id]
+                    self._pending_cond.notify_all()
+
+
+class SiteLeaseCoordinator:
+    """
+    Offers claimable sites to brozzler workers as leases, so that workers
+    don't all scan for claimable sites and race to claim the same ones.
+
+    Every worker using leases runs one of these and calls `run_if_due()`
+    regularly. The one elected through the service registry refreshes the
+    "site_leases" table with claimable sites, taking turns between jobs,
+    and workers take leases with `RethinkDbFrontier.claim_leased_sites()`.
+    Leases that aren't taken within `lease_ttl` seconds are withdrawn, so
+    the queue doesn't go stale.
+    """
+
+    logger = structlog.get_logger(logger_name=__module__ + "." + __qualname__)
+
+    ROLE = "brozzler-site-lease-coordinator"
+
+    def __init__(
+        self,
+        frontier,
+        service_registry,
+        interval=5.0,
+        queue_size=100,
+        lease_ttl=60.0,
+        reclaim_cooldown=20,
+    ):
+        self.frontier = frontier
+        self.rr = frontier.rr
+        self.service_registry = service_registry
+        self.interval = interval
+        self.queue_size = queue_size
+        self.lease_ttl = lease_ttl
+        self.reclaim_cooldown = reclaim_cooldown
+        self._candidate = {
+            "role": self.ROLE,
+            "instance": uuid.uuid4().hex,
+            "ttl": interval * 3,
+        }
+        self._last_run = 0
+
+    def coordinator_is_healthy(self):
+        """Returns True if some process is currently offering leases."""
+        return self.service_registry.unique_service(self.ROLE) is not None
+
+    def run_if_due(self):
+        """
+        Stands for election, and refreshes the leases if elected, at most
+        once every `interval` seconds.
+        """
+        if time.time() - self._last_run < self.interval:
+            return
+        self._last_run = time.time()
+        service = self.service_registry.unique_service(
+            self.ROLE, candidate=dict(self._candidate)
+        )
+        if service and service.get("instance") == self._candidate["instance"]:
+            self.refresh_leases()
+
+    def refresh_leases(self):
+        """
+        Withdraws expired leases and tops the queue back up to `queue_size`
+        claimable sites.
+        """
+        self.rr.table("site_leases").filter(
+            r.row["offered"].lt(r.now().sub(self.lease_ttl))
+        ).delete().run()
+        leases = list(self.rr.table("site_leases").pluck("id", "job_id", "seq").run())
+        wanted = self.queue_size - len(leases)
+        if wanted <= 0:
+            return
+
+        candidates, job_counts = self.frontier.get_claimable_sites(
+            self.queue_size, self.reclaim_cooldown
+        )
+        # offered leases count against max_claimed_sites too
+        for lease in leases:
+            if lease.get("job_id") is not None:
+                job_counts[lease["job_id"]] = job_counts.get(lease["job_id"], 0) + 1
+        leased_ids = {lease["id"] for lease in leases}
+        candidates = [site for site in candidates if site["id"] not in leased_ids]
+        site_ids = filter_claimable_site_ids(
+            candidates,
+            self.reclaim_cooldown,
+            max_sites_to_claim=wanted,
+            job_counts=job_counts,
+        )
+        if not site_ids:
+            return
+
+        sites_by_id = {site["id"]: site for site in candidates}
+        next_seq = max([lease["seq"] for lease in leases], default=0) + 1
+        new_leases = []
+        for i, site_id in enumerate(self._take_turns(site_ids, sites_by_id)):
+            new_leases.append(
+                {
+                    "id": site_id,
+                    "job_id": sites_by_id[site_id].get("job_id"),
+                    "seq": next_seq + i,
+                    "offered": r.now(),
+                }
+            )
+        # conflict="update" in case a lease was taken and the site disclaimed
+        # again in the meantime
+        self.rr.table("site_leases").insert(new_leases, conflict="update").run()
+        self.logger.debug("offered site leases", count=len(new_leases))
+
+    def _take_turns(self, site_ids, sites_by_id):
+        """
+        Reorders `site_ids` so that jobs take turns, keeping the order within
+        each job.
+        """
+        by_job = {}
+        for site_id in site_ids:
+            job_id = sites_by_id[site_id].get("job_id")
+            by_job.setdefault(job_id, []).append(site_id)
+        return [
+            site_id
+            for round_ in itertools.zip_longest(*by_job.values())
+            for site_id in round_
+            if site_id is not None
+        ]
+
+
+# placeholder for a job stop request that hasn't been read yet
+_UNKNOWN = object()
+
+
+class SiteStatusFeed:
+    """
+    Follows changes to the control fields (see
+    `RethinkDbFrontier.SITE_CONTROL_FIELDS`) of the sites a worker is
+    brozzling, and to the stop requests of their jobs, through a rethinkdb
+    changefeed, so that they don't have to be polled for before every page,
+    and so that stop requests take effect right away.
+
+    The changefeed only carries changes to those fields, but for all sites
+    and jobs, so that it doesn't have to be restarted whenever the worker
+    starts or stops brozzling a site. Changes to sites that aren't being
+    watched are ignored.
+
+    While the changefeed is down, `refresh_site_control_fields()` falls back
+    to querying rethinkdb.
+    """
+
+    logger = structlog.get_logger(logger_name=__module__ + "." + __qualname__)
+
+    # seconds to wait before restarting the changefeed after an error
+    RETRY_INTERVAL = 5.0
+
+    def __init__(self, frontier):
+        self.frontier = frontier
+        self.rr = frontier.rr
+        self._lock = threading.Lock()
+        self._watched = {}  # {site_id: {"job_id", "fields", "on_stop"}}
+        self._job_stop_requested = {}  # {job_id: stop_requested}
+        self._current = False  # whether the changefeed is running
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if not self._thread:
+            self._thread = threading.Thread(
+                target=self._run, name="SiteStatusFeed", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        # the changefeed blocks, so the thread (a daemon) exits on the next
+        # change or with the process
+        self._stop.set()
+        self._thread = None
+
+    def watch(self, site, on_stop=None):
+        """
+        Starts following changes to `site` and to its job. `on_stop` is
+        called once, from the changefeed thread, with no arguments, if a stop
+        is requested for either.
+        """
+        with self._lock:
+            self._watched[site.id] = {
+                "job_id": site.job_id,
+                "fields": None,  # not known yet
+                "on_stop": on_stop,
+            }
+            if site.job_id:
+                self._job_stop_requested.setdefault(site.job_id, _UNKNOWN)
+        job_stop_requested = self.frontier.refresh_site_control_fields(site)
+        with self._lock:
+            # unless the changefeed has already seen newer values
+            watched = self._watched.get(site.id)
+            if watched and watched["fields"] is None:
+                watched["fields"] = {
+                    k: site.get(k) for k in self.frontier.SITE_CONTROL_FIELDS
+                }
+            if self._job_stop_requested.get(site.job_id) is _UNKNOWN:
+                self._job_stop_requested[site.job_id] = job_stop_requested
+
+    def unwatch(self, site):
+        with self._lock:
+            self._watched.pop(site.id, None)
+            job_ids = {w["job_id"] for w in self._watched.values()}
+            if site.job_id not in job_ids:
+                self._job_stop_requested.pop(site.job_id, None)
+
+    def refresh_site_control_fields(self, site):
+        """
+        Like `RethinkDbFrontier.refresh_site_control_fields()`, but from what
+        the changefeed has seen, if `site` is being watched.
+        """
+        with self._lock:
+            watched = self._watched.get(site.id)
+            job_stop_requested = self._job_stop_requested.get(site.job_id)
+            if (
+                self._current
+                and watched
+                and watched["fields"] is not None
+                and job_stop_requested is not _UNKNOWN
+            ):
+                site.update(watched["fields"])
+                return job_stop_requested
+        return self.frontier.refresh_site_control_fields(site)
+
+    def _changefeed(self):
+        def changed(*fields):
+            return lambda change: (
+                change["new_val"].ne(None)
+                & (
+                    change["old_val"].default({}).pluck(*fields)
+                    != change["new_val"].pluck(*fields)
+                )
+            )
+
+        fields = self.frontier.SITE_CONTROL_FIELDS
+        sites = (
+            self.rr.table("sites")
+            .changes()
+            .filter(changed(*fields))
+            .map(
+                lambda change: (
+                    change["new_val"]
+                    .pluck("id", "job_id", *fields)
+                    .merge({"table": "sites"})
+                )
+            )
+        )
+        jobs = (
+            r.db(self.rr.dbname)
+            .table("jobs")
+            .changes()
+            .filter(changed("stop_requested"))
+            .map(
+                lambda change: (
+                    change["new_val"]
+                    .pluck("id", "stop_requested")
+                    .merge({"table": "jobs"})
+                )
+            )
+        )
+        return sites.union(jobs)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                changes = self._changefeed().run()
+                # changes made before the changefeed started were missed
+                self._resync()
+                with self._lock:
+                    self._current = True
+                for change in changes:
+                    if self._stop.is_set():
+                        break
+                    self._apply(change)
+            except Exception:
+                self.logger.exception(
+                    "problem following site status changefeed, will retry",
+                    retry_interval=self.RETRY_INTERVAL,
+                )
+            finally:
+                with self._lock:
+                    self._current = False
+            self._stop.wait(self.RETRY_INTERVAL)
+
+    def _resync(self):
+        with self._lock:
+            site_ids = list(self._watched)
+        if not site_ids:
+            return
+        fields = self.frontier.SITE_CONTROL_FIELDS
+        sites = list(
+            self.rr.table("sites")
+            .get_all(*site_ids)
+            .pluck("id", "job_id", *fields)
+            .run()
+        )
+        job_ids = list({site["job_id"] for site in sites if site.get("job_id")})
+        jobs = []
+        if job_ids:
+            jobs = list(
+                self.rr.table("jobs")
+                .get_all(*job_ids)
+                .pluck("id", "stop_requested")
+                .run()
+            )
+        for doc in sites:
+            self._apply(dict(doc, table="sites"))
+        for doc in jobs:
+            self._apply(dict(doc, table="jobs"))
+
+    def _apply(self, change):
+        stopped = []
+        now = doublethink.utcnow()
+        with self._lock:
+            if change["table"] == "sites":
+                watched = self._watched.get(change["id"])
+                if not watched:
+                    return
+                watched["fields"] = {
+                    k: change.get(k) for k in self.frontier.SITE_CONTROL_FIELDS
+                }
+                stop_requested = change.get("stop_requested")
+                if stop_requested and stop_requested <= now:
+                    stopped.append(watched)
+            else:
+                if change["id"] not in self._job_stop_requested:
+                    return
+                stop_requested = change.get("stop_requested")
+                self._job_stop_requested[change["id"]] = stop_requested
+                if stop_requested and stop_requested <= now:
+                    stopped.extend(
+                        w for w in self._watched.values() if w["job_id"] == change["id"]
+                    )
+            on_stops = []
+            for watched in stopped:
+                if watched["on_stop"]:
+                    on_stops.append(watched["on_stop"])
+                    watched["on_stop"] = None
+        for on_stop in on_stops:
+            on_stop()
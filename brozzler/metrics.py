@@ -31,6 +31,19 @@ brozzler_last_page_crawled_time = Gauge("brozzler_last_page_crawled_time", "time
 brozzler_ydl_urls_checked = Counter("brozzler_ydl_urls_checked", "count of urls checked by brozzler yt-dlp")
 brozzler_ydl_extract_successes = Counter("brozzler_ydl_extract_successes", "count of extracts completed by brozzler yt-dlp", labelnames=["youtube_host"])
 brozzler_ydl_download_successes = Counter("brozzler_ydl_download_successes", "count of downloads completed by brozzler yt-dlp", labelnames=["youtube_host"])
+brozzler_browser_pool_hits = Counter("brozzler_browser_pool_hits", "number of times a warm browser was reused from the browser pool")
+brozzler_browser_pool_misses = Counter("brozzler_browser_pool_misses", "number of times the browser pool had to provide a fresh browser")
+brozzler_completion_pipeline_depth = Gauge("brozzler_completion_pipeline_depth", "number of completed pages waiting for their frontier writes")
+brozzler_robots_cache_hits = Counter("brozzler_robots_cache_hits", "number of robots.txt lookups answered from the robots cache")
+brozzler_robots_cache_misses = Counter("brozzler_robots_cache_misses", "number of robots.txt lookups that had to fetch robots.txt")
+brozzler_robots_fetch_duration_seconds = Histogram("brozzler_robots_fetch_duration_seconds", "time spent fetching and parsing robots.txt")
+brozzler_page_header_requests = Counter("brozzler_page_header_requests", "number of pages whose headers were fetched or skipped because they were expected to be html", labelnames=["outcome"])
+brozzler_page_retries_scheduled = Counter("brozzler_page_retries_scheduled", "number of pages deferred to be retried after failing, by kind of failure", labelnames=["kind"])
+brozzler_site_claim_duration_seconds = Histogram("brozzler_site_claim_duration_seconds", "time spent claiming sites to brozzle", labelnames=["method"])
+brozzler_screenshots_pending = Gauge("brozzler_screenshots_pending", "number of screenshots waiting to be, or being, thumbnailed and written to warcprox")
+brozzler_screenshot_processing_duration_seconds = Histogram("brozzler_screenshot_processing_duration_seconds", "time spent thumbnailing a screenshot and writing both to warcprox")
+brozzler_screenshot_backpressure_wait_seconds = Histogram("brozzler_screenshot_backpressure_wait_seconds", "time browsing threads spent waiting for room in the screenshot pool")
+brozzler_warcprox_write_record_duration_seconds = Histogram("brozzler_warcprox_write_record_duration_seconds", "time spent on one WARCPROX_WRITE_RECORD request")
 # fmt: on
 
 
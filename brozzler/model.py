@@ -18,10 +18,14 @@ limitations under the License.
 """
 
 import base64
+import concurrent.futures
 import copy
 import hashlib
+import itertools
 import json
 import os
+import re
+import threading
 import urllib
 import uuid
 import zlib
@@ -69,6 +73,20 @@ def validate_conf(job_conf, schema=load_schema()):
         raise InvalidJobConf(v)
 
 
+def validate_seed_conf(seed_conf, schema=load_schema()["seeds"]["schema"]["schema"]):
+    v = JobValidator(schema)
+    if not v.validate(seed_conf, normalize=False):
+        raise InvalidJobConf(v)
+
+
+def _schema_without_required_seeds(schema=load_schema()):
+    """
+    Returns the job conf schema, except that seeds are optional, for job confs
+    whose seeds come from elsewhere, see `new_job()`.
+    """
+    return dict(schema, seeds=dict(schema["seeds"], required=False))
+
+
 def merge(a, b):
     if isinstance(a, dict) and isinstance(b, dict):
         merged = dict(a)
@@ -83,20 +101,79 @@ def merge(a, b):
         return a
 
 
-def new_job_file(frontier, job_conf_file):
-    """Returns new Job."""
+# the most bytes of json to send to rethinkdb in one insert, well under the
+# query size limit of 128 MiB
+INSERT_BATCH_BYTES = 4 * 1024 * 1024
+
+
+def new_job_file(frontier, job_conf_file, seeds_file=None, threads=1):
+    """
+    Returns new Job.
+
+    Args:
+        frontier: brozzler.RethinkDbFrontier
+        job_conf_file: path of the yaml job configuration
+        seeds_file: path of a file of more seeds, read a seed at a time, see
+            `load_seeds_file()` (default None)
+        threads: number of threads inserting sites and pages (default 1)
+    """
     logger.info("loading", job_conf_file=job_conf_file)
     with open(job_conf_file) as f:
         job_conf = yaml.safe_load(f)
-        return new_job(frontier, job_conf)
+    seeds = load_seeds_file(seeds_file) if seeds_file else None
+    return new_job(frontier, job_conf, seeds=seeds, threads=threads)
 
 
-def new_job(frontier, job_conf):
-    """Returns new Job."""
-    validate_conf(job_conf)
+def load_seeds_file(seeds_file):
+    """
+    Yields the seeds in `seeds_file` one at a time, without reading the whole
+    file into memory. If the name of the file ends in ".jsonl" or ".ndjson"
+    each line is a json seed, otherwise the file is a stream of yaml
+    documents, each a seed or a list of seeds. A seed is a dict like an entry
+    of the "seeds" of a job conf, or just a url.
+    """
+    logger.info("loading seeds", seeds_file=seeds_file)
+    with open(seeds_file) as f:
+        if seeds_file.endswith((".jsonl", ".ndjson")):
+            docs = (json.loads(line) for line in f if line.strip())
+        else:
+            docs = yaml.safe_load_all(f)
+        for doc in docs:
+            for seed_conf in doc if isinstance(doc, list) else [doc]:
+                if isinstance(seed_conf, str):
+                    seed_conf = {"url": seed_conf}
+                yield seed_conf
+
+
+def new_job(frontier, job_conf, seeds=None, threads=1):
+    """
+    Returns new Job.
+
+    Args:
+        frontier: brozzler.RethinkDbFrontier
+        job_conf: job configuration dict
+        seeds: iterable of more seeds, which may come from a generator like
+            `load_seeds_file()`, to add after those in `job_conf`, if any.
+            Each is validated as it is consumed, so an invalid seed raises
+            `InvalidJobConf` after the seeds before it have been queued, and
+            the job gets status "SEEDING_FAILED", as it does if queuing the
+            seeds fails for any other reason. (default None)
+        threads: number of threads inserting sites and pages (default 1)
+    """
+    if seeds is None:
+        validate_conf(job_conf)
+    else:
+        validate_conf(job_conf, schema=_schema_without_required_seeds())
+    # the job isn't finished while seeds are still being queued, even if all
+    # of its sites so far are, see `RethinkDbFrontier._maybe_finish_job()`
     job = Job(
         frontier.rr,
-        {"conf": job_conf, "status": "ACTIVE", "started": doublethink.utcnow()},
+        {
+            "conf": job_conf,
+            "status": "ACTIVE",
+            "seeding": True,
+            "started": doublethink.utcnow(),
+        },
     )
     if "id" in job_conf:
         job.id = job_conf["id"]
@@ -106,29 +183,112 @@ def new_job(frontier, job_conf):
         job.pdfs_only = job_conf["pdfs_only"]
     job.save()
 
-    sites = []
-    pages = []
-    for seed_conf in job_conf["seeds"]:
+    seed_confs = job_conf.get("seeds", [])
+    if seeds is not None:
+        seed_confs = itertools.chain(seed_confs, _validated(seeds))
+    try:
+        count = _insert_seeds(frontier, job, job_conf, seed_confs, threads)
+    except BaseException as e:
+        # including rethinkdb errors and KeyboardInterrupt, so that the job
+        # isn't left seeding, and so never finished
+        error = str(e.errors) if isinstance(e, InvalidJobConf) else repr(e)
+        try:
+            frontier.seeding_failed(job, error)
+        except Exception:
+            logger.exception("problem marking job seeding failed", job_id=job.id)
+        raise
+    frontier.seeded(job)
+    logger.info("job fully started", job_id=job.id, seeds=count)
+
+    return job
+
+
+def _validated(seeds):
+    for i, seed_conf in enumerate(seeds):
+        try:
+            validate_seed_conf(seed_conf)
+        except InvalidJobConf as e:
+            e.errors["seed number"] = i + 1
+            raise
+        yield seed_conf
+
+
+def _seed_batches(frontier, job, job_conf, seed_confs):
+    """
+    Yields the sites and seed pages of the job in batches of (sites, pages)
+    whose json adds up to no more than `INSERT_BATCH_BYTES` for each table.
+    """
+    sites, pages, sites_bytes, pages_bytes = [], [], 0, 0
+    for seed_conf in seed_confs:
         merged_conf = merge(seed_conf, job_conf)
-        merged_conf.pop("seeds")
+        merged_conf.pop("seeds", None)
         merged_conf["job_id"] = job.id
         merged_conf["seed"] = merged_conf.pop("url")
         site = brozzler.Site(frontier.rr, merged_conf)
         site.id = str(uuid.uuid4())
+        page = new_seed_page(frontier, site)
+        site_bytes = len(json.dumps(site, default=str))
+        page_bytes = len(json.dumps(page, default=str))
+        if sites and (
+            sites_bytes + site_bytes > INSERT_BATCH_BYTES
+            or pages_bytes + page_bytes > INSERT_BATCH_BYTES
+        ):
+            yield sites, pages
+            sites, pages, sites_bytes, pages_bytes = [], [], 0, 0
         sites.append(site)
-        pages.append(new_seed_page(frontier, site))
-
-    # insert in batches to avoid this error
-    # rethinkdb.errors.ReqlDriverError: Query size (167883036) greater than maximum (134217727) in:
-    for batch in (pages[i : i + 500] for i in range(0, len(pages), 500)):
-        logger.info("inserting batch of %s pages", len(batch))
-        frontier.rr.table("pages").insert(batch).run()
-    for batch in (sites[i : i + 100] for i in range(0, len(sites), 100)):
-        logger.info("inserting batch of %s sites", len(batch))
-        frontier.rr.table("sites").insert(batch).run()
-    logger.info("job fully started", job_id=job.id)
+        pages.append(page)
+        sites_bytes += site_bytes
+        pages_bytes += page_bytes
+    if sites:
+        yield sites, pages
 
-    return job
+
+def _insert_seed_batch(frontier, sites, pages):
+    # insert the pages before the sites, see `new_site()`
+    frontier.init_site_stats([site.id for site in sites])
+    logger.info("inserting batch of %s pages", len(pages))
+    frontier.insert_pages(pages)
+    logger.info("inserting batch of %s sites", len(sites))
+    frontier.rr.table("sites").insert(sites).run()
+
+
+def _insert_seeds(frontier, job, job_conf, seed_confs, threads):
+    """
+    Inserts the sites and seed pages of the job using `threads` threads, each
+    running its own queries. Batches are built while earlier ones are being
+    inserted, and at most two per thread are held in memory at once.
+
+    Returns:
+        the number of seeds
+    """
+    in_flight = threading.BoundedSemaphore(2 * threads)
+    futures = []
+    count = 0
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="InsertSeeds"
+        ) as pool:
+            for sites, pages in _seed_batches(frontier, job, job_conf, seed_confs):
+                in_flight.acquire()
+                future = pool.submit(_insert_seed_batch, frontier, sites, pages)
+                future.add_done_callback(lambda _: in_flight.release())
+                # keep only failures and batches still being inserted
+                futures = [f for f in futures if not f.done() or f.exception()]
+                futures.append(future)
+                count += len(sites)
+                if any(f.done() and f.exception() for f in futures):
+                    break
+        for future in futures:
+            future.result()
+    except Exception:
+        logger.error(
+            "stopped queuing job because of error, seeds already queued will "
+            "be crawled",
+            job_id=job.id,
+            seeds=count,
+        )
+        raise
+    return count
 
 
 def new_seed_page(frontier, site):
@@ -161,8 +321,9 @@ def new_site(frontier, site):
     # where a brozzler worker immediately claims the site, finds no pages
     # to crawl, and decides the site is finished
     try:
+        frontier.init_site_stats([site.id])
         page = new_seed_page(frontier, site)
-        page.save()
+        frontier.save_page(page)
         logger.info("queued page", page=page)
     finally:
         # finally block because we want to insert the Site no matter what
@@ -199,6 +360,9 @@ class Job(doublethink.Document, ElapsedMixIn):
     logger = structlog.get_logger(logger_name=__module__ + "." + __qualname__)
     table = "jobs"
 
+    # a job whose seeding failed is still crawling the seeds that were queued
+    ACTIVE_STATUSES = ("ACTIVE", "SEEDING_FAILED")
+
     def populate_defaults(self):
         if "status" not in self:
             self.status = "ACTIVE"
@@ -222,7 +386,11 @@ class Job(doublethink.Document, ElapsedMixIn):
                 status=self.status,
                 stop=self.starts_and_stops[-1]["stop"],
             )
-        self.status = "FINISHED"
+        if self.status == "SEEDING_FAILED":
+            # keep a record that not all of the seeds were crawled
+            self.status = "FINISHED_SEEDING_FAILED"
+        else:
+            self.status = "FINISHED"
         self.starts_and_stops[-1]["stop"] = doublethink.utcnow()
 
 
@@ -246,6 +414,195 @@ class VideoCaptureOptions(Enum):
     DISABLE_YTDLP_CAPTURE = "DISABLE_YTDLP_CAPTURE"
 
 
+class _PrefixTrie:
+    """Byte-string prefix trie, answers "does any added prefix start `s`?"."""
+
+    def __init__(self):
+        self._root = {}
+
+    def __bool__(self):
+        return bool(self._root)
+
+    def add(self, prefix):
+        node = self._root
+        for b in prefix:
+            node = node.setdefault(b, {})
+        node[None] = True
+
+    def matches(self, s):
+        node = self._root
+        for b in s:
+            node = node.get(b)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+
+class _CompiledRules:
+    """
+    A list of scope rules (`urlcanon.MatchRule` arguments) compiled for
+    answering "does any of these rules apply to this url?" quickly.
+
+    Rules with a single `ssurt`, `surt`, `domain`, `regex` or `substring`
+    condition, which are by far the most common, are grouped into prefix
+    tries, hash sets and a combined regex. Anything else is kept as a
+    `urlcanon.MatchRule`.
+    """
+
+    def __init__(self, rules):
+        self.ssurt_prefixes = _PrefixTrie()
+        self.exact_ssurts = set()
+        self.surt_prefixes = _PrefixTrie()
+        self.exact_surts = set()
+        # reversed domains as in urlcanon.reverse_host(), e.g. b"com,example,"
+        self.domain_suffixes = set()
+        # exact domains and ip addresses, which only match themselves
+        self.exact_hosts = set()
+        self.substrings = []
+        self.regexes = []
+        self.combined_regex = None
+        self.match_rules = []
+        self.parent_url_rules = []
+
+        for rule in rules:
+            self._add(urlcanon.MatchRule(**rule))
+        self._combine_regexes()
+
+    def _add(self, rule):
+        conditions = [
+            c
+            for c in ("surt", "ssurt", "regex", "domain", "substring")
+            if getattr(rule, c)
+        ]
+        if rule.parent_url_regex:
+            self.parent_url_rules.append(rule)
+        elif len(conditions) != 1:
+            self.match_rules.append(rule)
+        elif conditions == ["ssurt"]:
+            if rule.exact:
+                self.exact_ssurts.add(rule.ssurt)
+            else:
+                self.ssurt_prefixes.add(rule.ssurt)
+        elif conditions == ["surt"]:
+            if rule.exact:
+                self.exact_surts.add(rule.surt)
+            else:
+                self.surt_prefixes.add(rule.surt)
+        elif conditions == ["domain"]:
+            if rule.exact or urlcanon.parse_ipv4or6(rule.domain) != (None, None):
+                self.exact_hosts.add(rule.domain)
+            else:
+                self.domain_suffixes.add(urlcanon.reverse_host(rule.domain))
+        elif conditions == ["substring"]:
+            self.substrings.append(rule.substring)
+        else:
+            self.regexes.append(rule.regex)
+
+    def _combine_regexes(self):
+        # each pattern already ends with \Z (see urlcanon.MatchRule), but
+        # backreferences would be renumbered by combining, so leave those be
+        combinable = [r for r in self.regexes if not _BACKREFERENCE.search(r.pattern)]
+        if len(combinable) < 2:
+            return
+        try:
+            self.combined_regex = re.compile(
+                b"|".join(b"(?:" + regex.pattern + b")" for regex in combinable)
+            )
+        except re.error:
+            # e.g. same group name in two patterns, or inline global flags
+            return
+        self.regexes = [r for r in self.regexes if r not in combinable]
+
+    def has_parent_url_rules(self):
+        return bool(self.parent_url_rules)
+
+    def _domain_applies(self, host):
+        if host in self.exact_hosts:
+            return True
+        if not self.domain_suffixes:
+            return False
+        if urlcanon.parse_ipv4or6(host) != (None, None):
+            return False
+        reversed_host = urlcanon.reverse_host(host)
+        for i, b in enumerate(reversed_host):
+            if b == 0x2C and reversed_host[: i + 1] in self.domain_suffixes:  # ","
+                return True
+        return False
+
+    def applies(self, url, parent_urls=()):
+        """
+        Returns True if any of the rules applies to `url` (a
+        `urlcanon.ParsedUrl`), checking rules with a `parent_url_regex`
+        against each of `parent_urls`.
+        """
+        if self.ssurt_prefixes or self.exact_ssurts:
+            ssurt = url.ssurt()
+            if ssurt in self.exact_ssurts or self.ssurt_prefixes.matches(ssurt):
+                return True
+        if self.surt_prefixes or self.exact_surts:
+            surt = url.surt()
+            if surt in self.exact_surts or self.surt_prefixes.matches(surt):
+                return True
+        if (self.exact_hosts or self.domain_suffixes) and self._domain_applies(
+            url.host
+        ):
+            return True
+        if self.substrings or self.regexes or self.combined_regex:
+            url_bytes = url.__bytes__()
+            if any(url_bytes.find(s) >= 0 for s in self.substrings):
+                return True
+            if self.combined_regex and self.combined_regex.match(url_bytes):
+                return True
+            if any(regex.match(url_bytes) for regex in self.regexes):
+                return True
+        if any(rule.applies(url) for rule in self.match_rules):
+            return True
+        for rule in self.parent_url_rules:
+            for parent_url in parent_urls:
+                if rule.applies(url, parent_url):
+                    return True
+        return False
+
+
+_BACKREFERENCE = re.compile(rb"\\[1-9]|\(\?P=")
+
+
+class _CompiledScope:
+    """Compiled `blocks` and `accepts` rules of a site's scope."""
+
+    def __init__(self, scope):
+        self.blocks = _CompiledRules(scope.get("blocks") or [])
+        self.accepts = _CompiledRules(scope.get("accepts") or [])
+
+    def has_parent_url_rules(self):
+        return self.blocks.has_parent_url_rules() or self.accepts.has_parent_url_rules()
+
+
+# fields of a DevTools `Network.Cookie` that are needed to set it again
+_COOKIE_PARAM_FIELDS = (
+    "name",
+    "value",
+    "domain",
+    "path",
+    "secure",
+    "httpOnly",
+    "sameSite",
+    "priority",
+)
+
+
+def _cookie_param(cookie):
+    """
+    Converts a DevTools `Network.Cookie` to a `Network.CookieParam`.
+    """
+    param = {k: cookie[k] for k in _COOKIE_PARAM_FIELDS if k in cookie}
+    if not cookie.get("session") and cookie.get("expires", -1) > 0:
+        param["expires"] = cookie["expires"]
+    return param
+
+
 class Site(doublethink.Document, ElapsedMixIn):
     logger = structlog.get_logger(logger_name=__module__ + "." + __qualname__)
     table = "sites"
@@ -307,6 +664,7 @@ class Site(doublethink.Document, ElapsedMixIn):
         if not any(ssurt.startswith(ss) for ss in simple_rule_ssurts):
             self.logger.info("adding ssurt to scope accept rules", ssurt=ssurt)
             self.scope["accepts"].append({"ssurt": ssurt})
+            self._compiled_scope = None
 
     def note_seed_redirect(self, url):
         canon_seed_redirect = brozzler.site_surt_canon(url)
@@ -347,6 +705,41 @@ class Site(doublethink.Document, ElapsedMixIn):
             )
         return hdrs
 
+    def browser_cookies(self):
+        """
+        Returns the cookies stored by `note_browser_cookies()`, as a list of
+        DevTools `Network.CookieParam` dicts for `Network.setCookies`.
+        """
+        if not self.cookies:
+            return []
+        return json.loads(zlib.decompress(self.cookies))
+
+    def note_browser_cookies(self, cookies):
+        """
+        Stores `cookies`, a list of DevTools `Network.Cookie` dicts as returned
+        by `Network.getAllCookies`, compressed in `self.cookies`, unless they
+        are the same as the cookies already stored. Drops the legacy
+        `cookie_db`, which they supersede.
+
+        Returns:
+            True if the stored cookies changed
+        """
+        params = sorted(
+            (_cookie_param(cookie) for cookie in cookies),
+            key=lambda c: (c["domain"], c["path"], c["name"]),
+        )
+        data = json.dumps(params, sort_keys=True, separators=(",", ":")).encode()
+        digest = hashlib.sha1(data).digest()
+        if digest == self._cookies_digest:
+            return False
+        self._cookies_digest = digest
+        compressed = zlib.compress(data)
+        if compressed == self.cookies:
+            return False
+        self.cookies = compressed
+        self.pop("cookie_db", None)
+        return True
+
     def accept_reject_or_neither(self, url, parent_page=None):
         """
         Returns `True` (accepted), `False` (rejected), or `None` (no decision).
@@ -361,12 +754,6 @@ class Site(doublethink.Document, ElapsedMixIn):
             # schemes?)
             return False
 
-        try_parent_urls = []
-        if parent_page:
-            try_parent_urls.append(urlcanon.semantic(parent_page.url))
-            if parent_page.redirect_url:
-                try_parent_urls.append(urlcanon.semantic(parent_page.redirect_url))
-
         # enforce max_hops
         if (
             parent_page
@@ -375,32 +762,43 @@ class Site(doublethink.Document, ElapsedMixIn):
         ):
             return False
 
+        compiled_scope = self.compiled_scope()
+        try_parent_urls = []
+        if parent_page and compiled_scope.has_parent_url_rules():
+            try_parent_urls.append(urlcanon.semantic(parent_page.url))
+            if parent_page.redirect_url:
+                try_parent_urls.append(urlcanon.semantic(parent_page.redirect_url))
+
         # enforce reject rules
-        if "blocks" in self.scope:
-            for block_rule in self.scope["blocks"]:
-                rule = urlcanon.MatchRule(**block_rule)
-                if try_parent_urls:
-                    for parent_url in try_parent_urls:
-                        if rule.applies(url, parent_url):
-                            return False
-                else:
-                    if rule.applies(url):
-                        return False
+        if compiled_scope.blocks.applies(url, try_parent_urls):
+            return False
 
         # honor accept rules
-        for accept_rule in self.scope["accepts"]:
-            rule = urlcanon.MatchRule(**accept_rule)
-            if try_parent_urls:
-                for parent_url in try_parent_urls:
-                    if rule.applies(url, parent_url):
-                        return True
-            else:
-                if rule.applies(url):
-                    return True
+        if compiled_scope.accepts.applies(url, try_parent_urls):
+            return True
 
         # no decision if we reach here
         return None
 
+    def compiled_scope(self):
+        """
+        Returns the scope rules compiled for fast matching, compiling them if
+        they have changed since the last call. Code that modifies rules in
+        place, rather than adding or removing them or replacing `scope`,
+        should set `self._compiled_scope = None`.
+        """
+        blocks = self.scope.get("blocks")
+        accepts = self.scope.get("accepts")
+        # compare by identity, keeping references so that ids are not reused
+        key = (self.scope, blocks, len(blocks or ()), accepts, len(accepts or ()))
+        if self._compiled_scope is None or not all(
+            a is b or a == b and isinstance(a, int)
+            for a, b in zip(key, self._compiled_scope_key)
+        ):
+            self._compiled_scope = _CompiledScope(self.scope)
+            self._compiled_scope_key = key
+        return self._compiled_scope
+
 
 class Page(doublethink.Document):
     logger = structlog.get_logger(logger_name=__module__ + "." + __qualname__)
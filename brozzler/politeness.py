@@ -0,0 +1,173 @@
+"""
+brozzler/politeness.py - per-host token buckets that limit how fast pages of
+the same host are brozzled, by one worker or across the cluster
+
+Copyright (C) 2026 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import collections
+import threading
+import time
+import urllib.parse
+
+import rethinkdb as rdb
+import structlog
+
+r = rdb.RethinkDB()
+
+
+def url_host(url):
+    try:
+        return urllib.parse.urlsplit(url).hostname
+    except ValueError:
+        return None
+
+
+class HostTokenBuckets:
+    """
+    A token bucket per host, shared by the browsing threads of a worker.
+    Each host gets `rate` pages per second, with bursts of up to `burst`
+    pages. Buckets of hosts not seen lately are forgotten once there are
+    more than `max_hosts`, which is harmless, since a forgotten bucket would
+    have been full anyway.
+    """
+
+    def __init__(self, rate, burst=1, max_hosts=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_hosts = max_hosts
+        self._lock = threading.Lock()
+        self._buckets = collections.OrderedDict()  # {host: (tokens, updated)}
+
+    def take(self, url):
+        """
+        Takes a token from the bucket of the host of `url` if there is one.
+
+        Returns:
+            0 if a token was taken, otherwise the number of seconds until
+            there will be one
+        """
+        host = url_host(url)
+        if not host:
+            return 0
+        now = time.time()
+        with self._lock:
+            tokens, updated = self._buckets.pop(host, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / self.rate
+            self._buckets[host] = (tokens, now)
+            while len(self._buckets) > self.max_hosts:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class RethinkDbHostTokenBuckets:
+    """
+    Like `HostTokenBuckets`, but the buckets are documents in the rethinkdb
+    table "host_buckets", shared by all workers. Taking a token is a single
+    atomic upsert of the bucket, timed by the rethinkdb server's clock so
+    that the clocks of the workers don't have to agree. Buckets that would
+    be full again are deleted every `PRUNE_INTERVAL` seconds. The table is
+    created by `brozzler.RethinkDbFrontier`.
+    """
+
+    logger = structlog.get_logger(logger_name=__module__ + "." + __qualname__)
+
+    PRUNE_INTERVAL = 300
+
+    def __init__(self, rr, rate, burst=1):
+        self.rr = rr
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        self._last_pruned = time.time()
+
+    def take(self, url):
+        """
+        Takes a token from the bucket of the host of `url` if there is one.
+
+        Returns:
+            0 if a token was taken, otherwise the number of seconds until
+            there will be one
+        """
+        host = url_host(url)
+        if not host:
+            return 0
+        self._maybe_prune()
+
+        def refill(old, new):
+            tokens = r.expr(
+                [
+                    self.burst,
+                    old["tokens"].add(
+                        r.expr([0, new["updated"].sub(old["updated"])])
+                        .max()
+                        .mul(self.rate)
+                    ),
+                ]
+            ).min()
+            return r.branch(
+                tokens.ge(1),
+                new.merge({"tokens": tokens.sub(1), "wait": 0}),
+                new.merge(
+                    {"tokens": tokens, "wait": r.expr(1).sub(tokens).div(self.rate)}
+                ),
+            )
+
+        # r.now() is evaluated once per query, so the conflict function is
+        # still deterministic, and the write atomic
+        result = (
+            self.rr.table("host_buckets")
+            .insert(
+                {
+                    "id": host,
+                    "tokens": self.burst - 1,
+                    "updated": r.now().to_epoch_time(),
+                    "wait": 0,
+                },
+                conflict=lambda host, old, new: refill(old, new),
+                return_changes="always",
+            )
+            .run()
+        )
+        return result["changes"][0]["new_val"]["wait"]
+
+    def _maybe_prune(self):
+        with self._lock:
+            if time.time() - self._last_pruned < self.PRUNE_INTERVAL:
+                return
+            self._last_pruned = time.time()
+        try:
+            self.prune()
+        except Exception:
+            self.logger.exception("problem pruning host buckets")
+
+    def prune(self):
+        """
+        Deletes the buckets that have refilled since they were last updated,
+        which is the same as leaving them be, so that the table doesn't grow
+        with every host ever crawled.
+        """
+        expired = r.now().to_epoch_time().sub(self.burst / self.rate)
+        # checked again as each bucket is deleted, in case it was just updated
+        self.rr.table("host_buckets").between(
+            r.minval, expired, index="updated"
+        ).replace(
+            lambda bucket: r.branch(bucket["updated"].lt(expired), None, bucket)
+        ).run()
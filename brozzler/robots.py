@@ -22,7 +22,10 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import collections
 import json
+import threading
+import time
 
 import reppy
 import reppy.cache
@@ -31,6 +34,7 @@ import requests
 import structlog
 
 import brozzler
+from brozzler import metrics
 from brozzler.ssl import CustomSSLContextHTTPAdapter, permissive_ssl_context
 
 __all__ = ["is_permitted_by_robots"]
@@ -68,30 +72,99 @@ class _SessionRaiseOn420(requests.Session):
             return res
 
 
-_robots_caches = {}  # {site_id:reppy.cache.RobotsCache}
+class _RobotsCache:
+    """
+    Thread-safe LRU cache of parsed robots.txt rules, shared by all sites.
+
+    Entries are keyed by robots.txt url, user-agent, proxy and any extra
+    request headers (i.e. Warcprox-Meta), so that sites crawled the same way
+    share a fetch, but robots.txt is still fetched and archived separately
+    for sites with different warcprox settings. Entries are dropped when
+    their rules expire, which reppy computes from the response's caching
+    headers, or when the cache is full.
+    """
 
+    def __init__(self, max_entries=5000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._rules = collections.OrderedDict()
 
-def _robots_cache(site, proxy=None):
-    if site.id not in _robots_caches:
-        req_sesh = _SessionRaiseOn420()
-        req_sesh.verify = False  # ignore cert errors
+    def __len__(self):
+        return len(self._rules)
 
-        ctx = permissive_ssl_context()  # allow unsafe SSL renegotiation
-        ctx.check_hostname = False  # required when verify=False
-        req_sesh.mount("https://", CustomSSLContextHTTPAdapter(ctx))
+    def get(self, key):
+        with self._lock:
+            rules = self._rules.get(key)
+            if rules is None:
+                return None
+            if rules.expired:
+                del self._rules[key]
+                return None
+            self._rules.move_to_end(key)
+            return rules
+
+    def put(self, key, rules):
+        with self._lock:
+            self._rules[key] = rules
+            self._rules.move_to_end(key)
+            while len(self._rules) > self.max_entries:
+                self._rules.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._rules.clear()
 
-        if proxy:
-            proxie = "http://%s" % proxy
-            req_sesh.proxies = {"http": proxie, "https": proxie}
-        if site.extra_headers():
-            req_sesh.headers.update(site.extra_headers())
-        if site.user_agent:
-            req_sesh.headers["User-Agent"] = site.user_agent
-        _robots_caches[site.id] = reppy.cache.RobotsCache(
-            session=req_sesh, disallow_forbidden=False
-        )
 
-    return _robots_caches[site.id]
+_robots_cache = _RobotsCache()
+
+_fetchers = {}  # {proxy:reppy.cache.RobotsCache}
+_fetchers_lock = threading.Lock()
+
+
+def _robots_fetcher(proxy=None):
+    """
+    Returns a `reppy.cache.RobotsCache` for `proxy`, used only to fetch and
+    parse robots.txt, so that its requests session and connection pool are
+    shared by all sites crawled through that proxy.
+    """
+    with _fetchers_lock:
+        if proxy not in _fetchers:
+            req_sesh = _SessionRaiseOn420()
+            req_sesh.verify = False  # ignore cert errors
+
+            ctx = permissive_ssl_context()  # allow unsafe SSL renegotiation
+            ctx.check_hostname = False  # required when verify=False
+            req_sesh.mount("https://", CustomSSLContextHTTPAdapter(ctx))
+
+            if proxy:
+                proxie = "http://%s" % proxy
+                req_sesh.proxies = {"http": proxie, "https": proxie}
+            _fetchers[proxy] = reppy.cache.RobotsCache(
+                session=req_sesh, disallow_forbidden=False
+            )
+        return _fetchers[proxy]
+
+
+def _robots_rules(site, url, proxy=None):
+    headers = dict(site.extra_headers())
+    if site.user_agent:
+        headers["User-Agent"] = site.user_agent
+    robots_url = reppy.Utility.roboturl(url)
+    key = (robots_url, proxy, tuple(sorted(headers.items())))
+
+    rules = _robots_cache.get(key)
+    if rules is not None:
+        metrics.brozzler_robots_cache_hits.inc()
+        return rules
+
+    metrics.brozzler_robots_cache_misses.inc()
+    start = time.time()
+    try:
+        rules = _robots_fetcher(proxy).fetch(url, headers=headers)
+    finally:
+        metrics.brozzler_robots_fetch_duration_seconds.observe(time.time() - start)
+    _robots_cache.put(key, rules)
+    return rules
 
 
 def is_permitted_by_robots(site, url, proxy=None):
@@ -114,8 +187,9 @@ def is_permitted_by_robots(site, url, proxy=None):
         return True
 
     try:
-        result = _robots_cache(site, proxy).allowed(url, site.user_agent or "brozzler")
-        return result
+        return _robots_rules(site, url, proxy).allowed(
+            url, site.user_agent or "brozzler"
+        )
     except Exception as e:
         if isinstance(e, reppy.exceptions.ServerError) and isinstance(
             e.args[0], brozzler.ReachedLimit
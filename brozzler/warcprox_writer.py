@@ -0,0 +1,282 @@
+"""
+brozzler/warcprox_writer.py - writes records to warcprox with
+WARCPROX_WRITE_RECORD requests over kept-alive connections
+
+Copyright (C) 2026 Internet Archive
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import base64
+import collections
+import hashlib
+import http.client
+import io
+import os
+import threading
+import time
+
+import structlog
+
+import brozzler
+
+from . import metrics
+
+# result of `WarcproxRecordWriter.write_record()`, where payload_digest is the
+# sha1 of the payload in the form warcprox uses, e.g. "sha1:3I42H3S6..."
+WriteRecordResult = collections.namedtuple(
+    "WriteRecordResult", ["status", "reason", "payload_digest", "length"]
+)
+
+
+class _DigestingReader:
+    """
+    Reads a binary file for http.client, updating a sha1 digest with what is
+    read, so that the payload is hashed as it is streamed.
+    """
+
+    def __init__(self, f):
+        self._f = f
+        self.digest = hashlib.sha1()
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self.digest.update(data)
+        return data
+
+
+class _NotSent(Exception):
+    """
+    Raised when a request failed before its body was sent in full, so warcprox
+    can't have written the record, and it's safe to send it again.
+    """
+
+
+class WarcproxRecordWriter:
+    """
+    Sends WARCPROX_WRITE_RECORD requests to warcprox instances, keeping up to
+    `max_idle_connections` connections to each one open between requests.
+
+    Payloads can be files, which are streamed from disk in `blocksize` chunks
+    and hashed on the way, rather than read into memory. They are sent with a
+    content-length, because warcprox doesn't accept chunked requests.
+
+    A request is retried on a new connection, up to `max_attempts` times in
+    all, when it could not have been written: when sending it failed, or when
+    a connection kept open since an earlier request turned out to have been
+    closed by warcprox.
+
+    The record url, e.g. "screenshot:http://(com,example,)/", is sent as the
+    request target as is, which is why this talks http.client rather than
+    going through urllib3, which would normalize it.
+
+    Recent write latency and error rate are tracked per warcprox, see
+    `health()`.
+    """
+
+    logger = structlog.get_logger(logger_name=__module__ + "." + __qualname__)
+
+    # weight of the latest request in the moving averages of `health()`
+    HEALTH_ALPHA = 0.2
+    # only writes of payloads up to this size count toward latency, so that
+    # video pushes don't make a warcprox look slow
+    LATENCY_MAX_PAYLOAD = 1024 * 1024
+
+    def __init__(
+        self, timeout=600, max_idle_connections=4, max_attempts=3, blocksize=262144
+    ):
+        self.timeout = timeout
+        self.max_idle_connections = max_idle_connections
+        self.max_attempts = max_attempts
+        self.blocksize = blocksize
+        self._lock = threading.Lock()
+        # {warcprox_address: [http.client.HTTPConnection]}
+        self._idle = collections.defaultdict(list)
+        # {warcprox_address: [error_rate, latency]}
+        self._health = {}
+
+    def health(self, warcprox_address):
+        """
+        Returns tuple (error_rate, latency) of moving averages over recent
+        requests to warcprox at `warcprox_address`, where error_rate is the
+        fraction that failed and latency is in seconds, or (0.0, 0.0) if
+        there haven't been any.
+        """
+        with self._lock:
+            return tuple(self._health.get(warcprox_address, (0.0, 0.0)))
+
+    def _note_health(self, warcprox_address, failed, latency=None):
+        with self._lock:
+            health = self._health.setdefault(warcprox_address, [0.0, 0.0])
+            health[0] += self.HEALTH_ALPHA * (float(failed) - health[0])
+            if latency is not None:
+                health[1] += self.HEALTH_ALPHA * (latency - health[1])
+
+    def note_error(self, warcprox_address):
+        """
+        Counts an error talking to warcprox that happened somewhere else,
+        e.g. while browsing through it.
+        """
+        self._note_health(warcprox_address, True)
+
+    def _connection(self, warcprox_address):
+        """
+        Returns tuple (connection, reused) with an idle connection to
+        warcprox if there is one, or else a new one.
+        """
+        with self._lock:
+            if self._idle[warcprox_address]:
+                return self._idle[warcprox_address].pop(), True
+        conn = http.client.HTTPConnection(
+            warcprox_address, timeout=self.timeout, blocksize=self.blocksize
+        )
+        return conn, False
+
+    def _release(self, warcprox_address, conn):
+        with self._lock:
+            if len(self._idle[warcprox_address]) < self.max_idle_connections:
+                self._idle[warcprox_address].append(conn)
+                return
+        conn.close()
+
+    @staticmethod
+    def _remaining_length(f):
+        try:
+            return os.fstat(f.fileno()).st_size - f.tell()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            start = f.tell()
+            length = f.seek(0, os.SEEK_END) - start
+            f.seek(start)
+            return length
+
+    def write_record(
+        self,
+        warcprox_address,
+        url,
+        warc_type,
+        content_type,
+        payload,
+        extra_headers=None,
+    ):
+        """
+        Asks warcprox at `warcprox_address` ("host:port") to write a record of
+        `payload`, which is bytes or a binary file positioned at the start of
+        the payload.
+
+        Returns:
+            WriteRecordResult
+
+        Raises:
+            brozzler.ProxyError: if warcprox could not be reached, or the
+                request failed
+        """
+        headers = {"Content-Type": content_type, "WARC-Type": warc_type, "Host": "N/A"}
+        for k, v in (extra_headers or {}).items():
+            if k.lower() != "content-length":
+                headers[k] = v
+        if isinstance(payload, (bytes, bytearray, memoryview)):
+            payload = io.BytesIO(payload)
+        start = payload.tell()
+        length = self._remaining_length(payload)
+        headers["Content-Length"] = str(length)
+
+        started = time.time()
+        with metrics.brozzler_warcprox_write_record_duration_seconds.time():
+            try:
+                for attempt in range(1, self.max_attempts + 1):
+                    payload.seek(start)
+                    body = _DigestingReader(payload)
+                    try:
+                        response = self._send(warcprox_address, url, headers, body)
+                        break
+                    except _NotSent as e:
+                        if attempt == self.max_attempts:
+                            raise brozzler.ProxyError(
+                                "proxy error on WARCPROX_WRITE_RECORD %s" % url
+                            ) from e.__cause__
+                        self.logger.info(
+                            "retrying WARCPROX_WRITE_RECORD on new connection",
+                            url=url,
+                            attempt=attempt,
+                            error=e.__cause__,
+                        )
+            except brozzler.ProxyError:
+                self._note_health(warcprox_address, True)
+                raise
+        self._note_health(
+            warcprox_address,
+            response.status >= 500,
+            time.time() - started if length <= self.LATENCY_MAX_PAYLOAD else None,
+        )
+
+        if response.status != 204:
+            self.logger.warning(
+                "got unexpected response on warcprox "
+                "WARCPROX_WRITE_RECORD request (expected 204)",
+                code=response.status,
+                reason=response.reason,
+            )
+        return WriteRecordResult(
+            response.status,
+            response.reason,
+            "sha1:" + base64.b32encode(body.digest.digest()).decode("ascii"),
+            length,
+        )
+
+    def _send(self, warcprox_address, url, headers, body):
+        """
+        Sends the request and reads the response.
+
+        Raises:
+            _NotSent: if the request can be sent again
+            brozzler.ProxyError: if it can't
+        """
+        conn, reused = self._connection(warcprox_address)
+        try:
+            if conn.sock is None:
+                conn.connect()
+        except OSError as e:
+            conn.close()
+            raise brozzler.ProxyError(
+                "proxy error on WARCPROX_WRITE_RECORD %s" % url
+            ) from e
+        try:
+            conn.request("WARCPROX_WRITE_RECORD", url, body=body, headers=headers)
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            raise _NotSent() from e
+        try:
+            response = conn.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            # warcprox closed the connection while it was idle, before reading
+            # this request
+            if reused and isinstance(e, http.client.RemoteDisconnected):
+                raise _NotSent() from e
+            raise brozzler.ProxyError(
+                "proxy error on WARCPROX_WRITE_RECORD %s" % url
+            ) from e
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(warcprox_address, conn)
+        return response
+
+    def close(self):
+        """Closes the idle connections."""
+        with self._lock:
+            conns = [conn for conns in self._idle.values() for conn in conns]
+            self._idle.clear()
+        for conn in conns:
+            conn.close()
@@ -18,6 +18,9 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import collections
+import concurrent.futures
+import contextlib
 import datetime
 import importlib.util
 import io
@@ -25,8 +28,7 @@ import json
 import socket
 import threading
 import time
-import urllib.error
-import urllib.request
+import urllib.parse
 
 import doublethink
 import PIL.Image
@@ -40,6 +42,10 @@ from urllib3.exceptions import ProxyError, TimeoutError
 
 import brozzler
 import brozzler.browser
+import brozzler.content_type
+import brozzler.frontier
+import brozzler.politeness
+import brozzler.warcprox_writer
 from brozzler.model import VideoCaptureOptions
 from brozzler.ssl import CustomSSLContextHTTPAdapter, permissive_ssl_context
 
@@ -48,42 +54,253 @@ from . import metrics
 r = rdb.RethinkDB()
 
 
-def _get_with_legacy_renegotiation(url, **kwargs) -> requests.Response:
+# hosts that needed unsafe legacy ssl renegotiation, shared by all workers
+_legacy_renegotiation_hosts = set()
+
+
+def _needs_legacy_renegotiation(e: requests.exceptions.SSLError) -> bool:
+    return bool(
+        e.__context__
+        and e.__context__.__context__
+        and e.__context__.__context__.__context__
+        and e.__context__.__context__.__context__.reason
+        == "UNSAFE_LEGACY_RENEGOTIATION_DISABLED"
+    )
+
+
+class _DirectSession:
     """
-    Performs a get request with unsafe legacy renegotiation enabled.
+    Requests session for fetching directly, not through the proxy, that keeps
+    connections alive between requests. Falls back to unsafe legacy ssl
+    renegotiation when a host needs it, and remembers the host so that later
+    requests use it straight away. Cookies are not kept between requests.
+
+    Not thread safe, so each browsing thread gets its own.
     """
-    session = requests.session()
-    ctx = permissive_ssl_context()
-    if not kwargs.get("verify", True):
-        ctx.check_hostname = False
-    session.mount("https://", CustomSSLContextHTTPAdapter(ctx))
-    return session.get(url, **kwargs)
 
+    def __init__(self):
+        self._session = requests.Session()
+        self._legacy_sessions = {}  # {verify: requests.Session}
+
+    def _legacy_session(self, verify):
+        if verify not in self._legacy_sessions:
+            session = requests.Session()
+            ctx = permissive_ssl_context()
+            if not verify:
+                ctx.check_hostname = False
+            session.mount("https://", CustomSSLContextHTTPAdapter(ctx))
+            self._legacy_sessions[verify] = session
+        return self._legacy_sessions[verify]
+
+    def get(self, url, **kwargs) -> requests.Response:
+        host = urllib.parse.urlsplit(url).netloc
+        legacy_session = self._legacy_session(kwargs.get("verify", True))
+        try:
+            if host in _legacy_renegotiation_hosts:
+                return legacy_session.get(url, **kwargs)
+            try:
+                return self._session.get(url, **kwargs)
+            except requests.exceptions.SSLError as e:
+                if not _needs_legacy_renegotiation(e):
+                    raise
+                logger = structlog.get_logger(logger_name=__name__)
+                logger.info(
+                    "request failed with legacy renegotiation disabled; "
+                    "retrying with it enabled",
+                    url=url,
+                )
+                _legacy_renegotiation_hosts.add(host)
+                return legacy_session.get(url, **kwargs)
+        finally:
+            self._session.cookies.clear()
+            legacy_session.cookies.clear()
 
-def _get_with_permissive_fallback(url, **kwargs) -> requests.Response:
+
+class _HostSlots:
     """
-    Attempts to perform a request with default SSL settings, then falls
-    back to a request with unsafe legacy renegotiation enabled if
-    necessary.
+    Limits how many pages of the same host are brozzled at once.
     """
-    try:
-        return requests.get(url, **kwargs)
-    except requests.exceptions.SSLError as e:
-        if (
-            e.__context__
-            and e.__context__.__context__
-            and e.__context__.__context__.__context__
-            and e.__context__.__context__.__context__.reason
-            == "UNSAFE_LEGACY_RENEGOTIATION_DISABLED"
-        ):
-            logger = structlog.get_logger(logger_name=__name__)
-            logger.info(
-                "request failed with legacy renegotiation disabled; "
-                "retrying with it enabled",
-                url=url,
+
+    def __init__(self, max_per_host):
+        self.max_per_host = max_per_host
+        self._in_use = collections.Counter()
+        self._available = threading.Condition()
+
+    @contextlib.contextmanager
+    def hold(self, url):
+        host = urllib.parse.urlsplit(url).hostname
+        with self._available:
+            # wait in short slices, because exceptions from
+            # `brozzler.thread_raise()` are only delivered between waits
+            while self._in_use[host] >= self.max_per_host:
+                self._available.wait(0.5)
+            self._in_use[host] += 1
+        try:
+            yield
+        finally:
+            with self._available:
+                self._in_use[host] -= 1
+                if not self._in_use[host]:
+                    del self._in_use[host]
+                self._available.notify_all()
+
+
+class _ScreenshotPool:
+    """
+    Processes screenshots in a pool of threads, so that browsing carries on
+    while they are thumbnailed and written to warcprox. Submitting blocks
+    while `2 * threads` screenshots are waiting or being processed.
+    """
+
+    def __init__(self, threads):
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="Screenshots"
+        )
+        self._slots = threading.BoundedSemaphore(2 * threads)
+        self._lock = threading.Lock()
+        self._futures = collections.defaultdict(list)  # {page_id: [Future]}
+
+    def submit(self, page, fn, *args):
+        with metrics.brozzler_screenshot_backpressure_wait_seconds.time():
+            # wait in short slices, because exceptions from
+            # `brozzler.thread_raise()` are only delivered between waits
+            while not self._slots.acquire(timeout=0.5):
+                pass
+        metrics.brozzler_screenshots_pending.inc()
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(self._done)
+        with self._lock:
+            self._futures[page.id].append(future)
+
+    def _done(self, future):
+        metrics.brozzler_screenshots_pending.dec()
+        self._slots.release()
+
+    def wait(self, page):
+        """
+        Waits for the screenshots of `page` to be processed, and raises the
+        first exception raised processing them, if any.
+        """
+        with self._lock:
+            futures = self._futures.pop(page.id, [])
+        for future in futures:
+            future.result()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+class _WarcproxScoreboard:
+    """
+    Chooses warcprox instances for sites, from counts of the active sites
+    assigned to each instance that are cached for `refresh_interval` seconds,
+    rather than counted for every choice. Choices made in the meantime are
+    added to the cached counts.
+
+    Instances are ranked by `(assigned_sites + 1) * (1 + penalty)`, where the
+    penalty comes from the recent error rate and write latency of the
+    instance as seen by `record_writer`, then by the load (queue fullness)
+    the instance reports in the service registry. Without errors or slow
+    writes, that is the same as ranking by assigned sites, then load.
+    """
+
+    # penalty for an instance whose requests all fail
+    ERROR_WEIGHT = 4.0
+    # penalty per second of write latency
+    LATENCY_WEIGHT = 1.0
+
+    def __init__(self, frontier, record_writer, refresh_interval=20):
+        self.frontier = frontier
+        self.record_writer = record_writer
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._assigned_sites = {}  # {warcprox_address: count}
+        self._refreshed = None
+
+    def _refresh(self):
+        # .group('proxy').count() makes this query about 99% more efficient
+        reql = (
+            self.frontier.rr.table("sites")
+            .between(
+                ["ACTIVE", r.minval],
+                ["ACTIVE", r.maxval],
+                index="sites_last_disclaimed",
+            )
+            .group("proxy")
+            .count()
+        )
+        # returns results like
+        # {
+        #    "wbgrp-svc030.us.archive.org:8000": 148,
+        #    "wbgrp-svc030.us.archive.org:8001": 145
+        # }
+        self._assigned_sites = dict(reql.run())
+        self._refreshed = time.time()
+
+    def _penalty(self, address):
+        error_rate, latency = self.record_writer.health(address)
+        return self.ERROR_WEIGHT * error_rate + self.LATENCY_WEIGHT * latency
+
+    def choose(self, warcproxes):
+        """
+        Returns the best of `warcproxes`, service registry entries of warcprox
+        instances, and counts a site as assigned to it.
+        """
+        with self._lock:
+            if (
+                self._refreshed is None
+                or time.time() - self._refreshed > self.refresh_interval
+            ):
+                self._refresh()
+            for warcprox in warcproxes:
+                address = "%s:%s" % (warcprox["host"], warcprox["port"])
+                warcprox["assigned_sites"] = self._assigned_sites.get(address, 0)
+                warcprox["penalty"] = self._penalty(address)
+            best = min(
+                warcproxes,
+                key=lambda warcprox: (
+                    (warcprox["assigned_sites"] + 1) * (1 + warcprox["penalty"]),
+                    warcprox.get("load", 0),
+                ),
             )
-            return _get_with_legacy_renegotiation(url, **kwargs)
-        raise
+            address = "%s:%s" % (best["host"], best["port"])
+            self._assigned_sites[address] = self._assigned_sites.get(address, 0) + 1
+            return best
+
+    def unassign(self, address):
+        """
+        Notes that a site has given up on the warcprox at `address`.
+        """
+        with self._lock:
+            if self._assigned_sites.get(address):
+                self._assigned_sites[address] -= 1
+
+
+class _SiteSession:
+    """
+    State shared by the threads brozzling pages of the same site in different
+    tabs of a browser.
+    """
+
+    def __init__(self, max_pages_per_host):
+        # serializes claims, completions and refreshes of the site
+        self.lock = threading.Lock()
+        self.host_slots = _HostSlots(max_pages_per_host)
+        self.page_ids = set()  # pages being brozzled
+        # (page, exception) of the first page that failed in a tab, handled by
+        # the site's thread like a failure of its own page
+        self.failure = None
+        self.stop = threading.Event()
+        self.threads = []
+        self.tabs = []
+
+    def fail(self, page, e):
+        with self.lock:
+            first = self.failure is None and not self.stop.is_set()
+            if first:
+                self.failure = (page, e)
+        self.stop.set()
+        return first
 
 
 class BrozzlerWorker:
@@ -95,7 +312,25 @@ class BrozzlerWorker:
     # cluster with slow rethinkdb.
     HEARTBEAT_INTERVAL = 200.0
     SITE_SESSION_MINUTES = 15
+    # longest wait for a host rate limit before leaving the site to others
+    HOST_BUDGET_MAX_WAIT = 5
+    # (first delay, growth factor, longest delay) in seconds before retrying
+    # a page that failed, by kind of failure, see `_failure_kind()`
+    PAGE_RETRY_BACKOFF = {
+        # the host may be down for a while, so give it time
+        "connection": (60, 2, 480),
+        # a crashed or stuck browser is replaced straight away
+        "browser": (30, 1.5, 90),
+        # warcprox trouble isn't the page's fault and doesn't count as a
+        # failed attempt, so this delay doesn't grow
+        "proxy": (15, 1, 15),
+        # delays of 60, 90, 135, 135...
+        "other": (60, 1.5, 135),
+    }
     HEADER_REQUEST_TIMEOUT = 60
+    # read response bodies up to this size after getting the headers, so that
+    # the connection can be reused
+    HEADER_REQUEST_DRAIN_BYTES = 64 * 1024
     FETCH_URL_TIMEOUT = 60
 
     def __init__(
@@ -125,6 +360,20 @@ class BrozzlerWorker:
         registry_url=None,
         env=None,
         worker_id=None,
+        reuse_browsers=False,
+        max_pages_per_browser=None,
+        max_browser_minutes=None,
+        completion_pipeline_depth=0,
+        predict_content_type=False,
+        site_leases=False,
+        max_page_concurrency=4,
+        max_pages_per_host=2,
+        shared_chrome=False,
+        status_feed=False,
+        screenshot_threads=2,
+        host_rate_limit=None,
+        host_rate_burst=1,
+        cluster_host_rate_limit=False,
     ):
         self._frontier = frontier
         self._service_registry = service_registry
@@ -165,10 +414,66 @@ class BrozzlerWorker:
         self._env = env
 
         self._browser_pool = brozzler.browser.BrowserPool(
-            max_browsers, chrome_exe=chrome_exe, ignore_cert_errors=True
+            max_browsers,
+            reuse_browsers=reuse_browsers,
+            max_pages_per_browser=max_pages_per_browser,
+            max_browser_minutes=max_browser_minutes,
+            shared_chrome=shared_chrome,
+            chrome_exe=chrome_exe,
+            ignore_cert_errors=True,
         )
         self._browsing_threads = set()
         self._browsing_threads_lock = threading.Lock()
+        self._max_page_concurrency = max_page_concurrency
+        self._max_pages_per_host = max_pages_per_host
+
+        self._lease_coordinator = None
+        if site_leases:
+            if service_registry:
+                self._lease_coordinator = brozzler.frontier.SiteLeaseCoordinator(
+                    frontier, service_registry
+                )
+            else:
+                self.logger.warning(
+                    "site leases need a service registry, claiming sites directly"
+                )
+
+        self._content_type_predictor = None
+        if predict_content_type:
+            self._content_type_predictor = brozzler.content_type.ContentTypePredictor()
+
+        self._direct_sessions = threading.local()
+        self._http_pools = {}  # {proxy: urllib3.PoolManager}
+        self._http_pools_lock = threading.Lock()
+
+        self._warcprox_writer = brozzler.warcprox_writer.WarcproxRecordWriter(
+            max_idle_connections=max_browsers + screenshot_threads
+        )
+        self._warcprox_scoreboard = _WarcproxScoreboard(frontier, self._warcprox_writer)
+        self._screenshot_pool = None
+        if screenshot_threads > 0:
+            self._screenshot_pool = _ScreenshotPool(screenshot_threads)
+
+        self._host_budget = None
+        if host_rate_limit:
+            if cluster_host_rate_limit:
+                self._host_budget = brozzler.politeness.RethinkDbHostTokenBuckets(
+                    frontier.rr, host_rate_limit / 60, host_rate_burst
+                )
+            else:
+                self._host_budget = brozzler.politeness.HostTokenBuckets(
+                    host_rate_limit / 60, host_rate_burst
+                )
+
+        self._status_feed = None
+        if status_feed:
+            self._status_feed = brozzler.frontier.SiteStatusFeed(frontier)
+
+        self._completion_pipeline = None
+        if completion_pipeline_depth > 0:
+            self._completion_pipeline = brozzler.frontier.CompletionPipeline(
+                frontier, max_depth=completion_pipeline_depth
+            )
 
         self._thread = None
         self._start_stop_lock = threading.Lock()
@@ -188,31 +493,7 @@ class BrozzlerWorker:
         warcproxes = self._service_registry.available_services("warcprox")
         if not warcproxes:
             return None
-        # .group('proxy').count() makes this query about 99% more efficient
-        reql = (
-            self._frontier.rr.table("sites")
-            .between(
-                ["ACTIVE", r.minval],
-                ["ACTIVE", r.maxval],
-                index="sites_last_disclaimed",
-            )
-            .group("proxy")
-            .count()
-        )
-        # returns results like
-        # {
-        #    "wbgrp-svc030.us.archive.org:8000": 148,
-        #    "wbgrp-svc030.us.archive.org:8001": 145
-        # }
-        proxy_scoreboard = dict(reql.run())
-        for warcprox in warcproxes:
-            address = "%s:%s" % (warcprox["host"], warcprox["port"])
-            warcprox["assigned_sites"] = proxy_scoreboard.get(address, 0)
-        warcproxes.sort(
-            key=lambda warcprox: (warcprox["assigned_sites"], warcprox["load"])
-        )
-        # XXX make this heuristic more advanced?
-        return warcproxes[0]
+        return self._warcprox_scoreboard.choose(warcproxes)
 
     def _proxy_for(self, site):
         if self._proxy:
@@ -265,51 +546,28 @@ class BrozzlerWorker:
         payload,
         extra_headers=None,
     ):
-        headers = {"Content-Type": content_type, "WARC-Type": warc_type, "Host": "N/A"}
-        if extra_headers:
-            headers.update(extra_headers)
-        request = urllib.request.Request(
-            url, method="WARCPROX_WRITE_RECORD", headers=headers, data=payload
+        """
+        Returns `brozzler.warcprox_writer.WriteRecordResult`, see
+        `brozzler.warcprox_writer.WarcproxRecordWriter.write_record()`.
+        """
+        return self._warcprox_writer.write_record(
+            warcprox_address,
+            url,
+            warc_type,
+            content_type,
+            payload,
+            extra_headers=extra_headers,
         )
 
-        # XXX setting request.type="http" is a hack to stop urllib from trying
-        # to tunnel if url is https
-        request.type = "http"
-        request.set_proxy(warcprox_address, "http")
-
-        try:
-            with urllib.request.urlopen(request, timeout=600) as response:
-                if response.getcode() != 204:
-                    self.logger.warning(
-                        "got unexpected response on warcprox "
-                        "WARCPROX_WRITE_RECORD request (expected 204)",
-                        code=response.getcode(),
-                        reason=response.reason,
-                    )
-                return request, response
-        except urllib.error.HTTPError as e:
-            self.logger.warning(
-                "got unexpected response on warcprox "
-                "WARCPROX_WRITE_RECORD request (expected 204)",
-                code=e.getcode(),
-                reason=e.info(),
-            )
-            return request, None
-        except urllib.error.URLError as e:
-            raise brozzler.ProxyError(
-                "proxy error on WARCPROX_WRITE_RECORD %s" % url
-            ) from e
-        except ConnectionError as e:
-            raise brozzler.ProxyError(
-                "proxy error on WARCPROX_WRITE_RECORD %s" % url
-            ) from e
-
     def thumb_jpeg(self, full_jpeg):
         """Create JPEG thumbnail."""
         img = PIL.Image.open(io.BytesIO(full_jpeg))
         thumb_width = 300
         thumb_height = (thumb_width / img.size[0]) * img.size[1]
-        img.thumbnail((thumb_width, thumb_height))
+        # decode at the smallest jpeg scale (1/2, 1/4 or 1/8) that is still
+        # at least twice the thumbnail size, and resample from there
+        img.draft("RGB", (thumb_width * 2, int(thumb_height) * 2))
+        img.thumbnail((thumb_width, thumb_height), reducing_gap=2.0)
         out = io.BytesIO()
         img.save(out, "jpeg", quality=95)
         return out.getbuffer()
@@ -344,12 +602,43 @@ class BrozzlerWorker:
         on_screenshot=None,
         on_request=None,
         enable_youtube_dl=True,
+    ):
+        try:
+            outlinks = self._brozzle_page(
+                browser, site, page, on_screenshot, on_request, enable_youtube_dl
+            )
+        except BaseException:
+            if self._screenshot_pool:
+                try:
+                    self._screenshot_pool.wait(page)
+                except Exception:
+                    self.logger.exception("problem writing screenshot", page=page)
+            raise
+        # the screenshot is processed while the rest of the page is brozzled,
+        # but it has to be written before the page is completed
+        if self._screenshot_pool:
+            self._screenshot_pool.wait(page)
+        return outlinks
+
+    def _brozzle_page(
+        self, browser, site, page, on_screenshot, on_request, enable_youtube_dl
     ):
         page_logger = self.logger.bind(page=page)
         page_logger.info("brozzling")
         outlinks = set()
 
-        page_headers = self._get_page_headers(site, page)
+        if self._can_skip_page_headers(site, page):
+            page_logger.info("expecting html, not getting page headers")
+            metrics.brozzler_page_header_requests.labels(outcome="skipped").inc()
+            page_headers = {}
+        else:
+            page_headers = self._get_page_headers(site, page)
+            if self._content_type_predictor:
+                metrics.brozzler_page_header_requests.labels(outcome="fetched").inc()
+                if "content-type" in page_headers:
+                    self._content_type_predictor.observe(
+                        page.url, page_headers["content-type"]
+                    )
 
         if not self._needs_browsing(page_headers):
             page_logger.info("needs fetch")
@@ -427,13 +716,14 @@ class BrozzlerWorker:
             user_agent = site.get("user_agent")
             headers = {"User-Agent": user_agent} if user_agent else {}
             url_logger.info("getting page headers")
-            with _get_with_permissive_fallback(
+            with self._direct_session().get(
                 page.url,
                 stream=True,
                 verify=False,
                 headers=headers,
                 timeout=self.HEADER_REQUEST_TIMEOUT,
             ) as r:
+                self._drain_small_body(r)
                 return r.headers
         except requests.exceptions.Timeout:
             url_logger.warning("Timed out trying to get headers", exc_info=True)
@@ -441,6 +731,62 @@ class BrozzlerWorker:
             url_logger.warning("Failed to get headers", exc_info=True)
         return {}
 
+    def _direct_session(self):
+        if not hasattr(self._direct_sessions, "session"):
+            self._direct_sessions.session = _DirectSession()
+        return self._direct_sessions.session
+
+    def _drain_small_body(self, response):
+        """
+        Reads the body of `response` if it is small, so that its connection
+        goes back to the pool instead of being closed.
+        """
+        try:
+            length = int(response.headers.get("content-length"))
+        except (TypeError, ValueError):
+            return
+        if length <= self.HEADER_REQUEST_DRAIN_BYTES:
+            try:
+                # read only for its side effect of consuming the body
+                _ = response.content
+            except requests.exceptions.RequestException:
+                pass
+
+    def _http_pool(self, proxy_url=None):
+        """
+        Returns the urllib3 pool manager for fetching through `proxy_url`, or
+        directly if None, shared by all browsing threads so that connections
+        are kept alive between fetches.
+        """
+        with self._http_pools_lock:
+            if proxy_url not in self._http_pools:
+                if proxy_url:
+                    self._http_pools[proxy_url] = urllib3.ProxyManager(
+                        "http://%s" % proxy_url,
+                        cert_reqs="CERT_NONE",
+                        maxsize=self._max_browsers,
+                    )
+                else:
+                    self._http_pools[proxy_url] = urllib3.PoolManager(
+                        maxsize=self._max_browsers
+                    )
+            return self._http_pools[proxy_url]
+
+    def _can_skip_page_headers(self, site, page) -> bool:
+        """
+        Decides whether to browse `page` without getting its headers first,
+        which requires the url to be predicted to serve html, and the site to
+        have no options that depend on the page's content type.
+        """
+        if not self._content_type_predictor:
+            return False
+        if site.pdfs_only or site.video_capture in [
+            VideoCaptureOptions.DISABLE_VIDEO_CAPTURE.value,
+            VideoCaptureOptions.BLOCK_VIDEO_MIME_TYPES.value,
+        ]:
+            return False
+        return self._content_type_predictor.predicts_html(page.url)
+
     def _needs_browsing(self, page_headers) -> bool:
         return not (
             "content-type" in page_headers
@@ -486,25 +832,27 @@ class BrozzlerWorker:
                     proxy=self._proxy_for(site),
                     screenshot_for_page=page,
                 )
-                thumbnail_jpeg = self.thumb_jpeg(screenshot_jpeg)
-                self._warcprox_write_record(
-                    warcprox_address=self._proxy_for(site),
-                    url="screenshot:%s" % str(urlcanon.semantic(page.url)),
-                    warc_type="resource",
-                    content_type="image/jpeg",
-                    payload=screenshot_jpeg,
-                    extra_headers=site.extra_headers(page),
-                )
-                self._warcprox_write_record(
-                    warcprox_address=self._proxy_for(site),
-                    url="thumbnail:%s" % str(urlcanon.semantic(page.url)),
-                    warc_type="resource",
-                    content_type="image/jpeg",
-                    payload=thumbnail_jpeg,
-                    extra_headers=site.extra_headers(page),
+                args = (
+                    self._proxy_for(site),
+                    str(urlcanon.semantic(page.url)),
+                    site.extra_headers(page),
+                    screenshot_jpeg,
                 )
+                if self._screenshot_pool:
+                    self._screenshot_pool.submit(page, self._write_screenshot, *args)
+                else:
+                    self._write_screenshot(*args)
 
         def _on_response(chrome_msg):
+            if (
+                self._content_type_predictor
+                and chrome_msg.get("params", {}).get("type") == "Document"
+                and "mimeType" in chrome_msg["params"].get("response", {})
+            ):
+                self._content_type_predictor.observe(
+                    chrome_msg["params"]["response"].get("url"),
+                    chrome_msg["params"]["response"]["mimeType"],
+                )
             if (
                 "params" in chrome_msg
                 and "response" in chrome_msg["params"]
@@ -548,14 +896,7 @@ class BrozzlerWorker:
                     self._fetch_url(site, url=url)
                     sw_fetched.add(url)
 
-        if not browser.is_running():
-            browser.start(
-                proxy=self._proxy_for(site),
-                cookie_db=site.get("cookie_db"),
-                window_height=self._window_height,
-                window_width=self._window_width,
-                headless=self._headless,
-            )
+        self._start_browser(browser, site)
         page.clear_redirect()
         final_page_url, outlinks = browser.browse_page(
             page.url,
@@ -586,16 +927,44 @@ class BrozzlerWorker:
         update_page_metrics(page, outlinks)
         return outlinks
 
+    @metrics.brozzler_screenshot_processing_duration_seconds.time()
+    def _write_screenshot(self, warcprox_address, url, extra_headers, screenshot_jpeg):
+        thumbnail_jpeg = self.thumb_jpeg(screenshot_jpeg)
+        self._warcprox_write_record(
+            warcprox_address=warcprox_address,
+            url="screenshot:%s" % url,
+            warc_type="resource",
+            content_type="image/jpeg",
+            payload=screenshot_jpeg,
+            extra_headers=extra_headers,
+        )
+        self._warcprox_write_record(
+            warcprox_address=warcprox_address,
+            url="thumbnail:%s" % url,
+            warc_type="resource",
+            content_type="image/jpeg",
+            payload=thumbnail_jpeg,
+            extra_headers=extra_headers,
+        )
+
+    def _start_browser(self, browser, site):
+        if not browser.is_running():
+            browser.start(
+                proxy=self._proxy_for(site),
+                cookie_db=site.get("cookie_db"),
+                cookies=site.browser_cookies(),
+                window_height=self._window_height,
+                window_width=self._window_width,
+                headless=self._headless,
+            )
+
     def _fetch_url(self, site, url=None, page=None):
         proxy_url = self._proxy_for(site)
 
         if page:
             url = page.url
 
-        if proxy_url:
-            http = urllib3.ProxyManager("http://%s" % proxy_url, cert_reqs="CERT_NONE")
-        else:
-            http = urllib3.PoolManager()
+        http = self._http_pool(proxy_url)
 
         user_agent = site.get("user_agent")
         headers = {"User-Agent": user_agent} if user_agent else {}
@@ -623,8 +992,11 @@ class BrozzlerWorker:
 
     def brozzle_site(self, browser, site):
         site_logger = self.logger.bind(site=site)
+        session = None
+        reclaim_after = None
+        nothing_to_claim = False
         try:
-            site.last_claimed_by = "%s:%s" % (socket.gethostname(), browser.chrome.port)
+            site.last_claimed_by = "%s:%s" % (socket.gethostname(), browser.browser_id)
             site.save()
             start = time.time()
             page = None
@@ -633,34 +1005,71 @@ class BrozzlerWorker:
             # _proxy_for() call in log statement can raise brozzler.ProxyError
             # which is why we honor time limit and stop request first☝🏻
             site_logger.info("brozzling site", proxy=self._proxy_for(site))
+            if browser.is_running() and (
+                browser.proxy != self._proxy_for(site) or site.cookie_db
+            ):
+                # warm browser from the pool, but the proxy is a chrome command
+                # line option and the cookie db is loaded at chrome startup,
+                # so restart it
+                browser.stop()
+            if browser.is_running() and site.cookies:
+                browser.restore_cookies(site.browser_cookies())
+            page_concurrency = self._page_concurrency(site)
+            if page_concurrency > 1:
+                session = _SiteSession(self._max_pages_per_host)
+                self._start_tab_threads(
+                    browser, site, session, page_concurrency - 1, start
+                )
+            if self._status_feed:
+                self._watch_site(site, session)
             while time.time() - start < self.SITE_SESSION_MINUTES * 60:
-                site.refresh()
-                self._frontier.enforce_time_limit(site)
-                self._frontier.honor_stop_request(site)
-                page = self._frontier.claim_page(
-                    site, "%s:%s" % (socket.gethostname(), browser.chrome.port)
+                self._check_site(site, session)
+                page = self._claim_page(
+                    site,
+                    "%s:%s" % (socket.gethostname(), browser.browser_id),
+                    session,
                 )
-
-                if page.needs_robots_check and not brozzler.is_permitted_by_robots(
-                    site, page.url, self._proxy_for(site)
-                ):
-                    self.logger.warning("page is blocked by robots.txt", url=page.url)
-                    page.blocked_by_robots = True
-                    self._frontier.completed_page(site, page)
+                if page is None:
+                    break
+
+                if session:
+                    with session.host_slots.hold(page.url):
+                        self._brozzle_claimed_page(browser, site, page, session)
+                    with session.lock:
+                        session.page_ids.discard(page.id)
                 else:
-                    outlinks = self.brozzle_page(
-                        browser, site, page, enable_youtube_dl=not self._skip_youtube_dl
-                    )
-                    self._frontier.completed_page(site, page)
-                    self._frontier.scope_and_schedule_outlinks(site, page, outlinks)
-                    if browser.is_running():
-                        site.cookie_db = browser.chrome.persist_and_read_cookie_db()
+                    self._brozzle_claimed_page(browser, site, page)
+                if browser.is_running():
+                    self._note_cookies(browser, site)
 
                 page = None
+            if session and session.failure:
+                # a page failed in another tab, handle it like a failure here
+                with session.lock:
+                    (page, e), session.failure = session.failure, None
+                raise e
         except brozzler.ShutdownRequested:
             self.logger.info("shutdown requested")
+        except brozzler.HostOverBudget as e:
+            site_logger.info(
+                "hosts of site's pages over rate limit, leaving site until a "
+                "page is within it",
+                wait=e.wait,
+            )
+            reclaim_after = doublethink.utcnow() + datetime.timedelta(seconds=e.wait)
+        except brozzler.PagesDeferred as e:
+            site_logger.info(
+                "all pages left are waiting to be retried, leaving site until then",
+                retry_after=e.retry_after,
+            )
+            reclaim_after = e.retry_after
         except brozzler.NothingToClaim:
             site_logger.info("no pages left for site")
+            nothing_to_claim = True
+        except brozzler.frontier.PagesNotSaved:
+            # those pages are still claimed, so they're brozzled again when
+            # the site is next claimed
+            site_logger.exception("brozzled pages not saved, leaving site")
         except brozzler.ReachedLimit as e:
             self._frontier.reached_limit(site, e)
         except brozzler.ReachedTimeLimit:
@@ -676,11 +1085,18 @@ class BrozzlerWorker:
                     "healthy instance next time site is brozzled",
                     site_proxy=site.proxy,
                 )
+                if page:
+                    self._defer_page(page, "proxy")
+                if site.proxy:
+                    self._warcprox_writer.note_error(site.proxy)
+                    self._warcprox_scoreboard.unassign(site.proxy)
                 site.proxy = None
             else:
                 # using brozzler-worker --proxy, nothing to do but try the
                 # same proxy again next time
                 self.logger.exception("proxy error", self_proxy=self._proxy)
+                if page:
+                    self._defer_page(page, "proxy")
         except (brozzler.PageConnectionError, Exception) as e:
             if isinstance(e, brozzler.PageConnectionError):
                 site_logger.exception(
@@ -690,36 +1106,292 @@ class BrozzlerWorker:
             else:
                 site_logger.exception("unexpected exception", page=page)
             if page:
-                # Calculate backoff in seconds based on number of failed attempts.
-                # Minimum of 60, max of 135 giving delays of 60, 90, 135, 135...
-                retry_delay = min(135, 60 * (1.5 ** (page.failed_attempts or 0)))
-                page.retry_after = doublethink.utcnow() + datetime.timedelta(
-                    seconds=retry_delay
-                )
-                page.failed_attempts = (page.failed_attempts or 0) + 1
-                if page.failed_attempts >= brozzler.MAX_PAGE_FAILURES:
-                    self.logger.info(
-                        'marking page "completed" after several unexpected '
-                        "exceptions attempting to brozzle",
-                        failed_attempts=page.failed_attempts,
-                        page=page,
-                    )
-                    self._frontier.completed_page(site, page)
-                    page = None
-                else:
-                    page.save()
+                page = self._note_page_failure(site, page, e)
         finally:
+            if self._status_feed:
+                self._status_feed.unwatch(site)
+            if session:
+                self._stop_tab_threads(session)
+                if session.failure and session.failure[0]:
+                    # a page failed in another tab while this thread was
+                    # failing for some other reason, so it's still claimed
+                    failed_page, _ = session.failure
+                    failed_page.claimed = False
+                    self._frontier.save_page(failed_page)
             if start:
                 site.active_brozzling_time = (
                     (site.active_brozzling_time or 0) + time.time() - start
                 )
-            self._frontier.disclaim_site(site, page)
+            if self._completion_pipeline:
+                try:
+                    self._completion_pipeline.flush(site.id)
+                except brozzler.frontier.PagesNotSaved:
+                    site_logger.exception("brozzled pages not saved")
+            self._frontier.disclaim_site(
+                site, page, reclaim_after, nothing_to_claim=nothing_to_claim
+            )
+
+    def _brozzle_claimed_page(self, browser, site, page, session=None):
+        if page.needs_robots_check and not brozzler.is_permitted_by_robots(
+            site, page.url, self._proxy_for(site)
+        ):
+            self.logger.warning("page is blocked by robots.txt", url=page.url)
+            page.blocked_by_robots = True
+            self._complete_page(site, page, session=session)
+        else:
+            outlinks = self.brozzle_page(
+                browser, site, page, enable_youtube_dl=not self._skip_youtube_dl
+            )
+            self._complete_page(site, page, outlinks, session=session)
+
+    def _note_cookies(self, browser, site):
+        try:
+            cookies = browser.get_cookies()
+        except (brozzler.browser.BrowsingTimeout, brozzler.browser.DevtoolsError):
+            self.logger.warning("failed to get cookies", site=site, exc_info=True)
+            return
+        if site.note_browser_cookies(cookies):
+            self.logger.debug("cookies changed", site=site, cookie_count=len(cookies))
+
+    def _note_page_failure(self, site, page, error=None):
+        """
+        Schedules another attempt at brozzling a page that failed with
+        `error`, or gives up on it after `brozzler.MAX_PAGE_FAILURES`
+        attempts.
+
+        Returns:
+            the page, or None if it was given up on and marked completed
+        """
+        self._defer_page(page, self._failure_kind(error))
+        page.failed_attempts = (page.failed_attempts or 0) + 1
+        if page.failed_attempts >= brozzler.MAX_PAGE_FAILURES:
+            self.logger.info(
+                'marking page "completed" after several unexpected '
+                "exceptions attempting to brozzle",
+                failed_attempts=page.failed_attempts,
+                page=page,
+            )
+            self._frontier.completed_page(site, page)
+            return None
+        self._frontier.save_page(page)
+        return page
+
+    @staticmethod
+    def _failure_kind(error):
+        """Returns the key of `PAGE_RETRY_BACKOFF` that applies to `error`."""
+        if isinstance(error, brozzler.PageConnectionError):
+            return "connection"
+        if isinstance(error, brozzler.browser.BrowsingException):
+            return "browser"
+        return "other"
+
+    def _defer_page(self, page, kind):
+        """
+        Sets `page.retry_after` according to `PAGE_RETRY_BACKOFF[kind]` and
+        the number of times the page has failed so far. The page is saved
+        when it's disclaimed.
+        """
+        first, factor, longest = self.PAGE_RETRY_BACKOFF[kind]
+        retry_delay = min(longest, first * (factor ** (page.failed_attempts or 0)))
+        page.retry_after = doublethink.utcnow() + datetime.timedelta(
+            seconds=retry_delay
+        )
+        metrics.brozzler_page_retries_scheduled.labels(kind=kind).inc()
+
+    def _page_concurrency(self, site):
+        return max(1, min(site.page_concurrency or 1, self._max_page_concurrency))
+
+    def _check_site(self, site, session=None):
+        """
+        Raises if a stop has been requested or the site's time limit has been
+        reached. Only the site fields that may have been changed elsewhere
+        are refreshed, in place, so other tabs can keep reading the site.
+        """
+        with session.lock if session else contextlib.nullcontext():
+            self._frontier.honor_stop_request(site, status_feed=self._status_feed)
+            self._frontier.enforce_time_limit(site)
+
+    def _watch_site(self, site, session=None):
+        threads = [threading.current_thread()]
+        if session:
+            threads.extend(session.threads)
+
+        def on_stop():
+            self.logger.info("stop requested, interrupting brozzling", site=site)
+            for th in threads:
+                if th.is_alive():
+                    brozzler.thread_raise(th, brozzler.CrawlStopped)
+
+        self._status_feed.watch(site, on_stop)
+
+    def _start_tab_threads(self, browser, site, session, n, start):
+        """
+        Opens up to `n` more tabs in `browser`, each brozzling pages of `site`
+        in its own thread until the site session ends.
+        """
+        self._start_browser(browser, site)
+        for i in range(n):
+            try:
+                tab = browser.open_tab()
+            except brozzler.browser.BrowsingException:
+                self.logger.warning(
+                    "failed to open browser tab, brozzling fewer pages at once",
+                    site=site,
+                    exc_info=True,
+                )
+                break
+            session.tabs.append(tab)
+            th = threading.Thread(
+                target=self._brozzle_tab_thread_target,
+                args=(tab, site, session, start),
+                name="BrozzlingThread:%s:%s" % (browser.browser_id, i + 1),
+                daemon=True,
+            )
+            session.threads.append(th)
+            with self._browsing_threads_lock:
+                self._browsing_threads.add(th)
+            th.start()
+
+    def _stop_tab_threads(self, session):
+        # tabs finish the pages they are brozzling, and are closed from this
+        # thread, because closing them sends commands through `browser`
+        session.stop.set()
+        for th in session.threads:
+            th.join()
+        for tab in session.tabs:
+            tab.stop()
+
+    def _brozzle_tab_thread_target(self, tab, site, session, start):
+        try:
+            self._brozzle_pages_in_tab(tab, site, session, start)
+        finally:
+            with self._browsing_threads_lock:
+                self._browsing_threads.remove(threading.current_thread())
+
+    def _brozzle_pages_in_tab(self, tab, site, session, start):
+        worker_id = "%s:%s" % (socket.gethostname(), tab.browser_id)
+        page = None
+        try:
+            while (
+                not session.stop.is_set()
+                and time.time() - start < self.SITE_SESSION_MINUTES * 60
+            ):
+                page = self._claim_page(site, worker_id, session)
+                if page is None:
+                    return
+                with session.host_slots.hold(page.url):
+                    self._brozzle_claimed_page(tab, site, page, session)
+                with session.lock:
+                    session.page_ids.discard(page.id)
+                page = None
+        except brozzler.NothingToClaim:
+            pass
+        except (brozzler.ShutdownRequested, brozzler.CrawlStopped):
+            # the site's thread gets the same exception
+            session.stop.set()
+        except Exception as e:
+            if session.fail(page, e):
+                # the site's thread handles it
+                page = None
+            else:
+                self.logger.exception("exception in browser tab", page=page)
+        finally:
+            if page:
+                with session.lock:
+                    session.page_ids.discard(page.id)
+                page.claimed = False
+                self._frontier.save_page(page)
+
+    def _claim_page(self, site, worker_id, session=None):
+        """
+        Claims the site's next page. With a `session`, skips pages being
+        brozzled in other tabs, and waits for them to finish rather than
+        giving up on the site while they might still add outlinks.
+
+        If the hosts of the site's pages are over the host rate limit, waits
+        for them for up to `HOST_BUDGET_MAX_WAIT` seconds at a time.
+
+        Returns:
+            the page, or None if the session has been stopped
+
+        Raises:
+            brozzler.NothingToClaim: if the site has no pages left
+            brozzler.HostOverBudget: if the site has pages left, but not
+                within the host rate limit any time soon
+        """
+        if not session:
+            while True:
+                try:
+                    return self._claim_page_excluding(site, worker_id)
+                except brozzler.HostOverBudget as e:
+                    if e.wait > self.HOST_BUDGET_MAX_WAIT:
+                        raise
+                    brozzler.sleep(e.wait)
+        while not session.stop.is_set():
+            wait = 0.5
+            with session.lock:
+                try:
+                    page = self._claim_page_excluding(site, worker_id, session.page_ids)
+                    session.page_ids.add(page.id)
+                    return page
+                except brozzler.HostOverBudget as e:
+                    if e.wait > self.HOST_BUDGET_MAX_WAIT and not session.page_ids:
+                        raise
+                    wait = min(e.wait, self.HOST_BUDGET_MAX_WAIT)
+                except brozzler.NothingToClaim:
+                    if not session.page_ids:
+                        raise
+            brozzler.sleep(wait)
+        return None
+
+    def _claim_page_excluding(self, site, worker_id, exclude_page_ids=()):
+        exclude_page_ids = list(exclude_page_ids)
+        if not self._completion_pipeline:
+            return self._frontier.claim_page(
+                site,
+                worker_id,
+                exclude_page_ids=exclude_page_ids or None,
+                host_budget=self._host_budget,
+            )
+        try:
+            return self._frontier.claim_page(
+                site,
+                worker_id,
+                exclude_page_ids=exclude_page_ids
+                + self._completion_pipeline.pending_page_ids(site.id),
+                host_budget=self._host_budget,
+            )
+        except brozzler.HostOverBudget:
+            raise
+        except brozzler.NothingToClaim:
+            # outlinks of pages still in the pipeline may not be in rethinkdb
+            # yet, so wait for them before giving up on the site
+            if not self._completion_pipeline.pending_page_ids(site.id):
+                raise
+            self._completion_pipeline.flush(site.id)
+            return self._frontier.claim_page(
+                site,
+                worker_id,
+                exclude_page_ids=exclude_page_ids or None,
+                host_budget=self._host_budget,
+            )
+
+    def _complete_page(self, site, page, outlinks=None, session=None):
+        if session:
+            with session.lock:
+                self._complete_page(site, page, outlinks)
+        elif self._completion_pipeline:
+            self._completion_pipeline.submit(site, page, outlinks)
+        else:
+            self._frontier.completed_page(site, page)
+            if outlinks is not None:
+                self._frontier.scope_and_schedule_outlinks(site, page, outlinks)
 
     def _brozzle_site_thread_target(self, browser, site):
         try:
             self.brozzle_site(browser, site)
         finally:
-            browser.stop()
+            # stops the browser unless the pool keeps it warm for reuse
             self._browser_pool.release(browser)
             with self._browsing_threads_lock:
                 self._browsing_threads.remove(threading.current_thread())
@@ -760,6 +1432,37 @@ class BrozzlerWorker:
         if due:
             self._service_heartbeat()
 
+    def _claim_sites(self, n):
+        """
+        Claims up to `n` sites, from site leases if enabled and a lease
+        coordinator is running, otherwise directly.
+
+        Raises:
+            brozzler.NothingToClaim: if there are no sites to claim
+        """
+        start = time.time()
+        method = "direct"
+        try:
+            if self._lease_coordinator:
+                sites = self._frontier.claim_leased_sites(n)
+                if sites or self._lease_coordinator.coordinator_is_healthy():
+                    method = "lease"
+                    if not sites:
+                        raise brozzler.NothingToClaim
+                    return sites
+            return self._frontier.claim_sites(n)
+        finally:
+            metrics.brozzler_site_claim_duration_seconds.labels(method=method).observe(
+                time.time() - start
+            )
+
+    def _run_lease_coordinator_if_due(self):
+        if self._lease_coordinator:
+            try:
+                self._lease_coordinator.run_if_due()
+            except r.ReqlError:
+                self.logger.exception("problem refreshing site leases")
+
     def _start_browsing_some_sites(self):
         """
         Starts browsing some sites.
@@ -772,7 +1475,7 @@ class BrozzlerWorker:
             (self._browser_pool.num_available() + 1) // 2
         )
         try:
-            sites = self._frontier.claim_sites(len(browsers))
+            sites = self._claim_sites(len(browsers))
         except:
             self._browser_pool.release_all(browsers)
             raise
@@ -782,7 +1485,7 @@ class BrozzlerWorker:
                 th = threading.Thread(
                     target=self._brozzle_site_thread_target,
                     args=(browsers[i], sites[i]),
-                    name="BrozzlingThread:%s" % browsers[i].chrome.port,
+                    name="BrozzlingThread:%s" % browsers[i].browser_id,
                     daemon=True,
                 )
                 with self._browsing_threads_lock:
@@ -795,8 +1498,11 @@ class BrozzlerWorker:
         self.logger.warn("brozzler %s - brozzler-worker starting", brozzler.__version__)
         last_nothing_to_claim = 0
         try:
+            if self._status_feed:
+                self._status_feed.start()
             while not self._shutdown.is_set():
                 self._service_heartbeat_if_due()
+                self._run_lease_coordinator_if_due()
                 if time.time() - last_nothing_to_claim > 20:
                     try:
                         self._start_browsing_some_sites()
@@ -841,6 +1547,13 @@ class BrozzlerWorker:
             thredz = set(self._browsing_threads)
             for th in thredz:
                 th.join()
+            if self._screenshot_pool:
+                self._screenshot_pool.shutdown()
+            self._warcprox_writer.close()
+            if self._completion_pipeline:
+                self._completion_pipeline.stop()
+            if self._status_feed:
+                self._status_feed.stop()
 
     def start(self):
         with self._start_stop_lock:
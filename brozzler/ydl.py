@@ -188,35 +188,37 @@ def _build_youtube_dl(worker, destdir, site, page, ytdlp_proxy_endpoints):
             if url == "" or ".m3u8" in url:
                 return
 
-            size = os.path.getsize(info_dict["filepath"])
             self.logger.info(
                 "pushing video to warcprox",
                 format=info_dict["format"],
                 mimetype=mimetype,
-                size=size,
+                size=os.path.getsize(info_dict["filepath"]),
                 warcprox=worker._proxy_for(site),
             )
+            # streamed from disk, with a content-length header, because
+            # warcprox doesn't accept chunked transfer
             with open(info_dict["filepath"], "rb") as f:
-                # include content-length header to avoid chunked
-                # transfer, which warcprox currently rejects
-                extra_headers = dict(site.extra_headers())
-                extra_headers["content-length"] = size
-                request, response = worker._warcprox_write_record(
+                result = worker._warcprox_write_record(
                     warcprox_address=worker._proxy_for(site),
                     url=url,
                     warc_type="resource",
                     content_type=mimetype,
                     payload=f,
-                    extra_headers=extra_headers,
+                    extra_headers=site.extra_headers(),
                 )
+            self.logger.info(
+                "pushed video to warcprox",
+                url=url,
+                payload_digest=result.payload_digest,
+            )
 
             # consulted by _remember_videos()
             ydl.pushed_videos.append(
                 {
                     "url": url,
-                    "response_code": response.code,
+                    "response_code": result.status,
                     "content-type": mimetype,
-                    "content-length": size,
+                    "content-length": result.length,
                 }
             )
 
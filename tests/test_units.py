@@ -17,21 +17,33 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import base64
 import datetime
+import hashlib
 import http.server
+import io
+import json
 import os
 import socket
+import struct
 import tempfile
 import threading
 import time
+import urllib.parse
 import uuid
 from unittest import mock
 
+import doublethink
+import PIL.Image
 import pytest
+import urlcanon
 import yaml
 
 import brozzler
 import brozzler.chrome
+import brozzler.content_type
+import brozzler.politeness
+import brozzler.warcprox_writer
 import brozzler.ydl
 
 
@@ -175,6 +187,60 @@ def test_robots_connection_failure():
     assert brozzler.is_permitted_by_robots(site, url)
 
 
+def test_robots_cache():
+    fetches = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            fetches.append((self.path, self.headers.get("User-Agent")))
+            body = b"User-agent: badbot\nDisallow: /\n"
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = http.server.HTTPServer(("localhost", 0), Handler)
+    httpd_thread = threading.Thread(name="httpd", target=httpd.serve_forever)
+    httpd_thread.start()
+
+    orig_cache = brozzler.robots._robots_cache
+    brozzler.robots._robots_cache = brozzler.robots._RobotsCache(max_entries=2)
+    try:
+        url = "http://localhost:%s/" % httpd.server_port
+        site1 = brozzler.Site(None, {"id": "1", "seed": url})
+        site2 = brozzler.Site(None, {"id": "2", "seed": url})
+        assert brozzler.is_permitted_by_robots(site1, url + "a")
+        assert brozzler.is_permitted_by_robots(site2, url + "b")
+        # same host and user-agent, fetched once for both sites
+        assert fetches == [("/robots.txt", mock.ANY)]
+
+        bad_site = brozzler.Site(None, {"seed": url, "user_agent": "a badbot"})
+        assert not brozzler.is_permitted_by_robots(bad_site, url)
+        assert len(fetches) == 2
+        assert fetches[1][1] == "a badbot"
+        assert len(brozzler.robots._robots_cache) == 2
+
+        # lru eviction
+        other_site = brozzler.Site(None, {"seed": url, "user_agent": "other"})
+        assert brozzler.is_permitted_by_robots(other_site, url)
+        assert len(brozzler.robots._robots_cache) == 2
+        assert brozzler.is_permitted_by_robots(site1, url)
+        assert len(fetches) == 4
+
+        # expired rules are refetched
+        with mock.patch("time.time", return_value=time.time() + 7200):
+            assert brozzler.is_permitted_by_robots(site1, url)
+        assert len(fetches) == 5
+    finally:
+        brozzler.robots._robots_cache = orig_cache
+        httpd.shutdown()
+        httpd.server_close()
+        httpd_thread.join()
+
+
 def test_scoping():
     test_scope = yaml.safe_load(
         r"""
@@ -259,6 +325,100 @@ blocks:
     )
 
 
+def test_compiled_scope():
+    rules = yaml.safe_load(
+        r"""
+- ssurt: com,example,//http:/foo
+- ssurt: com,example,www,//https:/
+  exact: true
+- surt: http://(org,archive,
+- domain: example.net
+- domain: 127.0.0.1
+- domain: example.org
+  exact: true
+- substring: /wp-admin/
+- regex: ^https?://[^/]*\.gov/.*$
+- regex: ^.*\?page=(\d+)&p=\1$
+- regex: ^.*\.(?:jpg|png)$
+- domain: example.edu
+  substring: /private/
+- regex: ^https?://(www.)?youtube.com/watch?.*$
+  parent_url_regex: ^https?://(www.)?youtube.com/user/.*$
+"""
+    )
+    urls = [
+        "http://example.com/foo/bar",
+        "http://example.com/fo",
+        "https://example.com/foo/bar",
+        "https://www.example.com/",
+        "https://www.example.com/x",
+        "http://archive.org/",
+        "http://web.archive.org/web/",
+        "http://archive.org.evil.com/",
+        "http://example.net/",
+        "http://a.b.example.net/",
+        "http://notexample.net/",
+        "http://127.0.0.1:8080/",
+        "http://127.0.0.10/",
+        "http://example.org/",
+        "http://www.example.org/",
+        "http://foo.com/wp-admin/",
+        "http://whitehouse.gov/a",
+        "http://whitehouse.gov.uk/a",
+        "http://foo.com/?page=3&p=3",
+        "http://foo.com/?page=3&p=4",
+        "http://foo.com/a.png",
+        "http://example.edu/private/a",
+        "http://example.edu/public/a",
+        "https://www.youtube.com/watch?v=dUIn5OAPS5s",
+    ]
+    parents = [
+        None,
+        brozzler.Page(None, {"url": "https://www.youtube.com/user/foo"}),
+        brozzler.Page(
+            None,
+            {
+                "url": "http://example.com/",
+                "redirect_url": "https://youtube.com/user/foo",
+            },
+        ),
+    ]
+
+    def reference(url, parent_page):
+        url = urlcanon.semantic(url)
+        parent_urls = []
+        if parent_page:
+            parent_urls.append(urlcanon.semantic(parent_page.url))
+            if parent_page.redirect_url:
+                parent_urls.append(urlcanon.semantic(parent_page.redirect_url))
+        for rule_dict in rules:
+            rule = urlcanon.MatchRule(**rule_dict)
+            if parent_urls:
+                if any(rule.applies(url, p) for p in parent_urls):
+                    return True
+            elif rule.applies(url):
+                return True
+        return None
+
+    site = brozzler.Site(None, {"seed": "http://seed.test/", "scope": {}})
+    site.scope["accepts"] = list(rules)
+    for url in urls:
+        for parent_page in parents:
+            assert site.accept_reject_or_neither(url, parent_page) == reference(
+                url, parent_page
+            ), (url, parent_page and parent_page.url)
+
+    # the compiled scope is reused until the rules change
+    compiled = site.compiled_scope()
+    assert site.compiled_scope() is compiled
+    assert site.accept_reject_or_neither("http://other.test/") is None
+    site.scope["accepts"].append({"domain": "other.test"})
+    assert site.accept_reject_or_neither("http://other.test/") is True
+    assert site.compiled_scope() is not compiled
+    site.scope["blocks"] = [{"substring": "other"}]
+    assert site.accept_reject_or_neither("http://other.test/") is False
+
+
 # Some changes to the brozzler ydl interface not represented in this test
 # https://github.com/internetarchive/brozzler/issues/330
 @pytest.mark.xfail
@@ -278,6 +438,54 @@ def test_ydl_proxy_down():
                 brozzler.ydl.do_youtube_dl(worker, site, page)
 
 
+def test_fetch_connection_reuse():
+    connections = []
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            connections.append(self.client_address)
+
+        def do_GET(self):
+            body = b"<html>hi</html>"
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = http.server.ThreadingHTTPServer(("localhost", 0), Handler)
+    httpd_thread = threading.Thread(name="httpd", target=httpd.serve_forever)
+    httpd_thread.start()
+    try:
+        worker = brozzler.BrozzlerWorker(frontier=None)
+        site = brozzler.Site(None, {"seed": "http://localhost/"})
+        for path in ("/a", "/b", "/c"):
+            page = brozzler.Page(
+                None, {"url": "http://localhost:%s%s" % (httpd.server_port, path)}
+            )
+            headers = worker._get_page_headers(site, page)
+            assert headers["content-type"] == "text/html"
+        assert len(connections) == 1
+
+        for path in ("/a", "/b", "/c"):
+            worker._fetch_url(
+                site, url="http://localhost:%s%s" % (httpd.server_port, path)
+            )
+        assert len(connections) == 2
+        assert worker._http_pool(None) is worker._http_pool(None)
+        assert worker._http_pool("localhost:1") is not worker._http_pool(None)
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        httpd_thread.join()
+
+
 def test_proxy_down():
     """
     Test all fetching scenarios raise `brozzler.ProxyError` when proxy is down.
@@ -519,6 +727,103 @@ def test_needs_browsing():
     assert not brozzler.worker.BrozzlerWorker._needs_browsing(None, page, spy.fetches)
 
 
+def test_content_type_predictor():
+    predictor = brozzler.content_type.ContentTypePredictor(min_observations=2)
+    assert not predictor.predicts_html("http://example.com/")
+    assert predictor.predicts_html("http://example.com/index.html")
+    assert not predictor.predicts_html("http://example.com/a.pdf")
+    assert not predictor.predicts_html("ftp://example.com/a.html")
+
+    predictor.observe("http://example.com/a", "text/html; charset=utf-8")
+    assert not predictor.predicts_html("http://example.com/b")
+    predictor.observe("http://example.com/b", "text/html")
+    assert predictor.predicts_html("http://example.com/c")
+    assert predictor.predicts_html("http://example.com/d/")
+    # other hosts and extensions are separate
+    assert not predictor.predicts_html("http://www.example.com/c")
+    assert not predictor.predicts_html("http://example.com/c.php")
+
+    # anything other than html starts over
+    predictor.observe("http://example.com/e", "application/pdf")
+    assert not predictor.predicts_html("http://example.com/f")
+    predictor.observe("http://example.com/page.html", "image/png")
+    assert not predictor.predicts_html("http://example.com/index.html")
+
+    worker = brozzler.BrozzlerWorker(frontier=None, predict_content_type=True)
+    for path in ("/f", "/g", "/h"):
+        worker._content_type_predictor.observe("http://example.com" + path, "text/html")
+    page = brozzler.Page(None, {"url": "http://example.com/i"})
+    site = brozzler.Site(None, {"seed": "http://example.com/"})
+    assert worker._can_skip_page_headers(site, page)
+    site = brozzler.Site(None, {"seed": "http://example.com/", "pdfs_only": True})
+    assert not worker._can_skip_page_headers(site, page)
+    assert not brozzler.BrozzlerWorker(frontier=None)._can_skip_page_headers(site, page)
+
+
+def test_filter_claimable_site_ids_job_counts():
+    long_ago = datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc)
+    sites = [
+        {
+            "id": str(i),
+            "claimed": False,
+            "last_disclaimed": long_ago,
+            "job_id": i % 2,
+            "max_claimed_sites": 2,
+        }
+        for i in range(6)
+    ]
+    # job 0 already has a site claimed somewhere, job 1 has none
+    assert brozzler.frontier.filter_claimable_site_ids(
+        sites, 20, max_sites_to_claim=6, job_counts={0: 1}
+    ) == ["0", "1", "3"]
+    assert brozzler.frontier.filter_claimable_site_ids(
+        sites, 20, max_sites_to_claim=6
+    ) == ["0", "1", "2", "3"]
+
+
+def test_site_lease_claims():
+    frontier = mock.Mock()
+    registry = mock.Mock()
+    worker = brozzler.BrozzlerWorker(
+        frontier=frontier, service_registry=registry, site_leases=True
+    )
+    site = brozzler.Site(None, {"seed": "http://example.com/"})
+
+    frontier.claim_leased_sites.return_value = [site]
+    assert worker._claim_sites(2) == [site]
+    frontier.claim_leased_sites.assert_called_with(2)
+    frontier.claim_sites.assert_not_called()
+
+    # no leases, but the coordinator is up, so there is nothing to claim
+    frontier.claim_leased_sites.return_value = []
+    registry.unique_service.return_value = {"id": "coordinator"}
+    with pytest.raises(brozzler.NothingToClaim):
+        worker._claim_sites(2)
+    frontier.claim_sites.assert_not_called()
+
+    # no coordinator, fall back to claiming directly
+    registry.unique_service.return_value = None
+    frontier.claim_sites.return_value = [site]
+    assert worker._claim_sites(2) == [site]
+    frontier.claim_sites.assert_called_with(2)
+
+    coordinator = brozzler.frontier.SiteLeaseCoordinator(frontier, registry)
+    sites_by_id = {
+        "a1": {"job_id": "a"},
+        "a2": {"job_id": "a"},
+        "a3": {"job_id": "a"},
+        "b1": {"job_id": "b"},
+        "c1": {},
+    }
+    assert coordinator._take_turns(["a1", "a2", "a3", "b1", "c1"], sites_by_id) == [
+        "a1",
+        "b1",
+        "c1",
+        "a2",
+        "a3",
+    ]
+
+
 def test_seed_redirect():
     site = brozzler.Site(None, {"seed": "http://foo.com/"})
     site.note_seed_redirect("https://foo.com/a/b/c")
@@ -568,6 +873,7 @@ def test_limit_failures():
     site = mock.Mock()
     site.status = "ACTIVE"
     site.active_brozzling_time = 0
+    site.page_concurrency = None
     site.starts_and_stops = [{"start": datetime.datetime.now(datetime.timezone.utc)}]
 
     rr = mock.Mock()
@@ -588,6 +894,10 @@ def test_limit_failures():
     frontier.honor_stop_request = mock.Mock()
     frontier.claim_page = mock.Mock(return_value=page)
     frontier._maybe_finish_job = mock.Mock()
+    frontier.save_page = mock.Mock()
+    frontier.site_stats = mock.Mock(
+        return_value={"queued": 0, "claimed": 0, "brozzled": 1}
+    )
 
     browser = mock.Mock()
 
@@ -612,3 +922,806 @@ def test_limit_failures():
     assert page.failed_attempts == 3
     assert page.brozzle_count == 1
     assert site.status == "FINISHED"
+
+
+def test_browser_wait_for_wakes_on_message():
+    browser = brozzler.Browser(chrome_exe="chromium-browser")
+    browser.websock_thread = brozzler.browser.WebsockReceiverThread(mock.Mock())
+    browser.websock_thread.expect_result(1)
+
+    timer = threading.Timer(
+        0.1,
+        browser.websock_thread._on_message,
+        (None, '{"id":1,"result":{"result":{"value":"ok"}}}'),
+    )
+    start = time.time()
+    timer.start()
+    browser._wait_for(lambda: browser.websock_thread.received_result(1), timeout=5)
+    assert time.time() - start < 0.4
+    assert browser.websock_thread.pop_result(1)["result"]["result"]["value"] == "ok"
+
+    with pytest.raises(brozzler.browser.BrowsingTimeout):
+        browser._wait_for(lambda: False, timeout=0.2)
+
+    # network idle is noticed as soon as idle_time has passed
+    browser.websock_thread.last_network_activity = time.time()
+    start = time.time()
+    browser._wait_for_idle(idle_time=0.2, timeout=4)
+    assert 0.2 <= time.time() - start < 0.5
+
+
+def test_browser_commands_in_flight():
+    browser = brozzler.Browser(chrome_exe="chromium-browser")
+    browser.websock = mock.Mock()
+    browser.websock_thread = brozzler.browser.WebsockReceiverThread(browser.websock)
+
+    url_future = browser.send_command(
+        "Runtime.evaluate", {"expression": "document.URL"}
+    )
+    metrics_future = browser.send_command("Page.getLayoutMetrics")
+    bad_future = browser.send_command("Bogus.method")
+    sent = [json.loads(c.args[0]) for c in browser.websock.send.call_args_list]
+    assert [m["method"] for m in sent] == [
+        "Runtime.evaluate",
+        "Page.getLayoutMetrics",
+        "Bogus.method",
+    ]
+    assert len({m["id"] for m in sent}) == 3
+
+    # responses arrive in any order
+    thread = browser.websock_thread
+    thread._on_message(None, json.dumps({"id": sent[2]["id"], "error": {"code": 1}}))
+    thread._on_message(
+        None, json.dumps({"id": sent[1]["id"], "result": {"contentSize": {}}})
+    )
+    thread._on_message(
+        None,
+        json.dumps({"id": sent[0]["id"], "result": {"result": {"value": "http://a/"}}}),
+    )
+    assert browser._url_from(browser.result(url_future)) == "http://a/"
+    assert browser.result(metrics_future)["result"] == {"contentSize": {}}
+    with pytest.raises(brozzler.browser.DevtoolsError):
+        browser.result(bad_future)
+    assert thread._futures == {}
+
+    with pytest.raises(brozzler.browser.BrowsingTimeout):
+        browser.result(browser.send_command("Page.enable"), timeout=0.1)
+    assert thread._futures == {}
+
+
+def test_browser_pool_reuse():
+    pool = brozzler.BrowserPool(
+        2, reuse_browsers=True, max_pages_per_browser=2, chrome_exe="chromium-browser"
+    )
+
+    def fresh_browser():
+        browser = mock.Mock(pages_browsed=0, started_at=time.time())
+        browser.is_running.return_value = True
+        browser.reset.return_value = True
+        return browser
+
+    pool._fresh_browser = fresh_browser
+
+    browser1 = pool.acquire()
+    pool.release(browser1)
+    browser1.reset.assert_called_once()
+    browser1.stop.assert_not_called()
+    assert pool.num_idle() == 1
+    assert pool.num_available() == 2
+
+    # warm browser is handed out again
+    assert pool.acquire() is browser1
+    assert pool.num_idle() == 0
+
+    # retired after max_pages_per_browser
+    browser1.pages_browsed = 2
+    pool.release(browser1)
+    browser1.stop.assert_called_once()
+    assert pool.num_idle() == 0
+
+    # stopped if it can't be reset
+    browser2 = pool.acquire()
+    assert browser2 is not browser1
+    browser2.reset.return_value = False
+    pool.release(browser2)
+    browser2.stop.assert_called_once()
+    assert pool.num_idle() == 0
+
+    # idle browsers are stopped at shutdown
+    browser3, browser4 = pool.acquire_multi(2)
+    with pytest.raises(brozzler.browser.NoBrowsersAvailable):
+        pool.acquire()
+    pool.release_all([browser3, browser4])
+    assert pool.num_idle() == 2
+    pool.shutdown_now()
+    browser3.stop.assert_called_once()
+    browser4.stop.assert_called_once()
+    assert pool.num_idle() == 0
+
+
+def test_site_page_queue():
+    queue = brozzler.frontier._SitePageQueue("test_site_page_queue:0")
+    assert queue.pop() is None
+    assert queue.floor() is None
+
+    def page(url, priority):
+        return brozzler.Page(
+            None, {"site_id": "site1", "url": url, "priority": priority}
+        )
+
+    queue.push(page("http://example.com/a", 5))
+    queue.push(page("http://example.com/b", 10))
+    queue.push(page("http://example.com/c", 1))
+    assert len(queue) == 3
+    assert queue.floor() == 1
+
+    # re-pushing replaces the queued copy, e.g. when priority was bumped
+    queue.push(page("http://example.com/c", 20))
+    assert len(queue) == 3
+    assert queue.floor() == 5
+
+    assert queue.pop().url == "http://example.com/c"
+    assert queue.pop().url == "http://example.com/b"
+    assert brozzler.Page.compute_id("site1", "http://example.com/a") in queue
+    assert queue.drain() == [brozzler.Page.compute_id("site1", "http://example.com/a")]
+    assert len(queue) == 0
+    assert queue.pop() is None
+
+
+def test_brozzle_site_in_tabs():
+    pages = [
+        mock.Mock(id=i, url="http://%s/%s" % (host, i), needs_robots_check=False)
+        for i, host in enumerate(["a", "b", "a", "b", "a", "b"])
+    ]
+    remaining = list(pages)
+    lock = threading.Lock()
+
+    def claim_page(site, worker_id, exclude_page_ids=None, host_budget=None):
+        with lock:
+            for page in remaining:
+                if page.id not in (exclude_page_ids or ()):
+                    return page
+        raise brozzler.NothingToClaim
+
+    def completed_page(site, page):
+        with lock:
+            remaining.remove(page)
+
+    frontier = mock.Mock()
+    frontier.claim_page = mock.Mock(side_effect=claim_page)
+    frontier.completed_page = mock.Mock(side_effect=completed_page)
+
+    site = mock.Mock(page_concurrency=3, cookie_db=None, active_brozzling_time=0)
+    tabs = [mock.Mock(), mock.Mock()]
+    browser = mock.Mock()
+    browser.chrome.port = 9222
+    browser.proxy = None
+    browser.open_tab = mock.Mock(side_effect=tabs)
+    browser.get_cookies = mock.Mock(return_value=[])
+
+    in_progress = {}
+    max_in_progress = []
+    max_per_host = []
+
+    def brozzle_page(browser, site, page, **kwargs):
+        host = urllib.parse.urlsplit(page.url).hostname
+        with lock:
+            in_progress[host] = in_progress.get(host, 0) + 1
+            max_in_progress.append(sum(in_progress.values()))
+            max_per_host.append(in_progress[host])
+        time.sleep(0.1)
+        with lock:
+            in_progress[host] -= 1
+        return set()
+
+    worker = brozzler.BrozzlerWorker(frontier, max_pages_per_host=1)
+    worker._proxy_for = mock.Mock(return_value=None)
+    worker.brozzle_page = mock.Mock(side_effect=brozzle_page)
+    worker.brozzle_site(browser, site)
+
+    assert remaining == []
+    assert worker.brozzle_page.call_count == 6
+    # pages of the same host are not brozzled at the same time
+    assert max(max_in_progress) == 2
+    assert max(max_per_host) == 1
+    assert len({call.args[0] for call in worker.brozzle_page.call_args_list}) > 1
+    for tab in tabs:
+        tab.stop.assert_called_once()
+    frontier.disclaim_site.assert_called_once_with(
+        site, None, None, nothing_to_claim=True
+    )
+    assert not worker._browsing_threads
+
+
+def test_brozzle_site_in_tabs_failing_together():
+    pages = [
+        mock.Mock(
+            id=i,
+            url="http://%s/" % host,
+            needs_robots_check=False,
+            failed_attempts=0,
+            claimed=True,
+        )
+        for i, host in enumerate(["a", "b"])
+    ]
+    lock = threading.Lock()
+
+    def claim_page(site, worker_id, exclude_page_ids=None, host_budget=None):
+        with lock:
+            for page in pages:
+                if page.id not in (exclude_page_ids or ()):
+                    return page
+        raise brozzler.NothingToClaim
+
+    frontier = mock.Mock()
+    frontier.claim_page = mock.Mock(side_effect=claim_page)
+    site = mock.Mock(page_concurrency=2, cookie_db=None, active_brozzling_time=0)
+    tab = mock.Mock()
+    browser = mock.Mock()
+    browser.chrome.port = 9222
+    browser.proxy = None
+    browser.open_tab = mock.Mock(return_value=tab)
+    both_brozzling = threading.Barrier(2)
+
+    def brozzle_page(b, site, page, **kwargs):
+        both_brozzling.wait(timeout=5)
+        if b is browser:
+            # fail in the site's thread just after the tab has failed
+            time.sleep(0.2)
+        raise Exception("boom")
+
+    worker = brozzler.BrozzlerWorker(frontier)
+    worker._proxy_for = mock.Mock(return_value=None)
+    worker.brozzle_page = mock.Mock(side_effect=brozzle_page)
+    worker.brozzle_site(browser, site)
+
+    # one failure is handled by the site's thread, and the page of the other
+    # isn't left claimed
+    (site_page,) = [p for p in pages if p.failed_attempts == 1]
+    (tab_page,) = [p for p in pages if p is not site_page]
+    frontier.disclaim_site.assert_called_once_with(
+        site, site_page, None, nothing_to_claim=False
+    )
+    assert tab_page.claimed is False
+    frontier.save_page.assert_any_call(tab_page)
+
+
+def test_context_browsers():
+    pool = brozzler.BrowserPool(2, shared_chrome=True, chrome_exe="chromium-browser")
+    shared_chrome = pool._shared_chrome
+    shared_chrome.chrome = mock.Mock(port=9222, chrome_exe="chromium-browser")
+    shared_chrome.chrome.page_websocket_url = lambda target_id: (
+        "ws://localhost:9222/devtools/page/%s" % target_id
+    )
+    browser_target = mock.Mock()
+    browser_target.is_running.return_value = True
+    responses = iter(
+        [
+            {"result": {"browserContextId": "context1"}},
+            {"result": {"targetId": "target1"}},
+            {"result": {"browserContextId": "context2"}},
+            {"result": {"targetId": "target2"}},
+            {"result": {}},
+        ]
+    )
+    calling_threads = []
+
+    def call(method, params):
+        calling_threads.append(browser_target.websock_thread.calling_thread)
+        return next(responses)
+
+    browser_target._call.side_effect = call
+    shared_chrome._browser_target = browser_target
+
+    browsers = pool.acquire_multi(2)
+    assert all(isinstance(b, brozzler.browser.ContextBrowser) for b in browsers)
+    with mock.patch.object(brozzler.browser.ContextBrowser, "_connect"):
+        browsers[0].start(proxy="localhost:8000", window_height=900)
+        browsers[1].start()
+    # chrome was already running, and is shared
+    shared_chrome.chrome.start.assert_not_called()
+    assert browsers[0].chrome is browsers[1].chrome
+    assert browsers[0].websock_url == "ws://localhost:9222/devtools/page/target1"
+    assert browsers[0].proxy == "localhost:8000"
+    assert browser_target._call.call_args_list[:2] == [
+        mock.call("Target.createBrowserContext", {"proxyServer": "localhost:8000"}),
+        mock.call(
+            "Target.createTarget",
+            {"url": "about:blank", "browserContextId": "context1"},
+        ),
+    ]
+    assert browser_target._call.call_args_list[2] == mock.call(
+        "Target.createBrowserContext", {}
+    )
+    # errors from the shared browser target's websocket are raised in the
+    # thread using it at the time, and each browser has an id of its own
+    assert calling_threads == [threading.current_thread()] * 4
+    assert browser_target.websock_thread.calling_thread is None
+    assert [b.browser_id for b in browsers] == ["9222.1", "9222.2"]
+
+    # releasing a browser disposes of its context but leaves chrome running
+    pool.release(browsers[0])
+    assert not browsers[0].is_running()
+    assert browser_target._call.call_args == mock.call(
+        "Target.disposeBrowserContext", {"browserContextId": "context1"}
+    )
+    shared_chrome.chrome.stop.assert_not_called()
+    assert browsers[1].is_running()
+
+
+def test_site_browser_cookies():
+    site = brozzler.Site(None, {"seed": "http://example.com/", "cookie_db": b"SQLite"})
+    assert site.browser_cookies() == []
+
+    cookies = [
+        {
+            "name": "b",
+            "value": "2",
+            "domain": "example.com",
+            "path": "/",
+            "expires": -1,
+            "size": 2,
+            "httpOnly": False,
+            "secure": False,
+            "session": True,
+            "priority": "Medium",
+        },
+        {
+            "name": "a",
+            "value": "1",
+            "domain": ".example.com",
+            "path": "/",
+            "expires": 1900000000.5,
+            "size": 2,
+            "httpOnly": True,
+            "secure": True,
+            "session": False,
+            "sameSite": "Lax",
+        },
+    ]
+    assert site.note_browser_cookies(cookies)
+    assert "cookie_db" not in site
+    assert isinstance(site.cookies, bytes)
+    assert site.browser_cookies() == [
+        {
+            "name": "a",
+            "value": "1",
+            "domain": ".example.com",
+            "path": "/",
+            "expires": 1900000000.5,
+            "httpOnly": True,
+            "secure": True,
+            "sameSite": "Lax",
+        },
+        {
+            "name": "b",
+            "value": "2",
+            "domain": "example.com",
+            "path": "/",
+            "httpOnly": False,
+            "secure": False,
+            "priority": "Medium",
+        },
+    ]
+
+    # same cookies in a different order are not a change
+    stored = site.cookies
+    assert not site.note_browser_cookies(list(reversed(cookies)))
+    assert site.cookies is stored
+    # nor are they for a freshly loaded site
+    site = brozzler.Site(None, {"seed": "http://example.com/", "cookies": stored})
+    assert not site.note_browser_cookies(cookies)
+
+    cookies[1]["value"] = "changed"
+    assert site.note_browser_cookies(cookies)
+    assert site.browser_cookies()[0]["value"] == "changed"
+
+
+def test_completion_pipeline_failures():
+    def save_pages(completions):
+        page_ids = {page.id for _, page, _, _ in completions}
+        if "page1" in page_ids:
+            raise brozzler.frontier.PagesNotSaved({"page1"}, Exception("oops"))
+        if "page3" in page_ids:
+            raise RuntimeError("bug")
+
+    frontier = mock.Mock()
+    frontier._save_pages.side_effect = save_pages
+    pipeline = brozzler.frontier.CompletionPipeline(frontier)
+    site = mock.Mock(id="site1")
+    pages = [mock.Mock(id="page%s" % i) for i in range(4)]
+
+    # pages that weren't written stay pending until the failure is raised
+    pipeline.submit(site, pages[0])
+    pipeline.submit(site, pages[1])
+    assert pipeline.flush()
+    assert pipeline.pending_page_ids(site.id) == ["page1"]
+    with pytest.raises(brozzler.frontier.PagesNotSaved) as excinfo:
+        pipeline.submit(site, pages[2])
+    assert excinfo.value.page_ids == {"page1"}
+    assert pipeline.pending_page_ids(site.id) == []
+
+    pipeline.submit(site, pages[2])
+    pipeline.flush(site.id)
+    pipeline.submit(site, pages[3])
+    with pytest.raises(brozzler.frontier.PagesNotSaved) as excinfo:
+        pipeline.flush(site.id)
+    assert excinfo.value.page_ids == {"page3"}
+    assert isinstance(excinfo.value.error, RuntimeError)
+    pipeline.stop()
+
+
+def test_site_status_feed():
+    frontier = mock.Mock(SITE_CONTROL_FIELDS=("status", "stop_requested", "time_limit"))
+    frontier.refresh_site_control_fields.return_value = None
+    feed = brozzler.frontier.SiteStatusFeed(frontier)
+    site = brozzler.Site(
+        None, {"id": "site1", "job_id": "job1", "seed": "http://example.com/"}
+    )
+    site.status = "ACTIVE"
+    on_stop = mock.Mock()
+    feed.watch(site, on_stop)
+
+    # falls back to querying rethinkdb while the changefeed is not running
+    feed.refresh_site_control_fields(site)
+    assert frontier.refresh_site_control_fields.call_count == 2
+
+    feed._current = True
+    feed._apply({"table": "sites", "id": "site1", "status": "ACTIVE", "time_limit": 60})
+    feed._apply({"table": "sites", "id": "other", "status": "FINISHED"})
+    assert feed.refresh_site_control_fields(site) is None
+    assert frontier.refresh_site_control_fields.call_count == 2
+    assert site.time_limit == 60
+    on_stop.assert_not_called()
+
+    stop_requested = doublethink.utcnow()
+    feed._apply({"table": "jobs", "id": "job1", "stop_requested": stop_requested})
+    feed._apply({"table": "jobs", "id": "job1", "stop_requested": stop_requested})
+    on_stop.assert_called_once_with()
+    assert feed.refresh_site_control_fields(site) == stop_requested
+
+    feed.unwatch(site)
+    assert not feed._watched
+    assert not feed._job_stop_requested
+
+
+def test_new_job_streamed_seeds():
+    with tempfile.TemporaryDirectory(prefix="brzl-seeds-") as tmpdir:
+        jsonl = os.path.join(tmpdir, "seeds.jsonl")
+        with open(jsonl, "w") as f:
+            f.write('{"url": "http://one.example.org/", "time_limit": 30}\n')
+            f.write("\n")
+            f.write('"http://two.example.org/"\n')
+        yml = os.path.join(tmpdir, "seeds.yaml")
+        with open(yml, "w") as f:
+            f.write("url: http://one.example.org/\ntime_limit: 30\n---\n")
+            f.write("- http://two.example.org/\n")
+        expected = [
+            {"url": "http://one.example.org/", "time_limit": 30},
+            {"url": "http://two.example.org/"},
+        ]
+        assert list(brozzler.model.load_seeds_file(jsonl)) == expected
+        assert list(brozzler.model.load_seeds_file(yml)) == expected
+
+    # seeds are validated one at a time
+    seeds = brozzler.model._validated(
+        [{"url": "http://one.example.org/"}, {"url": "nope"}]
+    )
+    assert next(seeds) == {"url": "http://one.example.org/"}
+    with pytest.raises(brozzler.InvalidJobConf) as excinfo:
+        next(seeds)
+    assert excinfo.value.errors["seed number"] == 2
+
+    # batches are sized in bytes, and each inserts its pages before its sites
+    calls = []
+    lock = threading.Lock()
+
+    def record(name, key):
+        def call(docs):
+            with lock:
+                calls.append((name, [doc[key] for doc in docs]))
+            return mock.Mock()
+
+        return call
+
+    frontier = mock.Mock()
+    frontier.rr.table.return_value.insert = record("sites", "id")
+    frontier.insert_pages = record("pages", "site_id")
+    job = brozzler.Job(None, {"id": "job1"})
+    seed_confs = ({"url": "http://example.com/%s" % ("x" * 100 * i)} for i in range(50))
+    with mock.patch("brozzler.model.INSERT_BATCH_BYTES", 4000):
+        count = brozzler.model._insert_seeds(frontier, job, {}, seed_confs, 3)
+    assert count == 50
+    site_batches = [ids for name, ids in calls if name == "sites"]
+    assert 1 < len(site_batches) < 50
+    assert sum(len(ids) for ids in site_batches) == 50
+    for ids in site_batches:
+        assert calls.index(("pages", ids)) < calls.index(("sites", ids))
+
+    # the job is marked as seeding until its seeds are all queued, and marked
+    # failed, rather than left ACTIVE, if one of them is invalid
+    saved = []
+    with mock.patch.object(
+        brozzler.Job, "save", autospec=True, side_effect=lambda j: saved.append(dict(j))
+    ):
+        frontier = mock.Mock()
+        job = brozzler.new_job(
+            frontier, {"id": "job2"}, seeds=[{"url": "http://example.com/"}]
+        )
+        assert saved[-1]["seeding"] is True
+        frontier.seeded.assert_called_once_with(job)
+        frontier = mock.Mock()
+        with pytest.raises(brozzler.InvalidJobConf):
+            brozzler.new_job(
+                frontier,
+                {"id": "job3"},
+                seeds=[{"url": "http://example.com/"}, {"url": "nope"}],
+            )
+    assert frontier.seeding_failed.called
+    assert not frontier.seeded.called
+
+    # as it is if queuing the seeds fails any other way
+    with mock.patch.object(brozzler.Job, "save", autospec=True):
+        frontier = mock.Mock()
+        with mock.patch("brozzler.model._insert_seeds", side_effect=KeyboardInterrupt):
+            with pytest.raises(KeyboardInterrupt):
+                brozzler.new_job(
+                    frontier, {"id": "job4"}, seeds=[{"url": "http://example.com/"}]
+                )
+    frontier.seeding_failed.assert_called_once_with(mock.ANY, "KeyboardInterrupt()")
+    assert not frontier.seeded.called
+    job = brozzler.Job(None, {"id": "job3", "status": "SEEDING_FAILED"})
+    job.finish()
+    assert job.status == "FINISHED_SEEDING_FAILED"
+
+
+def test_screenshots_written_in_background():
+    records = []
+    drop_connection = threading.Event()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_WARCPROX_WRITE_RECORD(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            records.append((self.path, self.client_address[1], body))
+            self.send_response(204)
+            self.end_headers()
+            if drop_connection.is_set():
+                # closes without saying so, like an idle timeout
+                self.close_connection = True
+
+        def log_message(self, *args):
+            pass
+
+    httpd = http.server.ThreadingHTTPServer(("localhost", 0), Handler)
+    httpd_thread = threading.Thread(name="httpd", target=httpd.serve_forever)
+    httpd_thread.start()
+    address = "localhost:%s" % httpd.server_port
+    worker = brozzler.BrozzlerWorker(frontier=None, proxy=address)
+    page = brozzler.Page(None, {"url": "http://example.com/"})
+    screenshot = io.BytesIO()
+    PIL.Image.new("RGB", (1400, 2800), "red").save(screenshot, "jpeg")
+    try:
+        worker._screenshot_pool.submit(
+            page, worker._write_screenshot, address, "url", {}, screenshot.getvalue()
+        )
+        worker._screenshot_pool.wait(page)
+        assert [path for path, _, _ in records] == ["screenshot:url", "thumbnail:url"]
+        assert records[0][2] == screenshot.getvalue()
+        assert PIL.Image.open(io.BytesIO(records[1][2])).size == (300, 600)
+        # the connection is kept alive
+        assert records[0][1] == records[1][1]
+
+        # a connection closed by warcprox while idle is replaced
+        drop_connection.set()
+        for i in range(2):
+            worker._warcprox_write_record(address, "url%s" % i, "metadata", "a/b", b"x")
+        assert records[-1][0] == "url1"
+        assert records[-1][1] != records[-2][1]
+    finally:
+        worker._screenshot_pool.shutdown()
+        worker._warcprox_writer.close()
+        httpd.shutdown()
+        httpd.server_close()
+        httpd_thread.join()
+
+    # errors are raised when waiting for the page's screenshots
+    worker = brozzler.BrozzlerWorker(frontier=None, proxy=address)
+    worker._screenshot_pool.submit(
+        page, worker._write_screenshot, address, "url", {}, screenshot.getvalue()
+    )
+    with pytest.raises(brozzler.ProxyError):
+        worker._screenshot_pool.wait(page)
+    worker._screenshot_pool.wait(page)
+
+
+def test_warcprox_record_writer_streams_files():
+    records = []
+    reset_next = threading.Event()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_WARCPROX_WRITE_RECORD(self):
+            if reset_next.is_set():
+                reset_next.clear()
+                self.rfile.read(1)
+                self.connection.setsockopt(
+                    socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0)
+                )
+                self.connection.close()
+                self.close_connection = True
+                return
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            records.append((self.headers, body))
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    httpd = http.server.ThreadingHTTPServer(("localhost", 0), Handler)
+    httpd_thread = threading.Thread(name="httpd", target=httpd.serve_forever)
+    httpd_thread.start()
+    address = "localhost:%s" % httpd.server_port
+    writer = brozzler.warcprox_writer.WarcproxRecordWriter()
+    payload = os.urandom(16 * 1024 * 1024)
+    expected_digest = (
+        "sha1:" + base64.b32encode(hashlib.sha1(payload).digest()).decode()
+    )
+    try:
+        with tempfile.TemporaryFile() as f:
+            f.write(payload)
+            f.seek(0)
+            result = writer.write_record(
+                address, "youtube-dl:url", "resource", "video/mp4", f
+            )
+            assert result == (204, "No Content", expected_digest, len(payload))
+            assert records[-1][1] == payload
+            assert records[-1][0]["Content-Length"] == str(len(payload))
+            assert "Transfer-Encoding" not in records[-1][0]
+
+            # a connection reset while uploading is retried from the start
+            f.seek(0)
+            reset_next.set()
+            result = writer.write_record(
+                address, "youtube-dl:url", "resource", "video/mp4", f
+            )
+            assert result.payload_digest == expected_digest
+            assert len(records) == 2
+            assert records[-1][1] == payload
+    finally:
+        writer.close()
+        httpd.shutdown()
+        httpd.server_close()
+        httpd_thread.join()
+
+
+def test_warcprox_scoreboard():
+    frontier = mock.Mock()
+    count_query = frontier.rr.table.return_value.between.return_value.group.return_value
+    count_query.count.return_value.run.return_value = {"host1:8000": 2}
+    writer = brozzler.warcprox_writer.WarcproxRecordWriter()
+    scoreboard = brozzler.worker._WarcproxScoreboard(frontier, writer)
+
+    def warcproxes():
+        return [
+            {"host": "host1", "port": 8000, "load": 0.0},
+            {"host": "host2", "port": 8000, "load": 0.5},
+            {"host": "host3", "port": 8000, "load": 0.0},
+        ]
+
+    # choices spread out, counting sites assigned since the last refresh
+    chosen = [scoreboard.choose(warcproxes())["host"] for _ in range(5)]
+    assert chosen == ["host3", "host2", "host3", "host2", "host1"]
+    assert count_query.count.return_value.run.call_count == 1
+
+    # an instance that has been failing is avoided
+    scoreboard._refreshed = None
+    for _ in range(5):
+        writer.note_error("host3:8000")
+    assert writer.health("host3:8000")[0] > 0.5
+    chosen = [scoreboard.choose(warcproxes())["host"] for _ in range(3)]
+    assert chosen == ["host2", "host2", "host1"]
+    assert count_query.count.return_value.run.call_count == 2
+
+
+def test_host_budget():
+    buckets = brozzler.politeness.HostTokenBuckets(rate=1 / 60, burst=2)
+    assert buckets.take("http://a.example.com/1") == 0
+    assert buckets.take("http://a.example.com/2") == 0
+    assert 59 < buckets.take("http://a.example.com/3") <= 60
+    assert buckets.take("https://b.example.com/") == 0
+
+    # shared buckets are timed by the rethinkdb server's clock, and pruned
+    # now and then
+    rr = mock.Mock()
+    insert = rr.table.return_value.insert
+    insert.return_value.run.return_value = {"changes": [{"new_val": {"wait": 0}}]}
+    shared = brozzler.politeness.RethinkDbHostTokenBuckets(rr, rate=1 / 60)
+    assert shared.take("http://a.example.com/") == 0
+    assert not isinstance(insert.call_args.args[0]["updated"], (int, float))
+    assert not rr.table.return_value.between.called
+    shared._last_pruned -= shared.PRUNE_INTERVAL
+    assert shared.take("http://a.example.com/") == 0
+    assert rr.table.return_value.between.called
+
+    # pages of hosts over budget are passed over, and stay in the page queue
+    rr = mock.Mock()
+    rr.servers = [mock.Mock()]
+    rr.db_list.return_value.run.return_value = []
+    rr.table_list.return_value.run.return_value = []
+    frontier = brozzler.RethinkDbFrontier(rr, page_claim_batch_size=8)
+    site = brozzler.Site(rr, {"id": "site1", "seed": "http://a.example.com/"})
+    page_queue = brozzler.frontier._SitePageQueue("worker1")
+    for url, priority in [
+        ("http://a.example.com/", 10),
+        ("http://a.example.com/9", 9),
+        ("http://b.example.com/8", 8),
+        ("http://a.example.com/7", 7),
+        ("http://c.example.com/5", 5),
+        ("http://a.example.com/4", 4),
+    ]:
+        page_queue.push(
+            brozzler.Page(rr, {"id": url, "url": url, "priority": priority})
+        )
+    frontier._page_queues[site.id] = page_queue
+
+    budget = brozzler.politeness.HostTokenBuckets(rate=1 / 60)
+    claimed = [
+        frontier.claim_page(site, "worker1", host_budget=budget).url for _ in range(3)
+    ]
+    assert claimed == [
+        "http://a.example.com/",
+        "http://b.example.com/8",
+        "http://c.example.com/5",
+    ]
+    with pytest.raises(brozzler.HostOverBudget) as excinfo:
+        frontier.claim_page(site, "worker1", host_budget=budget)
+    assert 59 < excinfo.value.wait <= 60
+    assert sorted(page_queue.page_ids()) == [
+        "http://a.example.com/4",
+        "http://a.example.com/7",
+        "http://a.example.com/9",
+    ]
+
+
+def test_frontier_indexes_not_ready():
+    rr = mock.Mock()
+    rr.servers = [mock.Mock()]
+    rr.dbname = "brozzler"
+    rr.db_list.return_value.run.return_value = ["brozzler"]
+    rr.table_list.return_value.run.return_value = [
+        "sites",
+        "pages",
+        "site_stats",
+        "site_leases",
+        "host_buckets",
+        "jobs",
+    ]
+    table = rr.table.return_value
+    table.index_list.return_value.run.return_value = []
+
+    # indexes missing from tables created by an older version aren't built
+    # implicitly
+    with pytest.raises(brozzler.frontier.IndexesNotReady):
+        brozzler.RethinkDbFrontier(rr)
+    assert not table.index_create.called
+
+    brozzler.RethinkDbFrontier(rr, build_indexes=True)
+    created = {call.args[0] for call in table.index_create.call_args_list}
+    assert {"priority_by_site_ready", "retry_after_by_site"} <= created
+    assert table.index_wait.called
+
+    # nor used before they're ready
+    table.index_list.return_value.run.return_value = list(created)
+    table.index_status.return_value.run.return_value = [
+        {"index": name, "ready": name != "retry_after_by_site"} for name in created
+    ]
+    with pytest.raises(brozzler.frontier.IndexesNotReady):
+        brozzler.RethinkDbFrontier(rr)
+    table.index_status.return_value.run.return_value = [
+        {"index": name, "ready": True} for name in created
+    ]
+    brozzler.RethinkDbFrontier(rr)